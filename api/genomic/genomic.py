@@ -20,6 +20,11 @@ from sqlalchemy_filters import apply_filters
 from decimal import Decimal
 from app import app, genomic_dbs
 from api.vdjbase.vdjbase import get_vdjbase_species
+from db.dataset_fan_out import map_datasets
+from db.list_cursor import decode_keyset_cursor, keyset_page_query, merge_keyset_pages
+from db.sql_sort import sort_key_columns, row_sort_key, iter_merged_streams, values_table, check_sort_specs
+from api.stream_export import EXPORT_BATCH
+from api.response_encoding import field_converters, convert_row
 
 
 # Return SqlAlchemy row as a dict, using correct column names
@@ -152,6 +157,7 @@ filter_arguments.add_argument('page_size', type=int, location='args')
 filter_arguments.add_argument('filter', type=str, location='args')
 filter_arguments.add_argument('sort_by', type=str, location='args')
 filter_arguments.add_argument('cols', type=str, location='args')
+filter_arguments.add_argument('cursor', type=str, location='args')
 
 # borrowed from sqlalchemy-filters
 
@@ -184,7 +190,13 @@ class SequencesAPI(Resource):
 
         required_cols = json.loads(args['cols'])
         genomic_datasets = genomic_datasets.split(',')
-        ret = find_genomic_sequences(required_cols, genomic_datasets, species, json.loads(args['filter']) if args['filter'] else [])
+
+        sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None) else []
+        if len(sort_specs) == 0:
+            sort_specs = [{'field': 'name', 'order': 'asc'}]
+
+        ret, total_size, next_cursor, uniques = find_genomic_sequences_page(required_cols, genomic_datasets, species, json.loads(args['filter']) if args['filter'] else [],
+                                                                            sort_specs, args['page_number'] or 0, args['page_size'], args['cursor'])
 
         gene_order = {}
         set_index = 0
@@ -194,31 +206,11 @@ class SequencesAPI(Resource):
             for gene, order in go:
                 gene_order[gene] = int(order) + set_index
 
-        uniques = {}
         for f in required_cols:
-            uniques[f] = []
+            if f not in uniques:
+                uniques[f] = []
         uniques['dataset'] = genomic_datasets
 
-        for s in ret:
-            for f in required_cols:
-                if 'field' in genomic_sequence_filters[f] and genomic_sequence_filters[f]['field'] is not None and 'no_uniques' not in genomic_sequence_filters[f]:
-                    el = s[f]
-
-                    if f not in s:
-                        breakpoint()
-
-                    if isinstance(el, datetime):
-                        el = el.date().isoformat()
-                    elif isinstance(el, Decimal):
-                        el = int(el)
-                    elif isinstance(el, str) and len(el) == 0:
-                        el = '(blank)'
-                    elif isinstance(el, bool):
-                        if f in genomic_sequence_bool_values:
-                            el = genomic_sequence_bool_values[f][0 if el else 1]
-                    if el not in uniques[f]:
-                        uniques[f].append(el)
-
 
         def allele_sort_key(name):
             if gene_order is None or len(gene_order) == 0:
@@ -278,175 +270,277 @@ class SequencesAPI(Resource):
             except:
                 pass
 
-        sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None) else []
-        if len(sort_specs) == 0:
-            sort_specs = [{'field': 'name', 'order': 'asc'}]
-
-        for spec in sort_specs:
-            if spec['field'] in genomic_sequence_filters.keys():
-                f = spec['field']
-                if 'sort' in genomic_sequence_filters[f] and genomic_sequence_filters[f]['sort'] == 'numeric':
-                    ret = sorted(ret, key=lambda x: num_sort_key(x[spec['field']]), reverse=(spec['order'] == 'desc'))
-                elif 'sort' in genomic_sequence_filters[f] and genomic_sequence_filters[f]['sort'] == 'gene':
-                    ret = sorted(ret, key=lambda x: allele_sort_key(x[spec['field']]), reverse=(spec['order'] == 'desc'))
-                else:
-                    ret = sorted(ret, key=lambda x : (x[spec['field']] is None,  x[spec['field']]), reverse=(spec['order'] == 'desc'))
-
-        total_size = len(ret)
-
-        if args['page_size']:
-            first = (args['page_number']) * args['page_size']
-            ret = ret[first : first + args['page_size']]
-
         return {
             'sequences': ret,
             'uniques': uniques,
             'total_items': total_size,
             'page_size': args['page_size'],
-            'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1
+            'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1,
+            'next_cursor': next_cursor,
         }
 
 
-def find_genomic_sequences(required_cols, genomic_datasets, species, genomic_filters):
-    ret = []
+def genomic_providers(species, genomic_datasets):
+    providers = []
     for dataset in genomic_datasets:
         db = get_genomic_db(species, dataset)
 
         if db is None:
             raise BadRequest('Bad species or dataset name')
 
-        for col in required_cols:
-            if col not in genomic_sequence_filters.keys():
-                raise BadRequest('Bad column string %s' % col)
+        providers.append((dataset, db))
 
-        if 'sequence' in required_cols and 'gapped_sequence' not in required_cols:
-            required_cols.append('gapped_sequence')
+    return providers
 
-        attribute_query = [
-            genomic_sequence_filters['name']['field']]  # the query requires the first field to be from Sequence
 
-        for col in required_cols:
-            if col != 'name' and 'field' in genomic_sequence_filters[col] and genomic_sequence_filters[col]['field'] is not None:
-                attribute_query.append(genomic_sequence_filters[col]['field'])
+def genomic_sequence_attributes(required_cols):
+    for col in required_cols:
+        if col not in genomic_sequence_filters.keys():
+            raise BadRequest('Bad column string %s' % col)
 
-        seq_query = db.session.query(*attribute_query)
+    if 'sequence' in required_cols and 'gapped_sequence' not in required_cols:
+        required_cols.append('gapped_sequence')
 
-        seq_query = seq_query.join(Gene, Sequence.gene_id == Gene.id)
-        seq_query = seq_query.join(SequenceFeature, SequenceFeature.sequence_id == Sequence.id)
-        seq_query = seq_query.join(Feature, Feature.id == SequenceFeature.feature_id)
+    attribute_query = [
+        genomic_sequence_filters['name']['field']]  # the query requires the first field to be from Sequence
 
-        filter_spec = []
-        sample_count_filters = []
-        sample_id_filter = None
+    for col in required_cols:
+        if col != 'name' and 'field' in genomic_sequence_filters[col] and genomic_sequence_filters[col]['field'] is not None:
+            attribute_query.append(genomic_sequence_filters[col]['field'])
 
-        if len(genomic_filters) > 0:
-            for f in genomic_filters:
-                try:
-                    if 'fieldname' in genomic_sequence_filters[f['field']] and genomic_sequence_filters[f['field']]['fieldname'] == 'sample_count':
-                        sample_count_filters.append(f)
-                    elif 'fieldname' in genomic_sequence_filters[f['field']] and genomic_sequence_filters[f['field']]['fieldname'] == 'sample_identifier':
-                        sample_id_filter = f
-                    elif f['field'] == 'dataset':
-                        if f['op'] == 'in' and dataset not in f['value']:
-                            continue  # just going to ignore other criteria I'm afraid
-                    else:
-                        f['model'] = genomic_sequence_filters[f['field']]['model']
-                        if 'fieldname' in genomic_sequence_filters[f['field']]:
-                            f['field'] = genomic_sequence_filters[f['field']]['fieldname']
-                        if f['field'] in genomic_sequence_bool_values:
-                            value = []
-                            for v in f['value']:
-                                value.append('1' if v == genomic_sequence_bool_values[f['field']][0] else '0')
-                            f['value'] = value
-                        elif '(blank)' in f['value']:
-                            value_specs = [
-                                {'model': genomic_sequence_filters[f['field']]['model'], 'field': f['field'], 'op': 'is_null', 'value': ''},
-                                {'model': genomic_sequence_filters[f['field']]['model'], 'field': f['field'], 'op': '==', 'value': ''},
-                            ]
-
-                            for v in f['value']:
-                                if v != '(blank)':
-                                    value_specs.append({'model': genomic_sequence_filters[f['field']]['model'], 'field': f['field'], 'op': '==', 'value': v})
-                            
-                            f = {'or': value_specs}
-
-                        filter_spec.append(f)
-                except Exception as e:
-                    raise BadRequest(f'Bad filter string: {f}: {e}')
-
-        seq_query = apply_filters(seq_query, filter_spec)
-
-        for f in sample_count_filters:
-            if f['op'] in OPERATORS:
-                seq_query = seq_query.having(OPERATORS[f['op']](func.count(Patient.name), f['value']))
-
-        appears = {}
-
-        if sample_id_filter is not None:
-            filtered_sample_ids = []
-
-            names_to_ids = {}
-            for name, id in db.session.query(Sample.identifier, Sample.id).all():
-                names_to_ids[name] = id
-
-            for names in sample_id_filter['value'].items():
-                if names[0] == dataset:
-                    for n in names[1]:
-                        filtered_sample_ids.append(names_to_ids[n])
-
-            if not filtered_sample_ids:
-                continue
-
-            ids_to_names = {}
-            for id, name in  db.session.query(Sequence.id, Sequence.name).all():
-                ids_to_names[id] = name
-
-            sequence_id_query = db.session.query(Sequence.id.distinct()) \
-                .join(SampleSequence, Sequence.id == SampleSequence.sequence_id) \
-                .join(Sample, Sample.id == SampleSequence.sample_id)
-
-            filtered_sequence_ids = sequence_id_query.filter(Sample.id.in_(filtered_sample_ids)).all()
-            filtered_sequence_ids = [x[0] for x in filtered_sequence_ids]
-            seq_query = seq_query.filter(Sequence.id.in_(filtered_sequence_ids))
-
-            subseqs = db.session.query(SampleSequence.sequence_id, SampleSequence.sample_id)\
-                .filter(SampleSequence.sample_id.in_(filtered_sample_ids))\
-                .filter(SampleSequence.sequence_id.in_(filtered_sequence_ids))\
-                .all()
-
-            appearances = {}
-
-            for sequence_id, patient_id in subseqs:
-                if sequence_id not in appearances:
-                    appearances[sequence_id] = []
-                appearances[sequence_id].append(patient_id)
-
-            for k, v in appearances.items():
-                appears[ids_to_names[k]] = len(set(v))
-
-        seqs = seq_query.all()
-
-        for r in seqs:
-            s = r._asdict()
-
-            if len(appears):
-                if s['name'] in appears:
-                    s['appearances'] = appears[s['name']]
+    return attribute_query
+
+
+# The query for a dataset's sequences, and, if there is a sample filter, the number of selected samples in which
+# each sequence appears, by name ({} otherwise). The query is None if the filter selects no samples in the dataset
+
+def genomic_sequence_query(session, dataset, attribute_query, genomic_filters):
+    seq_query = session.query(*attribute_query)
+
+    seq_query = seq_query.join(Gene, Sequence.gene_id == Gene.id)
+    seq_query = seq_query.join(SequenceFeature, SequenceFeature.sequence_id == Sequence.id)
+    seq_query = seq_query.join(Feature, Feature.id == SequenceFeature.feature_id)
+
+    filter_spec = []
+    sample_count_filters = []
+    sample_id_filter = None
+
+    if len(genomic_filters) > 0:
+        for f in genomic_filters:
+            try:
+                f = dict(f)
+                if 'fieldname' in genomic_sequence_filters[f['field']] and genomic_sequence_filters[f['field']]['fieldname'] == 'sample_count':
+                    sample_count_filters.append(f)
+                elif 'fieldname' in genomic_sequence_filters[f['field']] and genomic_sequence_filters[f['field']]['fieldname'] == 'sample_identifier':
+                    sample_id_filter = f
+                elif f['field'] == 'dataset':
+                    if f['op'] == 'in' and dataset not in f['value']:
+                        continue  # just going to ignore other criteria I'm afraid
                 else:
-                    s['appearances'] = 0
+                    f['model'] = genomic_sequence_filters[f['field']]['model']
+                    if 'fieldname' in genomic_sequence_filters[f['field']]:
+                        f['field'] = genomic_sequence_filters[f['field']]['fieldname']
+                    if f['field'] in genomic_sequence_bool_values:
+                        value = []
+                        for v in f['value']:
+                            value.append('1' if v == genomic_sequence_bool_values[f['field']][0] else '0')
+                        f['value'] = value
+                    elif '(blank)' in f['value']:
+                        value_specs = [
+                            {'model': genomic_sequence_filters[f['field']]['model'], 'field': f['field'], 'op': 'is_null', 'value': ''},
+                            {'model': genomic_sequence_filters[f['field']]['model'], 'field': f['field'], 'op': '==', 'value': ''},
+                        ]
+
+                        for v in f['value']:
+                            if v != '(blank)':
+                                value_specs.append({'model': genomic_sequence_filters[f['field']]['model'], 'field': f['field'], 'op': '==', 'value': v})
+                        
+                        f = {'or': value_specs}
+
+                    filter_spec.append(f)
+            except Exception as e:
+                raise BadRequest(f'Bad filter string: {f}: {e}')
+
+    seq_query = apply_filters(seq_query, filter_spec)
+
+    for f in sample_count_filters:
+        if f['op'] in OPERATORS:
+            seq_query = seq_query.having(OPERATORS[f['op']](func.count(Patient.name), f['value']))
+
+    appears = {}
+
+    if sample_id_filter is not None:
+        filtered_sample_ids = []
+
+        names_to_ids = {}
+        for name, id in session.query(Sample.identifier, Sample.id).all():
+            names_to_ids[name] = id
+
+        for names in sample_id_filter['value'].items():
+            if names[0] == dataset:
+                for n in names[1]:
+                    filtered_sample_ids.append(names_to_ids[n])
+
+        if not filtered_sample_ids:
+            return None, appears
+
+        seq_query = seq_query.filter(Sequence.id.in_(
+            session.query(SampleSequence.sequence_id)
+            .join(Sample, Sample.id == SampleSequence.sample_id)
+            .filter(Sample.id.in_(filtered_sample_ids))))
+
+        appearances = session.query(Sequence.name, func.count(SampleSequence.sample_id.distinct()))\
+            .join(SampleSequence, Sequence.id == SampleSequence.sequence_id)\
+            .filter(SampleSequence.sample_id.in_(filtered_sample_ids))\
+            .group_by(Sequence.id)\
+            .all()
+
+        for name, count in appearances:
+            appears[name] = count
+
+    return seq_query, appears
+
+
+def genomic_sequence_row(r, dataset, appears, converters):
+    s = r._asdict()
+
+    if len(appears):
+        if s['name'] in appears:
+            s['appearances'] = appears[s['name']]
+        else:
+            s['appearances'] = 0
+
+    convert_row(s, converters)
+    s['dataset'] = dataset
+
+    for k in list(s.keys()):
+        if k.startswith('_sort_'):
+            del s[k]
+
+    return s
+
+
+def genomic_sequence_unique_value(f, el):
+    if isinstance(el, datetime):
+        el = el.date().isoformat()
+    elif isinstance(el, Decimal):
+        el = int(el)
+    elif isinstance(el, str) and len(el) == 0:
+        el = '(blank)'
+    elif isinstance(el, bool):
+        if f in genomic_sequence_bool_values:
+            el = genomic_sequence_bool_values[f][0 if el else 1]
+    return el
+
+
+# The distinct values of each of the required columns in the rows selected by a dataset's query, as listed in the
+# uniques of the sequence list
+
+def genomic_sequence_uniques(query, required_cols, appears, converters):
+    uniques = {}
+
+    for f in required_cols:
+        if 'field' in genomic_sequence_filters[f] and genomic_sequence_filters[f]['field'] is not None and 'no_uniques' not in genomic_sequence_filters[f]:
+            field = genomic_sequence_filters[f]['field']
+
+            if f == 'appearances' and len(appears):
+                values = [appears.get(name, 0) for (name,) in query.with_entities(Sequence.name).distinct()]
+            else:
+                values = [convert_row({field.key: v}, converters)[field.key] for (v,) in query.with_entities(field).distinct()]
+
+            uniques[f] = list(dict.fromkeys(genomic_sequence_unique_value(f, el) for el in values))
+
+    return uniques
 
-            for k, v in s.items():
-                if isinstance(v, datetime):
-                    s[k] = v.date().isoformat()
-                elif isinstance(v, Decimal):
-                    s[k] = int(v)
-            s['dataset'] = dataset
 
-            ret.append(s)
+def find_genomic_sequences(required_cols, genomic_datasets, species, genomic_filters):
+    providers = genomic_providers(species, genomic_datasets)
+    attribute_query = genomic_sequence_attributes(required_cols)
+    converters = field_converters(attribute_query, decimal_converter=int)
+
+    def dataset_sequences(session, dataset):
+        seq_query, appears = genomic_sequence_query(session, dataset, attribute_query, genomic_filters)
+
+        if seq_query is None:
+            return []
+
+        return [genomic_sequence_row(r, dataset, appears, converters) for r in seq_query.all()]
+
+    ret = []
+    for rows in map_datasets(dataset_sequences, providers):
+        ret.extend(rows)
 
     return ret
 
 
+# Sort keys for the sequence list. With a sample filter, appearances are counted in the selected samples, and
+# appears_field is the count to sort by
+
+def genomic_sequence_sort_keys(sort_specs, appears_field=None):
+    filters = genomic_sequence_filters
+    if appears_field is not None:
+        filters = dict(filters, appearances=dict(filters['appearances'], field=appears_field))
+
+    return sort_key_columns(filters, sort_specs)
+
+
+# Return one page of sequences, sorted and paged by the database, with the uniques of the sequences selected by the
+# filter. Each row is a sequence and one of its features. Returns (sequences, total_size, next_cursor, uniques).
+# Sequences can be sorted on any field in genomic_sequence_filters that has a column
+
+def find_genomic_sequences_page(required_cols, genomic_datasets, species, genomic_filters, sort_specs, page_number=0, page_size=None, cursor=None):
+    providers = genomic_providers(species, genomic_datasets)
+    attribute_query = genomic_sequence_attributes(required_cols)
+    converters = field_converters(attribute_query, decimal_converter=int)
+    try:
+        check_sort_specs(genomic_sequence_filters, sort_specs)
+    except ValueError as e:
+        raise BadRequest(f'Bad sort: {e}')
+
+    sort_keys = genomic_sequence_sort_keys(sort_specs)
+    id_keys = [(Sequence.id.label('_sort_id'), False), (Feature.id.label('_sort_feature_id'), False)]
+    offset = page_number * page_size if page_size and not cursor else 0
+    last = None
+
+    if cursor:
+        try:
+            last = decode_keyset_cursor(cursor, genomic_datasets, sort_keys, id_keys)
+        except ValueError as e:
+            raise BadRequest(f'Bad cursor: {e}')
+
+    def dataset_page(session, dataset):
+        seq_query, appears = genomic_sequence_query(session, dataset, attribute_query, genomic_filters)
+
+        if seq_query is None:
+            return 0, {}, appears, []
+
+        count = seq_query.count()
+        uniques = genomic_sequence_uniques(seq_query, required_cols, appears, converters)
+
+        keys = sort_keys
+        if appears and any(spec['field'] == 'appearances' for spec in sort_specs):
+            appears_table = values_table(session, 'sequence_appears', appears.items())
+            seq_query = seq_query.outerjoin(appears_table, appears_table.c.key == Sequence.name)
+            keys = genomic_sequence_sort_keys(sort_specs, func.coalesce(appears_table.c.value, 0))
+
+        seq_query = seq_query.add_columns(*[k for k, _ in keys + id_keys])
+        seq_query = keyset_page_query(seq_query, keys, id_keys, genomic_datasets.index(dataset), last, offset + page_size + 1 if page_size else None)
+        return count, uniques, appears, seq_query.all()
+
+    results = map_datasets(dataset_page, providers)
+    total_size = sum(r[0] for r in results)
+    merged, next_cursor = merge_keyset_pages([(dataset, r[3]) for dataset, r in zip(genomic_datasets, results)], sort_keys, id_keys, offset, page_size)
+    appears = {dataset: r[2] for dataset, r in zip(genomic_datasets, results)}
+    ret = [genomic_sequence_row(r, dataset, appears[dataset], converters) for dataset, r in merged]
+
+    uniques = {}
+    for _, dataset_uniques, _, _ in results:
+        for f, values in dataset_uniques.items():
+            uniques[f] = list(dict.fromkeys(uniques.get(f, []) + values))
+
+    return ret, total_size, next_cursor, uniques
+
+
 @ns.route('/feature_pos/<string:species>/<string:dataset>/<string:ref_seq_name>/<string:feature_string>')
 @api.response(404, 'Reference sequence not found.')
 class FeaturePosAPI(Resource):
@@ -519,20 +613,24 @@ class SubjectsAPI(Resource):
 
         filter = json.loads(args['filter']) if args['filter'] else []
         datasets = genomic_datasets.split(',')
-        ret = find_genomic_samples(attribute_query, species, datasets, filter)
 
-        uniques = {}
+        sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None) else []
+        if len(sort_specs) == 0:
+            sort_specs = [{'field': 'sample_identifier', 'order': 'asc'}]
+
+        unique_cols = [f for f in required_cols if genomic_sample_filters[f]['field'] is not None and 'no_uniques' not in genomic_sample_filters[f]]
+        filter_applied = len(filter) > 0
+        ret, total_size, next_cursor, uniques, names_by_dataset = find_genomic_samples_page(attribute_query, species, datasets, filter, sort_specs, args['page_number'] or 0,
+                                                                                            args['page_size'], args['cursor'], unique_cols, names=filter_applied)
+
         for f in required_cols:
-            uniques[f] = []
+            if f not in uniques:
+                uniques[f] = []
         uniques['dataset'] = datasets
 
         # special column for names by dataset
 
-        uniques['names_by_dataset'] = {}
-        filter_applied = len(filter) > 0
-        if filter_applied:
-            for dataset in uniques['dataset']:
-                uniques['names_by_dataset'][dataset] = []
+        uniques['names_by_dataset'] = names_by_dataset if filter_applied else {}
 
         def num_sort_key(x):
             if x is None or x == '':
@@ -549,19 +647,6 @@ class SubjectsAPI(Resource):
                 name[i] = name[i][1:].zfill(4)
             return name
 
-        for s in ret:
-            for f in required_cols:
-                if genomic_sample_filters[f]['field'] is not None and 'no_uniques' not in genomic_sample_filters[f]:
-                    el = s[f]
-                    if isinstance(el, datetime):
-                        el = el.date().isoformat()
-                    elif isinstance(el, str) and len(el) == 0:
-                        el = '(blank)'
-                    if el not in uniques[f]:
-                        uniques[f].append(el)
-            if filter_applied:
-                uniques['names_by_dataset'][s['dataset']].append(s['sample_id'])
-
         for f in required_cols:
             try:
                 if 'sort' in genomic_sample_filters[f] and genomic_sample_filters[f]['sort'] == 'numeric':
@@ -573,112 +658,222 @@ class SubjectsAPI(Resource):
             except:
                 pass
 
-        sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None) else []
-        if len(sort_specs) == 0:
-            sort_specs = [{'field': 'sample_identifier', 'order': 'asc'}]
-
-        for spec in sort_specs:
-            f = spec['field']
-            if f in genomic_sample_filters.keys():
-                if 'sort' in genomic_sample_filters[f] and genomic_sample_filters[f]['sort'] == 'underscore':
-                    ret = sorted(ret, key=lambda x: name_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-                elif 'sort' in genomic_sample_filters[f] and genomic_sample_filters[f]['sort'] == 'numeric':
-                    ret = sorted(ret, key=lambda x: num_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-                else:
-                    ret = sorted(ret, key=lambda x: ((x[f] is None or x[f] == ''),  x[f]), reverse=(spec['order'] == 'desc'))
-
-        total_size = len(ret)
-
-        if args['page_size']:
-            first = (args['page_number']) * args['page_size']
-            ret = ret[first : first + args['page_size']]
-
         return {
             'samples': ret,
             'uniques': uniques,
             'total_items': total_size,
             'page_size': args['page_size'],
-            'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1
+            'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1,
+            'next_cursor': next_cursor,
         }
 
 
-def find_genomic_samples(attribute_query, species, genomic_datasets, genomic_filters):
-    results = []
-    for dataset in genomic_datasets:
-        db = get_genomic_db(species, dataset)
+def genomic_sample_query(session, dataset, attribute_query, genomic_filters):
+    sample_query = session.query(*attribute_query)\
+        .join(Patient, Sample.patient_id == Patient.id)\
+        .join(SeqProtocol, Sample.seq_protocol_id == SeqProtocol.id)\
+        .join(TissuePro, Sample.tissue_pro_id == TissuePro.id)\
+        .join(Study, Sample.study_id == Study.id)
+
+    allele_filters = None
+
+    filter_spec = []
+    for f in genomic_filters:
+        try:
+            f = dict(f)
+            if f['field'] == 'allele':
+                allele_filters = f
+            elif f['field'] == 'dataset':
+                if f['op'] == 'in' and dataset not in f['value']:
+                    continue        # just going to ignore other criteria I'm afraid
+            else:
+                f['model'] = genomic_sample_filters[f['field']]['model']
+                if 'fieldname' in genomic_sample_filters[f['field']]:
+                    f['field'] = genomic_sample_filters[f['field']]['fieldname']
+                if '(blank)' in f['value']:
+                    value_specs = [
+                        {'model': genomic_sample_filters[f['field']]['model'], 'field': f['field'], 'op': 'is_null', 'value': ''},
+                        {'model': genomic_sample_filters[f['field']]['model'], 'field': f['field'], 'op': '==', 'value': ''},
+                    ]
+
+                    for v in f['value']:
+                        if v != '(blank)':
+                            value_specs.append({'model': genomic_sample_filters[f['field']]['model'], 'field': f['field'], 'op': '==', 'value': v})
+                    
+                    f = {'or': value_specs}
+
+                filter_spec.append(f)
+        except Exception as e:
+            raise BadRequest(f'Bad filter string: {f}: {e}')
+
+    if len(filter_spec) > 0:
+        sample_query = apply_filters(sample_query, filter_spec)
+
+    if allele_filters is not None:
+        samples_with_alleles = session.query(Sample.sample_name)\
+            .join(Patient, Sample.patient_id == Patient.id)\
+            .join(SampleSequence, SampleSequence.sample_id == Sample.id)\
+            .join(Sequence, SampleSequence.sequence_id == Sequence.id)\
+            .filter(Sequence.name.in_(allele_filters['value']))\
+            .all()
+        samples_with_alleles = [x[0] for x in samples_with_alleles]
+        sample_query = sample_query.filter(Sample.sample_name.in_(samples_with_alleles))
 
-        if db is None:
-            raise BadRequest('Bad species or dataset name')
+    return sample_query
 
-        sample_query = db.session.query(*attribute_query)\
-            .join(Patient, Sample.patient_id == Patient.id)\
-            .join(SeqProtocol, Sample.seq_protocol_id == SeqProtocol.id)\
-            .join(TissuePro, Sample.tissue_pro_id == TissuePro.id)\
-            .join(Study, Sample.study_id == Study.id)
 
-        allele_filters = None
+GENOMIC_SAMPLE_PATH_COLS = ('annotation_path', 'contig_bam_path')
 
-        filter_spec = []
-        for f in genomic_filters:
-            try:
-                if f['field'] == 'allele':
-                    allele_filters = f
-                elif f['field'] == 'dataset':
-                    if f['op'] == 'in' and dataset not in f['value']:
-                        continue        # just going to ignore other criteria I'm afraid
-                else:
-                    f['model'] = genomic_sample_filters[f['field']]['model']
-                    if 'fieldname' in genomic_sample_filters[f['field']]:
-                        f['field'] = genomic_sample_filters[f['field']]['fieldname']
-                    if '(blank)' in f['value']:
-                        value_specs = [
-                            {'model': genomic_sample_filters[f['field']]['model'], 'field': f['field'], 'op': 'is_null', 'value': ''},
-                            {'model': genomic_sample_filters[f['field']]['model'], 'field': f['field'], 'op': '==', 'value': ''},
-                        ]
 
-                        for v in f['value']:
-                            if v != '(blank)':
-                                value_specs.append({'model': genomic_sample_filters[f['field']]['model'], 'field': f['field'], 'op': '==', 'value': v})
-                        
-                        f = {'or': value_specs}
+def genomic_sample_path(species, dataset, v):
+    if 'http' not in v:
+        return os.path.join(app.config['STATIC_LINK'], 'study_data/Genomic/samples', species, dataset, v)
+    return v
 
-                    filter_spec.append(f)
-            except Exception as e:
-                raise BadRequest(f'Bad filter string: {f}: {e}')
 
-        if len(filter_spec) > 0:
-            sample_query = apply_filters(sample_query, filter_spec)
-
-        if allele_filters is not None:
-            samples_with_alleles = db.session.query(Sample.sample_name)\
-                .join(Patient, Sample.patient_id == Patient.id)\
-                .join(SampleSequence, SampleSequence.sample_id == Sample.id)\
-                .join(Sequence, SampleSequence.sequence_id == Sequence.id)\
-                .filter(Sequence.name.in_(allele_filters['value']))\
-                .all()
-            samples_with_alleles = [x[0] for x in samples_with_alleles]
-            sample_query = sample_query.filter(Sample.sample_name.in_(samples_with_alleles))
-
-        samples = sample_query.all()
-
-        for s in samples:
-            r = s._asdict()
-            for k in list(r.keys()):
-                v = r[k]
-                if isinstance(v, datetime):
-                    r[k] = v.date().isoformat()
-                elif k == 'annotation_path' or k == 'contig_bam_path':
-                    if v is None:
-                        app.logger.error('No annotation path for sample %s' % r['sample_id'])
-                        r[k] = ''
-                    elif 'http' not in v:
-                        r[k] = os.path.join(app.config['STATIC_LINK'], 'study_data/Genomic/samples', species, dataset, r[k])
-            r['dataset'] = dataset
-            results.append(r)
+def genomic_sample_row(s, species, dataset, converters):
+    r = s._asdict()
+    convert_row(r, converters)
+    for k in GENOMIC_SAMPLE_PATH_COLS:
+        if k in r:
+            v = r[k]
+            if v is None:
+                app.logger.error('No annotation path for sample %s' % r['sample_id'])
+                r[k] = ''
+            else:
+                r[k] = genomic_sample_path(species, dataset, v)
+    r['dataset'] = dataset
+
+    for k in list(r.keys()):
+        if k.startswith('_sort_'):
+            del r[k]
+
+    return r
+
+
+def find_genomic_samples(attribute_query, species, genomic_datasets, genomic_filters):
+    providers = genomic_providers(species, genomic_datasets)
+    converters = field_converters(attribute_query, decimal_converter=None)
+
+    def dataset_samples(session, dataset):
+        return [genomic_sample_row(s, species, dataset, converters) for s in genomic_sample_query(session, dataset, attribute_query, genomic_filters).all()]
+
+    results = []
+    for rows in map_datasets(dataset_samples, providers):
+        results.extend(rows)
 
     return results
 
 
+# The distinct values of the named columns in the rows selected by a dataset's query, as listed in the uniques of
+# the subject list
+
+def genomic_sample_uniques(query, unique_cols, species, dataset, converters):
+    uniques = {}
+
+    for f in unique_cols:
+        field = genomic_sample_filters[f]['field']
+        values = []
+
+        for (el,) in query.with_entities(field).distinct():
+            el = convert_row({field.key: el}, converters)[field.key]
+            if f in GENOMIC_SAMPLE_PATH_COLS:
+                el = genomic_sample_path(species, dataset, el) if el is not None else ''
+            if isinstance(el, datetime):
+                el = el.date().isoformat()
+            elif isinstance(el, str) and len(el) == 0:
+                el = '(blank)'
+            values.append(el)
+
+        uniques[f] = list(dict.fromkeys(values))
+
+    return uniques
+
+
+# Return one page of samples, sorted and paged by the database, with the uniques of unique_cols over the samples
+# selected by the filter, and, if names is set, their sample ids by dataset.
+# Returns (samples, total_size, next_cursor, uniques, names_by_dataset)
+
+def find_genomic_samples_page(attribute_query, species, genomic_datasets, genomic_filters, sort_specs, page_number=0, page_size=None, cursor=None, unique_cols=(), names=False):
+    providers = genomic_providers(species, genomic_datasets)
+    converters = field_converters(attribute_query, decimal_converter=None)
+    sort_keys = sort_key_columns(genomic_sample_filters, sort_specs)
+    id_keys = [(Sample.id.label('_sort_id'), False)]
+    offset = page_number * page_size if page_size and not cursor else 0
+    last = None
+
+    if cursor:
+        try:
+            last = decode_keyset_cursor(cursor, genomic_datasets, sort_keys, id_keys)
+        except ValueError as e:
+            raise BadRequest(f'Bad cursor: {e}')
+
+    def dataset_page(session, dataset):
+        query = genomic_sample_query(session, dataset, attribute_query, genomic_filters)
+        count = query.with_entities(Sample.id).count()
+        uniques = genomic_sample_uniques(query, unique_cols, species, dataset, converters)
+        dataset_names = [r[0] for r in query.with_entities(Sample.sample_id)] if names else None
+        query = query.add_columns(*[k for k, _ in sort_keys + id_keys])
+        query = keyset_page_query(query, sort_keys, id_keys, genomic_datasets.index(dataset), last, offset + page_size + 1 if page_size else None)
+        return count, uniques, dataset_names, query.all()
+
+    results = map_datasets(dataset_page, providers)
+    total_size = sum(r[0] for r in results)
+    merged, next_cursor = merge_keyset_pages([(dataset, r[3]) for dataset, r in zip(genomic_datasets, results)], sort_keys, id_keys, offset, page_size)
+    ret = [genomic_sample_row(s, species, dataset, converters) for dataset, s in merged]
+
+    uniques = {}
+    for _, dataset_uniques, _, _ in results:
+        for f, values in dataset_uniques.items():
+            uniques[f] = list(dict.fromkeys(uniques.get(f, []) + values))
+
+    names_by_dataset = {dataset: r[2] for dataset, r in zip(genomic_datasets, results)} if names else None
+
+    return ret, total_size, next_cursor, uniques, names_by_dataset
+
+
+# Generator over all selected samples in sort order, for streaming export, starting after the cursor if one is
+# given. Each dataset's query is read a batch at a time, and the datasets are merged as they are read. The datasets
+# and cursor are checked before the generator is returned
+
+def iter_genomic_samples(attribute_query, species, genomic_datasets, genomic_filters, sort_specs, cursor=None):
+    providers = genomic_providers(species, genomic_datasets)
+    converters = field_converters(attribute_query, decimal_converter=None)
+    sort_keys = sort_key_columns(genomic_sample_filters, sort_specs)
+    id_keys = [(Sample.id.label('_sort_id'), False)]
+    last = None
+
+    if cursor:
+        try:
+            last = decode_keyset_cursor(cursor, genomic_datasets, sort_keys, id_keys)
+        except ValueError as e:
+            raise BadRequest(f'Bad cursor: {e}')
+
+    def keyed_rows(query, ds_index, dataset):
+        for s in query:
+            yield row_sort_key(s, sort_keys) + (ds_index, s._sort_id), (dataset, s)
+
+    def samples():
+        sessions = []
+        try:
+            streams = []
+            for ds_index, (dataset, provider) in enumerate(providers):
+                session = provider.new_session()
+                sessions.append(session)
+                query = genomic_sample_query(session, dataset, attribute_query, genomic_filters)
+                query = query.add_columns(*[k for k, _ in sort_keys + id_keys])
+                query = keyset_page_query(query, sort_keys, id_keys, ds_index, last).yield_per(EXPORT_BATCH)
+                streams.append(keyed_rows(query, ds_index, dataset))
+
+            for dataset, s in iter_merged_streams(streams):
+                yield genomic_sample_row(s, species, dataset, converters)
+        finally:
+            for session in sessions:
+                session.close()
+
+    return samples()
+
+
 def find_genomic_filter_params(species, genomic_datasets):
     genes = []
     gene_types = []
@@ -3,6 +3,7 @@ from Bio import SeqIO
 from werkzeug.exceptions import BadRequest
 from api.reports.reports import send_report
 from api.reports.report_utils import make_output_file, chunk_list
+from api.reports.report_progress import report_progress, check_cancelled
 from app import vdjbase_dbs
 from db.vdjbase_airr_model import GenoDetection, SeqProtocol, Study, TissuePro, Patient, Sample, DataPro
 import csv
@@ -20,6 +21,7 @@ SAMPLE_CHUNKS = 500
 def zipdir(path, ziph, arc_root):
     # ziph is zipfile handle
     for root, dirs, files in os.walk(path):
+        check_cancelled()
         for file in files:
             path = os.path.join(root, file)
             ziph.write(path, arcname=path.replace(arc_root, ''))
@@ -46,10 +48,13 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
                 headers.append(name)
 
         rows = []
+        done = 0
         for dataset in samples_by_dataset.keys():
             session = vdjbase_dbs[species][dataset].session
 
             for sample_chunk in chunk_list(samples_by_dataset[dataset], SAMPLE_CHUNKS):
+                report_progress('collecting sample info', done / len(rep_samples))
+                done += len(sample_chunk)
                 sample_list = session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(sample_chunk)).all()
                 sample_list = [s[0] for s in sample_list]
 
@@ -84,10 +89,13 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
             added_files = []            # handle multiple samples in same dir etc
             added_dirs = []
+            done = 0
             for dataset in samples_by_dataset.keys():
                 print('adding dataset')
                 session = vdjbase_dbs[species][dataset].session
                 for sample_chunk in chunk_list(samples_by_dataset[dataset], SAMPLE_CHUNKS):
+                    report_progress('adding sample files', done / len(rep_samples))
+                    done += len(sample_chunk)
                     sample_list = session.query(Sample.genotype, Sample.igsnper_plot_path).filter(Sample.sample_name.in_(sample_chunk)).all()
                     for p1, p2 in sample_list:
                         if p1 is not None and len(p1) > 0:
@@ -105,6 +113,7 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
     elif 'Ungapped' in params['type'] or 'Gapped' in params['type']:
         required_cols = ['name', 'seq', 'dataset']
+        report_progress('collecting sequences')
         seqs = find_sequences(params, rep_samples, species, required_cols)
 
         recs = []
@@ -123,6 +132,7 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
                 headers.append(name)
 
         headers.append('dataset')
+        report_progress('collecting sequences')
         rows = find_sequences(params, rep_samples, species, headers)
 
         outfile = make_output_file('csv')
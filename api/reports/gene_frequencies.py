@@ -3,7 +3,7 @@ from collections import defaultdict
 
 from werkzeug.exceptions import BadRequest
 from api.reports.reports import run_rscript, send_report
-from api.reports.report_utils import make_output_file, collate_samples, chunk_list
+from api.reports.report_utils import make_output_file, collate_samples, chunk_list, write_r_input
 from app import vdjbase_dbs
 from db.vdjbase_model import Gene, GenesDistribution
 from db.vdjbase_airr_model import Sample
@@ -64,8 +64,7 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     #genes_frequencies_df = pd.concat([genes_frequencies_df, pd.DataFrame([{'GENE': gene, 'FREQ': ",".join([str(x) for x in usages])} for gene, usages in genes_frequencies.items()])], axis=0, ignore_index=True)
     genes_frequencies_df = pd.DataFrame([{'GENE': gene, 'FREQ': ",".join([str(x) for x in usages])} for gene, usages in genes_frequencies.items()])
 
-    input_path = make_output_file('tab')
-    genes_frequencies_df.to_csv(input_path, sep='\t', index=False)
+    input_path = write_r_input(genes_frequencies_df)
 
     output_path = make_output_file(format)
     attachment_filename = '%s_gene_frequency.pdf' % species
@@ -1,138 +1,185 @@
 # Functions to extract genotypes by database query
+#
+# Genotypes are extracted for a batch of samples at a time, with one query per chunk of samples, and returned as a
+# single frame with one row per sample and gene, in the format expected by the genotype report scripts.
 
-from db.genomic_db import Gene as GenomicGene, Sequence as GenomicSequence, SampleSequence as GenomicSampleSequence, SampleSequence as GenomicSampleSequence
+from db.genomic_db import Gene as GenomicGene, Sequence as GenomicSequence, SampleSequence as GenomicSampleSequence
 from db.genomic_airr_model import Sample as GenomicSample
 from db.vdjbase_model import Gene, Allele, AllelesSample
 from db.vdjbase_airr_model import Sample
-from receptor_utils.simple_bio_seq import read_csv
+from api.reports.report_utils import chunk_list
+from api.reports.report_progress import check_cancelled
 
 import pandas as pd
 
-def fake_genotype(subject, genes):
-    genotype = []
-    for gene_name, gene_details in genes.items():
-        rec = fake_gene(gene_details, gene_name, subject)
-        genotype.append(rec)
+GENOTYPE_COLUMNS = ['subject', 'gene', 'alleles', 'counts', 'total', 'note', 'kh', 'kd', 'kt', 'kq', 'k_diff',
+                    'GENOTYPED_ALLELES', 'Freq_by_Clone', 'Freq_by_Seq']
 
-    return genotype
+# Samples named in each query. Wanted genes are filtered in the query if there are no more than GENE_FILTER_LIMIT
+# of them, and afterwards otherwise, to stay within SQLite's limit on the number of query parameters
+SAMPLE_CHUNKS = 400
+GENE_FILTER_LIMIT = 400
 
 
-def fake_gene(gene_details, gene_name, subject):
-    rec = {
-        'subject': subject,
-        'gene': gene_name,
-        'alleles': ','.join(gene_details['alleles']),
-        'counts': ','.join(gene_details['count']),
-        'total': gene_details['total_count'],
-        'note': '',
-        'kh': '1',
-        'kd': '1',
-        'kt': '1',
-        'kq': '1',
-        'k_diff': gene_details['kdiff'],
-        'GENOTYPED_ALLELES': ','.join(gene_details['alleles']),
-        'Freq_by_Clone': ';'.join(gene_details['fc']),
-        'Freq_by_Seq': ';'.join(gene_details['fs']),
-    }
-    return rec
+# Allele name as used in the genotype, eg 01 for IGHV1-2*01
 
+def allele_suffix(allele):
+    if '*' in allele:
+        return allele.split('*')[1]
+    elif '.' in allele:         # cirelli format
+        if allele[-2:-1] == '.' and allele[-1].isalpha():
+            return '01_' + allele[-1]
+        elif '_' in allele.replace('LJI.Rh_', ''):
+            return '01_' + allele.replace('LJI.Rh_', '').split('_')[-1]
+        else:
+            return '01'
+    else:
+        return allele    # don't expect this to happen
 
-def process_genomic_genotype(sample_name, wanted_genes, session, functional, fully_haplotyped):
-    allele_query = session.query(GenomicSample.sample_name, GenomicSequence.name, GenomicGene.name, GenomicSampleSequence.haplotype)\
-        .filter(GenomicSample.sample_name == sample_name) \
+
+# Run the query for each chunk of samples, returning a frame with the given columns, the first two of which must be
+# the sample and gene name
+
+def query_genotype_rows(query, sample_col, gene_col, sample_names, wanted_genes, columns):
+    if 0 < len(wanted_genes) <= GENE_FILTER_LIMIT:
+        query = query.filter(gene_col.in_(list(wanted_genes)))
+
+    rows = []
+    for sample_chunk in chunk_list(list(sample_names), SAMPLE_CHUNKS):
+        check_cancelled()
+        rows.extend(query.filter(sample_col.in_(sample_chunk)).all())
+
+    rows = pd.DataFrame(rows, columns=columns, dtype=object)
+
+    if len(wanted_genes) > GENE_FILTER_LIMIT:
+        rows = rows[rows['gene'].isin(list(wanted_genes))]
+
+    return rows
+
+
+# Convert allele names to the form used in genotypes, and drop repeats of an allele in a sample's gene
+
+def unique_alleles(rows):
+    names = rows['allele'].unique()
+    rows = rows.assign(allele=rows['allele'].map(dict(zip(names, map(allele_suffix, names)))))
+
+    repeated = rows.duplicated(['subject', 'gene', 'allele'])
+    for allele_name in rows.loc[repeated, 'allele']:
+        print(f"Allele {allele_name} seen multiply in genotype")
+
+    return rows[~repeated]
+
+
+# Collapse rows of (subject, gene, allele, count, fc, fs, kdiff, total) into one row per subject and gene, ordered by
+# subject as in sample_names
+
+def build_genotypes(rows, sample_names):
+    if len(rows) == 0:
+        return pd.DataFrame(columns=GENOTYPE_COLUMNS)
+
+    genotypes = rows.groupby(['subject', 'gene'], sort=False).agg(
+        alleles=('allele', ','.join),
+        counts=('count', ','.join),
+        total=('total', 'last'),
+        k_diff=('kdiff', 'last'),
+        Freq_by_Clone=('fc', ';'.join),
+        Freq_by_Seq=('fs', ';'.join),
+    ).reset_index()
+
+    genotypes['note'] = ''
+    for col in ['kh', 'kd', 'kt', 'kq']:
+        genotypes[col] = '1'
+    genotypes['GENOTYPED_ALLELES'] = genotypes['alleles']
+
+    order = {name: i for i, name in enumerate(sample_names)}
+    genotypes = genotypes.iloc[genotypes['subject'].map(order).argsort(kind='stable')]
+    return genotypes[GENOTYPE_COLUMNS].reset_index(drop=True)
+
+
+def genomic_genotypes(sample_names, wanted_genes, session, functional, fully_haplotyped):
+    query = session.query(GenomicSample.sample_name, GenomicGene.name, GenomicSequence.name, GenomicSampleSequence.haplotype)\
         .join(GenomicSampleSequence, GenomicSampleSequence.sample_id == GenomicSample.id) \
         .join(GenomicSequence, GenomicSampleSequence.sequence_id == GenomicSequence.id) \
         .filter(GenomicSequence.type.like('%REGION%')) \
         .join(GenomicGene, GenomicGene.id == GenomicSequence.gene_id)
 
-    if len(wanted_genes) > 0:
-        allele_query = allele_query.filter(GenomicGene.name.in_(wanted_genes))
-
     if functional:
-        allele_query = allele_query.filter(GenomicSequence.functional == 'Functional')
-
-    alleles = allele_query.all()
-
-    genes = {}
-    for _, allele, gene, haplotype in alleles:
-        if gene not in genes:
-            genes[gene] = {'alleles': [], 'count': [], 'fc': [], 'fs': [], 'haplotypes': []}
-
-        if '*' in allele:
-            allele_name = allele.split('*')[1]
-        elif '.' in allele:         # cirelli format
-            if allele[-2:-1] == '.' and allele[-1].isalpha():
-                allele_name = '01_' + allele[-1]
-            elif '_' in allele.replace('LJI.Rh_', ''):
-                allele_name = '01_' + allele.replace('LJI.Rh_', '').split('_')[-1]
-            else:
-                allele_name = '01'
-        else:
-            allele_name = allele    # don't expect this to happen
-
-        if allele_name not in genes[gene]['alleles']:
-            genes[gene]['alleles'].append(allele_name)
-            genes[gene]['haplotypes'].extend(haplotype.split(','))
-            genes[gene]['count'].append('1')
-            genes[gene]['fc'].append('1')
-            genes[gene]['fs'].append('1')
-            genes[gene]['kdiff'] = '1000'
-            genes[gene]['total_count'] = 1
-        else:
-            print(f"Allele {allele_name} seen multiply in genotype")
+        query = query.filter(GenomicSequence.functional == 'Functional')
 
-    if fully_haplotyped:
-        dropped = []
-        for gene_name in list(genes.keys()):
-            if 'h0' in genes[gene_name]['haplotypes'] or len(genes[gene_name]['haplotypes']) < 2:
-                dropped.append(genes[gene_name])
-                del genes[gene_name]
+    rows = query_genotype_rows(query, GenomicSample.sample_name, GenomicGene.name, sample_names, wanted_genes,
+                               ['subject', 'gene', 'allele', 'haplotype'])
+    rows = unique_alleles(rows)
 
-    geno_list = fake_genotype(sample_name, genes)
-    return pd.DataFrame(geno_list)
+    # keep only genes in which both haplotypes are assigned
 
+    if fully_haplotyped and len(rows) > 0:
+        haplotypes = ',' + rows['haplotype'].fillna('') + ','
+        genes = rows[['subject', 'gene']].assign(h0=haplotypes.str.contains(',h0,', regex=False),
+                                                  haplotypes=haplotypes.str.count(',') - 1)
+        grouped = genes.groupby(['subject', 'gene'], sort=False)
+        rows = rows[~grouped['h0'].transform('any') & (grouped['haplotypes'].transform('sum') >= 2)]
 
-def process_repseq_genotype(sample_name, wanted_genes, session, functional):
-    alleles = session.query(Sample.sample_name, Allele.name, Gene.name, AllelesSample) \
-        .filter(Sample.sample_name == sample_name) \
+    rows = rows.assign(count='1', fc='1', fs='1', kdiff='1000', total='1')
+    return build_genotypes(rows, sample_names)
+
+
+def repseq_genotypes(sample_names, wanted_genes, session, functional):
+    query = session.query(Sample.sample_name, Gene.name, Allele.name, AllelesSample.count, AllelesSample.freq_by_clone,
+                          AllelesSample.freq_by_seq, AllelesSample.kdiff, AllelesSample.total_count) \
         .join(AllelesSample, AllelesSample.sample_id == Sample.id) \
         .join(Allele, AllelesSample.allele_id == Allele.id) \
         .join(Gene, Allele.gene_id == Gene.id)
 
-    if len(wanted_genes) > 0:
-        alleles = alleles.filter(Gene.name.in_(wanted_genes))
-
     if functional:
-        alleles = alleles.filter(Gene.pseudo_gene == False)
-
-    alleles = alleles.all()
-
-    genes = {}
-    for sample_name, allele, gene, allelessample in alleles:
-        if gene not in genes:
-            genes[gene] = {'alleles': [], 'count': [], 'fc': [], 'fs': []}
-
-        if '*' in allele:
-            allele_name = allele.split('*')[1]
-        elif '.' in allele:         # cirelli format
-            if allele[-2:-1] == '.' and allele[-1].isalpha():
-                allele_name = '01_' + allele[-1]
-            elif '_' in allele.replace('LJI.Rh_', ''):
-                allele_name = '01_' + allele.replace('LJI.Rh_', '').split('_')[-1]
-            else:
-                allele_name = '01'
-        else:
-            allele_name = allele    # don't expect this to happen
-
-        if allele_name not in genes[gene]['alleles']:
-            genes[gene]['alleles'].append(allele_name)
-            genes[gene]['count'].append(str(allelessample.count))
-            genes[gene]['fc'].append(str(allelessample.freq_by_clone))
-            genes[gene]['fs'].append(str(allelessample.freq_by_seq))
-            genes[gene]['kdiff'] = str(allelessample.kdiff)
-            genes[gene]['total_count'] = str(allelessample.total_count)
-        else:
-            print(f"Allele {allele_name} seen multiply in genotype")
+        query = query.filter(Gene.pseudo_gene == False)
+
+    rows = query_genotype_rows(query, Sample.sample_name, Gene.name, sample_names, wanted_genes,
+                               ['subject', 'gene', 'allele', 'count', 'fc', 'fs', 'kdiff', 'total'])
+    rows = unique_alleles(rows)
+
+    for col in ['count', 'fc', 'fs', 'kdiff', 'total']:
+        rows[col] = rows[col].map(str)
+
+    return build_genotypes(rows, sample_names)
+
 
-    geno_list = fake_genotype(sample_name, genes)
-    return pd.DataFrame(geno_list)
+def process_genomic_genotype(sample_name, wanted_genes, session, functional, fully_haplotyped):
+    return genomic_genotypes([sample_name], wanted_genes, session, functional, fully_haplotyped)
+
+
+def process_repseq_genotype(sample_name, wanted_genes, session, functional):
+    return repseq_genotypes([sample_name], wanted_genes, session, functional)
+
+
+# Add a row for each wanted gene that is missing from a subject's genotype, with the given alleles. Rows are ordered
+# by subject, as listed in subjects, and within each subject by gene if sort_genes is set, otherwise with the added
+# rows following the subject's own
+
+def add_missing_genes(genotypes, subjects, wanted_genes, alleles='', sort_genes=False):
+    subjects = list(dict.fromkeys(subjects))
+    wanted = pd.MultiIndex.from_product([subjects, sorted(wanted_genes)], names=['subject', 'gene'])
+    missing = wanted[~wanted.isin(pd.MultiIndex.from_frame(genotypes[['subject', 'gene']]))]
+
+    fakes = pd.DataFrame({
+        'subject': missing.get_level_values('subject'),
+        'gene': missing.get_level_values('gene'),
+        'alleles': alleles,
+        'counts': '',
+        'total': '0',
+        'note': '',
+        'kh': '1',
+        'kd': '1',
+        'kt': '1',
+        'kq': '1',
+        'k_diff': '0',
+        'GENOTYPED_ALLELES': alleles,
+        'Freq_by_Clone': '',
+        'Freq_by_Seq': '',
+    }, columns=GENOTYPE_COLUMNS)
+
+    genotypes = pd.concat([genotypes, fakes], ignore_index=True)
+    order = {name: i for i, name in enumerate(subjects)}
+    keys = ['subject', 'gene'] if sort_genes else ['subject']
+    genotypes = genotypes.sort_values(keys, key=lambda col: col.map(order) if col.name == 'subject' else col,
+                                      kind='stable')
+    return genotypes.reset_index(drop=True)
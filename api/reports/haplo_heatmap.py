@@ -2,13 +2,13 @@
 
 from werkzeug.exceptions import BadRequest
 
-from api.reports.report_utils import make_output_file, trans_df, collate_samples, chunk_list, find_primer_translations, translate_primer_alleles, translate_primer_genes
+from api.reports.report_utils import make_output_file, trans_df, collate_samples, chunk_list, find_primer_translations, translate_primer_alleles, translate_primer_genes, write_r_input
 from api.reports.reports import run_rscript, send_report
 from app import vdjbase_dbs
-from db.vdjbase_model import HaplotypesFile, SamplesHaplotype
+from api.reports.haplotypes import rep_haplotypes
 from db.vdjbase_airr_model import Sample
 import os
-from api.vdjbase.vdjbase import VDJBASE_SAMPLE_PATH, apply_rep_filter_params, get_multiple_order_file
+from api.vdjbase.vdjbase import apply_rep_filter_params, get_multiple_order_file
 import pandas as pd
 
 HEATMAP_HAPLOTYPE_SCRIPT = "haplotype_heatmap.R"
@@ -25,50 +25,42 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     html = (format == 'html')
 
     chain, samples_by_dataset = collate_samples(rep_samples)
-    haplotypes = pd.DataFrame()
+    haplotypes = []
 
     for dataset in samples_by_dataset.keys():
         session = vdjbase_dbs[species][dataset].session
         primer_trans, gene_subs = find_primer_translations(session)
 
-        haplos = []
+        sample_names = []
         for sample_chunk in chunk_list(samples_by_dataset[dataset], SAMPLE_CHUNKS):
             sample_list = session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(sample_chunk)).all()
             sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
-            sample_list = [s[0] for s in sample_list]
-            haplo_query = session.query(Sample.sample_name, HaplotypesFile.file)\
-                .filter(Sample.sample_name.in_(sample_list))\
-                .join(SamplesHaplotype, Sample.id == SamplesHaplotype.samples_id)\
-                .filter(SamplesHaplotype.haplotypes_file_id == HaplotypesFile.id)\
-                .filter(HaplotypesFile.by_gene == params['haplo_gene'])
-            haplos.extend(haplo_query.all())
+            sample_names.extend(s[0] for s in sample_list)
 
-        for name, filename in haplos:
-            sample_path = os.path.join(VDJBASE_SAMPLE_PATH, species, dataset, filename.replace('samples/', ''))
+        haplotype = trans_df(rep_haplotypes(species, dataset, sample_names, params['haplo_gene']))
 
-            if not os.path.isfile(sample_path):
-                raise BadRequest('Haplotype file %s is missing.' % (sample_path))
+        if len(haplotype) == 0:
+            continue
 
-            haplotype = pd.read_csv(sample_path, sep='\t', dtype=str)
-            haplotype = trans_df(haplotype)
-            haplotype['subject'] = name if len(samples_by_dataset) == 1 else dataset + '_' + name
+        subjects = haplotype.index if len(samples_by_dataset) == 1 else dataset + '_' + haplotype.index
+        haplotype = haplotype.reset_index(drop=True)
+        haplotype['subject'] = list(subjects)
 
-            # translate pipeline allele names to VDJbase allele names
+        # translate pipeline allele names to VDJbase allele names
 
-            col_names = list(haplotype.columns.values)
-            for i in (2, 3, 4):
-                haplotype[col_names[i]] = [translate_primer_alleles(x, y, primer_trans) for x, y in zip(haplotype['gene'], haplotype[col_names[i]])]
+        col_names = list(haplotype.columns.values)
+        for i in (2, 3, 4):
+            haplotype[col_names[i]] = [translate_primer_alleles(x, y, primer_trans) for x, y in zip(haplotype['gene'], haplotype[col_names[i]])]
 
-            haplotype['gene'] = [translate_primer_genes(x, gene_subs) for x in haplotype['gene']]
-            haplotype = haplotype[haplotype.gene.isin(wanted_genes)]
+        haplotype['gene'] = [translate_primer_genes(x, gene_subs) for x in haplotype['gene']]
+        haplotypes.append(haplotype[haplotype.gene.isin(wanted_genes)])
 
-            haplotypes = pd.concat([haplotypes, haplotype], keys=None, ignore_index=True)[haplotype.columns.tolist()]
+    haplotypes = pd.concat(haplotypes, ignore_index=True, sort=False) if haplotypes else pd.DataFrame()
 
     if len(haplotypes) == 0:
         raise BadRequest('No records matching the filter criteria were found.')
 
-    haplo_path = make_output_file('tsv')
-    haplotypes.to_csv(haplo_path, sep='\t', index=False)
+    haplo_path = write_r_input(haplotypes)
     attachment_filename = '%s_haplotype_heatmap.pdf' % species
 
     if not params['f_kdiff'] or params['f_kdiff'] == '':
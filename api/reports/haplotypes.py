@@ -0,0 +1,74 @@
+# Functions to extract haplotypes from a dataset's haplotype store (see db/haplotype_store.py)
+
+import os
+import re
+import time
+
+from werkzeug.exceptions import BadRequest
+
+from app import app, vdjbase_dbs
+from api.vdjbase.vdjbase import VDJBASE_SAMPLE_PATH
+from db.dataset_publish import PRUNE_AFTER
+from db.haplotype_store import haplotype_files, haplotype_file_path, read_haplotype_files, file_columns, SAMPLE_COL, pyarrow
+
+
+# Where the store of a dataset published without one is built
+
+def store_cache_dir():
+    return os.path.join(app.config['OUTPUT_PATH'], 'haplotype_store')
+
+
+def store_cache_path(species, dataset, version):
+    return os.path.join(store_cache_dir(), '%s_%s_%s.parquet' % (species, dataset, version))
+
+
+# Remove the stores built for other versions of the dataset. Reports may still be reading the store of the previous
+# version for a while after a new one is published, so nothing is removed until the current version has been
+# published for PRUNE_AFTER seconds (see dataset_publish). Called when a worker first opens the store
+
+def prune_store_caches(species, dataset, provider):
+    if time.time() - provider.modified < PRUNE_AFTER or not os.path.isdir(store_cache_dir()):
+        return
+
+    pattern = re.compile(re.escape('%s_%s_' % (species, dataset)) + r'[0-9a-f]{16}\.parquet')
+    current = os.path.basename(store_cache_path(species, dataset, provider.version))
+
+    for fn in os.listdir(store_cache_dir()):
+        if fn != current and pattern.fullmatch(fn):
+            try:
+                os.remove(os.path.join(store_cache_dir(), fn))
+            except FileNotFoundError:
+                pass
+
+
+# The rows of the named samples' haplotype files for the anchor gene (HaplotypesFile.by_gene), as a single frame
+# indexed by sample name, in the order of sample_names. Samples without a file for the anchor gene are left out.
+# Without pyarrow, the files are read directly
+
+def rep_haplotypes(species, dataset, sample_names, anchor):
+    provider = vdjbase_dbs[species][dataset]
+    sample_path = os.path.join(VDJBASE_SAMPLE_PATH, species, dataset)
+    wanted = set(sample_names)
+    files = [f for f in haplotype_files(provider.session, anchor) if f[0] in wanted and f[2]]
+
+    if pyarrow is not None:
+        if provider.haplotype_store is None:
+            prune_store_caches(species, dataset, provider)
+        store = provider.haplotypes(sample_path, store_cache_path(species, dataset, provider.version))
+        columns = store.columns
+    else:
+        rows, columns = read_haplotype_files(files, sample_path)
+
+    for sample_name, _, filename in files:
+        if anchor not in columns.get(sample_name, {}):
+            raise BadRequest('Haplotype file %s is missing.' % haplotype_file_path(sample_path, filename))
+
+    found = [f[0] for f in files]
+
+    if pyarrow is not None:
+        haplotypes = store.read(found, anchor)
+    else:
+        haplotypes = rows[[SAMPLE_COL] + file_columns(columns, found, anchor)].set_index(SAMPLE_COL)
+
+    order = {name: i for i, name in enumerate(sample_names)}
+    return haplotypes.iloc[haplotypes.index.map(order).argsort(kind='stable')]
@@ -2,10 +2,9 @@
 
 from werkzeug.exceptions import BadRequest
 from api.reports.reports import run_rscript, send_report
-from api.reports.report_utils import make_output_file, collate_samples, chunk_list
+from api.reports.report_utils import make_output_file, collate_samples, chunk_list, write_r_input, rep_allele_frame, drop_contained_patterns
 from app import vdjbase_dbs
-from db.vdjbase_model import AllelesSample, Gene, Allele, AllelesPattern
-from db.vdjbase_airr_model import Patient, Sample
+from db.vdjbase_airr_model import Sample
 import os
 from api.vdjbase.vdjbase import apply_rep_filter_params
 import pandas as pd
@@ -24,92 +23,29 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     kdiff = float(params['f_kdiff']) if 'f_kdiff' in params and params['f_kdiff'] != '' else 0
     chain, samples_by_dataset = collate_samples(rep_samples)
 
-    # Format we need to produce is [(gene_name, hetero count, homo count),...]
+    # Format we need to produce is [(gene_name, homo count, hetero count),...], counting each patient once
 
-    gene_hetrozygous_dis = {}
+    patient_counts = []
 
     for dataset in samples_by_dataset.keys():
         session = vdjbase_dbs[species][dataset].session
-        allele_sample_recs = []
+        sample_list = []
 
         for sample_chunk in chunk_list(samples_by_dataset[dataset], SAMPLE_CHUNKS):
-            sample_list = session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(sample_chunk)).all()
-            sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
-            sample_list = [s[0] for s in sample_list]
-
-            query = session.query(Gene.name, Patient.id, Allele.id, Sample.sample_name, Gene.locus_order, AllelesSample.kdiff, Allele.name) \
-                .join(Allele, Gene.id == Allele.gene_id) \
-                .join(AllelesSample, Allele.id == AllelesSample.allele_id) \
-                .join(Sample, Sample.id == AllelesSample.sample_id) \
-                .join(Patient, Patient.id == Sample.patient_id) \
-                .filter(Gene.name.in_(wanted_genes)) \
-                .filter(Allele.name.notlike('%Del%')) \
-                .filter(Allele.name.notlike('%OR%')) \
-                .filter(Sample.sample_name.in_(sample_list)) \
-                .filter(AllelesSample.kdiff >= kdiff)
-
-            if 'sort_order' in params and params['sort_order'] == 'Locus':
-                query = query.order_by(Gene.locus_order, Patient.id, Allele.id)
-            else:
-                query = query.order_by(Gene.alpha_order, Patient.id, Allele.id)
-
-            if params['ambiguous_alleles'] == 'Exclude':
-                query = query.filter(Allele.is_single_allele == True)
-
-            allele_sample_recs.extend(query.all())
-
-        # As the result is indexed, run over each gene in turn, count the number of alleles found in each patient, update h_counts accordingly
-
-        i = 0
-        target_gene = ''
-
-        while i < len(allele_sample_recs):
-            target_gene = allele_sample_recs[i][0]
-            h_counts = [0, 0]
-
-            while i < len(allele_sample_recs):
-                if allele_sample_recs[i][0] != target_gene:
-                    break
-
-                target_patient = allele_sample_recs[i][1]
-                patient_allele_ids = []
-
-                while i < len(allele_sample_recs):
-                    if allele_sample_recs[i][0] != target_gene or allele_sample_recs[i][1] != target_patient:
-                        break
-
-                    patient_allele_ids.append(allele_sample_recs[i][2])
-                    i += 1
-
-                patient_allele_ids = set(patient_allele_ids)
-
-                # If we have both an unambiguous allele and an ambiguous allele containing that unambiguous one,
-                # drop the unambiguous one because it is already counted
-
-                if params['ambiguous_alleles'] != 'Exclude':
-                    patterns = session.query(AllelesPattern.pattern_id)\
-                        .filter(AllelesPattern.allele_in_p_id.in_(patient_allele_ids))\
-                        .filter(AllelesPattern.pattern_id.in_(patient_allele_ids))\
-                        .all()
-
-                    if patterns is not None and len(patterns) >0:
-                        patterns = set([pattern[0] for pattern in patterns])
-                        patient_allele_ids = patient_allele_ids - patterns
-
-                if len(patient_allele_ids) > 1:
-                    h_counts[1] += 1
-                elif len(patient_allele_ids) > 0:
-                    h_counts[0] += 1
-
-            if target_gene not in gene_hetrozygous_dis:
-                gene_hetrozygous_dis[target_gene] = (target_gene, h_counts[0], h_counts[1])
-            else:
-                gene_hetrozygous_dis[target_gene] = (target_gene, gene_hetrozygous_dis[target_gene][1] + h_counts[0], gene_hetrozygous_dis[target_gene][2] + h_counts[1])
-
-    haplo_path = make_output_file('tab')
-    labels = ['GENE', 'HM', 'HT']
-    df = pd.DataFrame(gene_hetrozygous_dis.values(), columns=labels)
-    df.to_csv(haplo_path, sep='\t', index=False)
+            sample_list.extend(session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(sample_chunk)).all())
+
+        sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
+        alleles = rep_allele_frame(session, [s[0] for s in sample_list], wanted_genes, kdiff, params)
+        alleles = drop_contained_patterns(alleles, ['gene', 'patient'])
+
+        patient_counts.append(alleles.groupby(['gene', 'patient'], sort=False)['allele_id'].nunique().reset_index())
+
+    patient_counts = pd.concat(patient_counts, ignore_index=True)
+    patient_counts['HM'] = (patient_counts['allele_id'] == 1).astype(int)
+    patient_counts['HT'] = (patient_counts['allele_id'] > 1).astype(int)
+
+    df = patient_counts.groupby('gene', sort=False)[['HM', 'HT']].sum().reset_index().rename(columns={'gene': 'GENE'})
+    haplo_path = write_r_input(df)
     output_path = make_output_file('html')
 
     cmd_line = ["-i", haplo_path,
@@ -0,0 +1,231 @@
+# Pool of persistent R processes for running report scripts
+#
+# Starting Rscript for each plot means loading the report packages every time. Instead, each process that runs
+# reports keeps a small pool of R workers (R_scripts/r_worker.R), which load the packages once and then run each
+# script in a fork of themselves, so that scripts run unchanged and don't affect each other.
+#
+# A worker that fails to answer within the timeout is killed, along with the script it is running, and the call
+# fails. A worker that exits unexpectedly is replaced, and the script is run again once. Workers are replaced after
+# max_jobs scripts, to bound any growth in their memory use. If the caller's report is cancelled while a script is
+# running, the worker is killed in the same way, and replaced when next needed.
+
+import os
+import queue
+import select
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+WORKER_SCRIPT = 'r_worker.R'
+STARTUP_TIMEOUT = 120
+
+# Seconds between checks for cancellation while a script runs
+CANCEL_POLL_INTERVAL = 1
+
+# Packages used by the report scripts
+DEFAULT_PRELOAD = ['optparse', 'ggplot2', 'dplyr', 'plyr', 'purrr', 'reshape2', 'stringr', 'plotly', 'readxl',
+                   'mltools', 'tigger', 'rabhit', 'vdjbasevis']
+
+
+class RWorkerTimeout(Exception):
+    pass
+
+
+class RWorkerCrashed(Exception):
+    pass
+
+
+class RWorkerCancelled(Exception):
+    pass
+
+
+class RWorker:
+    def __init__(self, script_path, preload):
+        self.jobs = 0
+        self.buffer = b''
+        self.capabilities = set()
+        self.proc = subprocess.Popen(['Rscript', os.path.join(script_path, WORKER_SCRIPT)] + preload,
+                                     cwd=script_path, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, start_new_session=True)
+        ready = self.read_until(lambda line: line.split(b'\t')[0] == b'READY', STARTUP_TIMEOUT)
+        self.capabilities = set(ready.decode('utf-8').split('\t')[1:])
+
+    # Read lines from the worker until one satisfies match, and return it. Other lines are output written directly
+    # by R rather than through the sink, and are passed on. If cancelled is given, it is called periodically, and
+    # the worker is killed if it returns True
+
+    def read_until(self, match, timeout, cancelled=None):
+        deadline = time.monotonic() + timeout
+        fd = self.proc.stdout.fileno()
+
+        while True:
+            while b'\n' in self.buffer:
+                line, self.buffer = self.buffer.split(b'\n', 1)
+                if match(line):
+                    return line
+                print(line.decode('utf-8', errors='replace'))
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.kill()
+                raise RWorkerTimeout()
+
+            if cancelled is not None:
+                if cancelled():
+                    self.kill()
+                    raise RWorkerCancelled()
+                remaining = min(remaining, CANCEL_POLL_INTERVAL)
+
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if ready:
+                data = os.read(fd, 65536)
+                if not data:
+                    self.kill()
+                    raise RWorkerCrashed()
+                self.buffer += data
+
+    # Run a script and return (exit status, stdout, stderr)
+
+    def run(self, script, args, cwd, timeout, cancelled=None):
+        self.jobs += 1
+        job_id = str(self.jobs)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            out_file = os.path.join(tmp, 'stdout')
+            err_file = os.path.join(tmp, 'stderr')
+
+            try:
+                self.proc.stdin.write(('\t'.join([job_id, script, cwd, out_file, err_file] + args) + '\n').encode('utf-8'))
+                self.proc.stdin.flush()
+            except (BrokenPipeError, OSError):
+                self.kill()
+                raise RWorkerCrashed()
+
+            line = self.read_until(lambda line: line.startswith(b'DONE\t' + job_id.encode() + b'\t'), timeout, cancelled)
+            status = int(line.split(b'\t')[2])
+
+            stdout, stderr = b'', b''
+            if os.path.isfile(out_file):
+                with open(out_file, 'rb') as fi:
+                    stdout = fi.read()
+            if os.path.isfile(err_file):
+                with open(err_file, 'rb') as fi:
+                    stderr = fi.read()
+
+        return status, stdout, stderr
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=10)
+        except Exception:
+            self.kill()
+
+    def kill(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+
+
+class RWorkerPool:
+    def __init__(self, script_path, size, max_jobs, timeout, preload):
+        self.script_path = script_path
+        self.size = size
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.preload = preload
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+        self.slots = threading.Semaphore(size)
+        self.capabilities = None
+
+    def checkout(self):
+        self.slots.acquire()
+        try:
+            worker = self.idle.get_nowait()
+            if worker.alive():
+                return worker
+            worker.kill()
+        except queue.Empty:
+            pass
+
+        try:
+            return RWorker(self.script_path, self.preload)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def checkin(self, worker):
+        if worker is not None:
+            if worker.alive() and worker.jobs < self.max_jobs:
+                self.idle.put(worker)
+            elif worker.alive():
+                worker.close()
+        self.slots.release()
+
+    # True if the workers support the named feature (see r_worker.R). A worker is started to find out, if necessary
+
+    def supports(self, feature):
+        if self.capabilities is None:
+            worker = self.checkout()
+            self.capabilities = worker.capabilities
+            self.checkin(worker)
+
+        return feature in self.capabilities
+
+    def run(self, script, args, cwd, cancelled=None):
+        for attempt in range(2):
+            worker = self.checkout()
+            try:
+                return worker.run(script, args, cwd, self.timeout, cancelled)
+            except RWorkerCrashed:
+                print('R worker exited while running %s' % script)
+                if attempt:
+                    raise
+            finally:
+                self.checkin(worker)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+pool = None
+pool_settings = None
+
+
+def init_r_worker_pool(script_path, size, max_jobs, timeout, preload=None):
+    global pool_settings
+    pool_settings = (script_path, size, max_jobs, timeout, preload if preload is not None else DEFAULT_PRELOAD)
+
+
+# The pool for this process, or None if the pool is disabled. The pool is created on first use, so that each
+# Celery worker process, which is forked from the parent, has its own
+
+def r_worker_pool():
+    global pool
+
+    if pool_settings is None or not pool_settings[1]:
+        return None
+
+    if pool is None or pool.pid != os.getpid():
+        pool = RWorkerPool(*pool_settings)
+
+    return pool
+
+
+# Arguments are sent to the worker as tab-separated fields, so those containing tabs or newlines must be passed to
+# Rscript directly
+
+def can_use_pool(args):
+    return all('\t' not in a and '\n' not in a for a in args)
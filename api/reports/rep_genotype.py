@@ -6,14 +6,15 @@ from werkzeug.exceptions import BadRequest
 
 from app import vdjbase_dbs, genomic_dbs
 from api.reports.reports import run_rscript, send_report
-from api.reports.report_utils import make_output_file, collate_samples, collate_gen_samples
+from api.reports.report_utils import make_output_file, collate_samples, collate_gen_samples, chunk_list, write_r_input
 from db.vdjbase_airr_model import Sample
 from db.genomic_airr_model import Sample as GenomicSample
 from api.vdjbase.vdjbase import apply_rep_filter_params, get_multiple_order_file
-from api.reports.genotypes import process_repseq_genotype, process_genomic_genotype, fake_gene
+from api.reports.genotypes import repseq_genotypes, genomic_genotypes, add_missing_genes
 
 
 MULTIPLE_GENOTYPE_SCRIPT = "html_multiple_genotype_hoverText.R"
+SAMPLE_CHUNKS = 400
 
 
 def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params):
@@ -28,20 +29,20 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     if not chain:
         chain = g_chain
 
-    genotypes = {}
+    rep_batches = []
+    gen_batches = []
     all_wanted_genes = set()
 
     for dataset in rep_samples_by_dataset.keys():
         session = vdjbase_dbs[species][dataset].session
-        sample_list = session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(rep_samples_by_dataset[dataset])).all()
+        sample_list = []
+        for sample_chunk in chunk_list(rep_samples_by_dataset[dataset], SAMPLE_CHUNKS):
+            sample_list.extend(session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(sample_chunk)).all())
         sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
 
         if len(wanted_genes) > 0:
             all_wanted_genes |= set(wanted_genes)
-            for (name, genotype, patient_id) in sample_list:
-                session = vdjbase_dbs[species][dataset].session
-                genotype = process_repseq_genotype(name, all_wanted_genes, session, False)
-                genotypes[name] = genotype
+            rep_batches.append((dataset, [name for (name, genotype, patient_id) in sample_list], set(all_wanted_genes)))
 
     for dataset in gen_samples_by_dataset.keys():
         session = genomic_dbs[species][dataset].session
@@ -59,32 +60,31 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
         sample_list = [(sample.sample_name) for sample in samples if sample.sample_name in filtered_samples]
 
         if len(wanted_genes) > 0:
-            for (sample_name) in sample_list:
-                genotype = process_genomic_genotype(sample_name, wanted_genes, session, not params['f_pseudo_genes'], fully_haplotyped)
-                genotypes[sample_name] = genotype
+            gen_batches.append((dataset, sample_list, wanted_genes))
 
-    if len(genotypes) == 0:
+    subjects = [name for batch in rep_batches + gen_batches for name in batch[1]]
+
+    if len(subjects) == 0:
         raise BadRequest('No records matching the filter criteria were found.')
 
-    if len(genotypes) > 20:
+    if len(set(subjects)) > 20:
         raise BadRequest('Please select at most 20 genotypes, or use the Genotype Heatmap report.')
 
+    genotypes = []
 
-    # add fakes to each genotype for missing genes
-
-    for subject_name, genotype in genotypes.items():
-        contained_genes = genotype['gene'].tolist() if len(genotype) > 0 else []
+    for dataset, sample_list, wanted_genes in rep_batches:
+        session = vdjbase_dbs[species][dataset].session
+        genotypes.append(repseq_genotypes(sample_list, wanted_genes, session, False))
 
-        fakes = []
-        for gene in all_wanted_genes:
-            if gene not in contained_genes:
-                fakes.append(fake_gene({'alleles': [], 'count': [], 'fc': [], 'fs': [], 'total_count': 0, 'kdiff': 0}, gene, subject_name))
+    for dataset, sample_list, wanted_genes in gen_batches:
+        session = genomic_dbs[species][dataset].session
+        genotypes.append(genomic_genotypes(sample_list, wanted_genes, session, not params['f_pseudo_genes'], fully_haplotyped))
 
-        genotypes[subject_name] = pd.concat([genotype, pd.DataFrame(fakes)], ignore_index=True)
+    # add fakes to each genotype for missing genes
 
-    geno_path = make_output_file('tsv')
-    genotypes = pd.concat(genotypes)
-    genotypes.to_csv(geno_path, sep='\t')
+    genotypes = add_missing_genes(pd.concat(genotypes, ignore_index=True), subjects, all_wanted_genes)
+    genotypes.index = pd.MultiIndex.from_arrays([genotypes['subject'].values, genotypes.groupby('subject', sort=False).cumcount().values])
+    geno_path = write_r_input(genotypes, index=True)
 
     if format == 'pdf':
         attachment_filename = '%s_sampled_genotype.pdf' % (species)
@@ -3,10 +3,11 @@
 from werkzeug.exceptions import BadRequest
 
 
-from api.reports.rep_genotype import fake_gene, process_genomic_genotype, process_repseq_genotype
-from api.reports.report_utils import collate_samples, chunk_list, collate_gen_samples
+from api.reports.genotypes import repseq_genotypes, genomic_genotypes, add_missing_genes
+from api.reports.report_utils import collate_samples, chunk_list, collate_gen_samples, write_r_input
 from api.reports.reports import run_rscript, send_report
 from api.reports.report_utils import make_output_file
+from api.reports.report_progress import report_progress
 from app import vdjbase_dbs, genomic_dbs
 from db.genomic_airr_model import Sample as GenomicSample
 
@@ -25,14 +26,18 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     html = (format == 'html')
     chain, rep_samples_by_dataset = collate_samples(rep_samples)
     g_chain, gen_samples_by_dataset = collate_gen_samples(genomic_samples)
-    genotypes = {}
+    genotypes = []
+    subjects = []
     all_wanted_genes = set()
     fully_haplotyped = 'Only' in params['geno_hap']
 
     if not chain:
         chain = g_chain
 
-    for dataset in rep_samples_by_dataset.keys():
+    datasets = len(rep_samples_by_dataset) + len(gen_samples_by_dataset)
+
+    for i, dataset in enumerate(rep_samples_by_dataset.keys()):
+        report_progress('extracting genotypes', 0.6 * i / datasets)
         session = vdjbase_dbs[species][dataset].session
 
         sample_list = []
@@ -43,12 +48,12 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
         if len(wanted_genes) > 0:
             all_wanted_genes |= set(wanted_genes)
-            for (name, genotype, patient_id) in sample_list:
-                session = vdjbase_dbs[species][dataset].session
-                genotype = process_repseq_genotype(name, all_wanted_genes, session, False)
-                genotypes[name] = genotype
+            names = [name for (name, genotype, patient_id) in sample_list]
+            genotypes.append(repseq_genotypes(names, all_wanted_genes, session, False))
+            subjects.extend(names)
 
-    for dataset in gen_samples_by_dataset.keys():
+    for i, dataset in enumerate(gen_samples_by_dataset.keys()):
+        report_progress('extracting genotypes', 0.6 * (len(rep_samples_by_dataset) + i) / datasets)
         session = genomic_dbs[species][dataset].session
         samples = session.query(GenomicSample).filter(GenomicSample.sample_name.in_(gen_samples_by_dataset[dataset])).all()
 
@@ -64,32 +69,19 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
         sample_list = [(sample.sample_name) for sample in samples if sample.sample_name in filtered_samples]
 
         if len(wanted_genes) > 0:
-            for (sample_name) in sample_list:
-                genotype = process_genomic_genotype(sample_name, all_wanted_genes, session, not params['f_pseudo_genes'], fully_haplotyped)
-                genotypes[sample_name] = genotype
+            genotypes.append(genomic_genotypes(sample_list, all_wanted_genes, session, not params['f_pseudo_genes'], fully_haplotyped))
+            subjects.extend(sample_list)
 
-    if len(genotypes) == 0:
+    if len(subjects) == 0:
         raise BadRequest('No records matching the filter criteria were found.')
 
-    # add fakes to each genotype for missing genes
-
-    for subject_name, genotype in genotypes.items():
-        contained_genes = genotype['gene'].tolist() if len(genotype) > 0 else []
-
-        fakes = []
-        for gene in all_wanted_genes:
-            if gene not in contained_genes:
-                fakes.append(fake_gene({'alleles': ['Unk'], 'count': [], 'fc': [], 'fs': [], 'total_count': 0, 'kdiff': 0}, gene, subject_name))
-
-        genotypes[subject_name] = pd.concat([genotype, pd.DataFrame(fakes)], ignore_index=True)
+    report_progress('preparing heatmap', 0.6)
 
-    # sort rows in each genotype by gene
-    for genotype in genotypes.values():
-        genotype.sort_values(by=['gene'], inplace=True)
+    # add fakes to each genotype for missing genes, and sort rows in each genotype by gene
 
-    geno_path = make_output_file('tsv')
-    genotypes = pd.concat(genotypes.values())
-    genotypes.to_csv(geno_path, sep='\t')
+    genotypes = add_missing_genes(pd.concat(genotypes, ignore_index=True), subjects, all_wanted_genes, alleles='Unk', sort_genes=True)
+    genotypes.index = genotypes.groupby('subject', sort=False).cumcount()
+    geno_path = write_r_input(genotypes, index=True)
 
     if format == 'pdf':
         attachment_filename = '%s_genotype.pdf' % species
@@ -3,13 +3,13 @@
 from werkzeug.exceptions import BadRequest
 
 from api.reports.reports import SYSDATA, run_rscript, send_report
-from api.reports.report_utils import make_output_file, check_tab_file, find_primer_translations, translate_primer_alleles, translate_primer_genes
-import pandas as pd
+from api.reports.report_utils import make_output_file, trans_df, find_primer_translations, translate_primer_alleles, translate_primer_genes, write_r_input
+from api.reports.haplotypes import rep_haplotypes
 from app import vdjbase_dbs
 from db.vdjbase_model import HaplotypesFile, SamplesHaplotype
 from db.vdjbase_airr_model import Sample
 import os
-from api.vdjbase.vdjbase import VDJBASE_SAMPLE_PATH, get_order_file
+from api.vdjbase.vdjbase import get_order_file
 
 PERSONAL_HAPLOTYPE_SCRIPT = 'Haplotype_plot.R'
 
@@ -27,30 +27,26 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     session = vdjbase_dbs[species][rep_sample['dataset']].session
     primer_trans, gene_subs = find_primer_translations(session)
 
-    p = session.query(HaplotypesFile.file)\
+    anchor = session.query(HaplotypesFile.by_gene)\
         .join(SamplesHaplotype)\
         .join(Sample)\
         .filter(Sample.sample_name == rep_sample['sample_name'])\
         .filter(HaplotypesFile.by_gene_s == params['haplo_gene']).one_or_none()
 
-    p = p[0].replace('samples/','')
-    sample_path = os.path.join(VDJBASE_SAMPLE_PATH, species, rep_sample['dataset'], p)
+    if anchor is None:
+        raise BadRequest('Haplotype file for sample %s/%s is missing' % (rep_sample['dataset'], rep_sample['sample_name']))
 
-    if not os.path.isfile(sample_path):
-        raise BadRequest('Genotype file for sample %s/%s is missing' % (rep_sample['dataset'], rep_sample['sample_name']))
-
-    sample_path = check_tab_file(sample_path)
+    haplotype = trans_df(rep_haplotypes(species, rep_sample['dataset'], [rep_sample['sample_name']], anchor[0]))
+    haplotype = haplotype.reset_index(drop=True)
 
     # translate pipeline allele names to VDJbase allele names
-    haplotype = pd.read_csv(sample_path, sep='\t', dtype=str)
 
     col_names = list(haplotype.columns.values)
     for i in (2, 3, 4):
         haplotype[col_names[i]] = [translate_primer_alleles(x, y, primer_trans) for x, y in zip(haplotype['gene'], haplotype[col_names[i]])]
 
     haplotype['gene'] = [translate_primer_genes(x, gene_subs) for x in haplotype['gene']]
-    sample_path = make_output_file('tsv')
-    haplotype.to_csv(sample_path, sep='\t', index=False)
+    sample_path = write_r_input(haplotype)
 
     locus_order = ('sort_order' in params and params['sort_order'] == 'Locus')
     gene_order_file = get_order_file(species, rep_sample['dataset'], locus_order=locus_order)
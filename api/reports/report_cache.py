@@ -0,0 +1,192 @@
+# Cache of report results
+#
+# A report's output depends only on the report, its format and parameters, the samples selected and the content of
+# the datasets they come from. The key of a cached result is a hash of these, with the datasets represented by
+# their content versions, so that a result is never reused after a dataset is republished. The key also includes a
+# hash of the report code and R scripts, so that results are not reused after a deploy that changes them.
+#
+# Results are cached when a report completes successfully. The output file stays where the report wrote it, in
+# OUTPUT_PATH, and the result is recorded in OUTPUT_PATH/report_cache/<key>.json. The modification time of the
+# record is the time at which the result was last used. Records older than REPORT_CACHE_MAX_AGE, and the least
+# recently used records while the cached output exceeds REPORT_CACHE_MAX_SIZE, are removed along with their output.
+#
+# A cached result is returned under a job id of its own, which ReportsStatus answers without consulting Celery.
+
+import hashlib
+import json
+import os
+import re
+import time
+
+from werkzeug.exceptions import BadRequest
+
+from app import app, vdjbase_dbs, genomic_dbs
+from api.system.system import source_hash
+
+CACHED_JOB_PREFIX = 'cached-'
+
+_code_version = None
+
+
+def cache_dir():
+    return os.path.join(app.config['OUTPUT_PATH'], 'report_cache')
+
+
+def dataset_versions(dbs, species, datasets):
+    versions = []
+    for dataset in sorted(datasets or []):
+        if species in dbs and dataset in dbs[species].entries:
+            versions.append((dataset, dbs[species].entries[dataset].version))
+        else:
+            versions.append((dataset, None))
+    return versions
+
+
+def sample_ids(samples):
+    return sorted([s.get('dataset', ''), s['sample_name']] for s in samples)
+
+
+# A hash of the source files of the reports package, including the R scripts, computed once per process
+
+def code_version():
+    global _code_version
+
+    if _code_version is None:
+        _code_version = source_hash([os.path.dirname(os.path.abspath(__file__))])
+
+    return _code_version
+
+
+def report_cache_key(report_name, format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples,
+                     params):
+    content = {
+        'report': report_name,
+        'code': code_version(),
+        'format': format,
+        'species': species,
+        'params': params,
+        'genomic_datasets': dataset_versions(genomic_dbs, species, genomic_datasets),
+        'genomic_samples': sample_ids(genomic_samples),
+        'rep_datasets': dataset_versions(vdjbase_dbs, species, rep_datasets),
+        'rep_samples': sample_ids(rep_samples),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def record_path(key):
+    return os.path.join(cache_dir(), key + '.json')
+
+
+def output_files(result):
+    if isinstance(result, dict) and result.get('url'):
+        return [os.path.join(app.config['OUTPUT_PATH'], os.path.basename(result['url']))]
+    return []
+
+
+def read_record(path):
+    try:
+        with open(path, 'r') as fi:
+            return json.load(fi)
+    except (OSError, ValueError):
+        return None
+
+
+# Remove a record and its output. Another process may be removing it at the same time
+
+def remove_record(path, record):
+    for fn in (record['files'] if record is not None else []) + [path]:
+        try:
+            os.remove(fn)
+        except FileNotFoundError:
+            pass
+
+
+# Return the cached result for the key, or None. The record is marked as used
+
+def cached_report(key):
+    if not app.config['REPORT_CACHE']:
+        return None
+
+    path = record_path(key)
+    record = read_record(path)
+
+    if record is None:
+        return None
+
+    if time.time() - record['created'] > app.config['REPORT_CACHE_MAX_AGE'] \
+            or not all(os.path.isfile(fn) for fn in record['files']):
+        remove_record(path, record)
+        return None
+
+    os.utime(path)
+    return record['result']
+
+
+# Cache the result of a report that has completed successfully, then evict as necessary
+
+def store_report(key, report_name, result):
+    if not app.config['REPORT_CACHE'] or not isinstance(result, dict) or result.get('status') != 'ok':
+        return
+
+    files = output_files(result)
+    if not files or not all(os.path.isfile(fn) for fn in files):
+        return
+
+    os.makedirs(cache_dir(), exist_ok=True)
+    record = {
+        'report': report_name,
+        'created': time.time(),
+        'result': result,
+        'files': files,
+        'size': sum(os.path.getsize(fn) for fn in files),
+    }
+
+    path = record_path(key)
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'w') as fo:
+        json.dump(record, fo)
+    os.replace(temp, path)
+
+    evict_reports()
+
+
+def evict_reports():
+    now = time.time()
+    records = []
+
+    for fn in os.listdir(cache_dir()):
+        if fn.endswith('.json'):
+            path = os.path.join(cache_dir(), fn)
+            record = read_record(path)
+            if record is None or now - record['created'] > app.config['REPORT_CACHE_MAX_AGE']:
+                remove_record(path, record)
+            else:
+                try:
+                    records.append((os.path.getmtime(path), path, record))
+                except FileNotFoundError:
+                    pass
+
+    records.sort(key=lambda r: r[0])
+    total = sum(record['size'] for _, _, record in records)
+
+    while records and total > app.config['REPORT_CACHE_MAX_SIZE']:
+        _, path, record = records.pop(0)
+        remove_record(path, record)
+        total -= record['size']
+
+
+def cached_job_id(key):
+    return CACHED_JOB_PREFIX + key
+
+
+# The cache key of a cached job id, or None if the id is not that of a cached result
+
+def cached_job_key(job_id):
+    if not job_id.startswith(CACHED_JOB_PREFIX):
+        return None
+
+    key = job_id[len(CACHED_JOB_PREFIX):]
+    if not re.fullmatch(r'[0-9a-f]{64}', key):
+        raise BadRequest('Invalid report id')
+
+    return key
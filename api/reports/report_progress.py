@@ -0,0 +1,90 @@
+# Progress and cancellation of running reports
+#
+# A report publishes its progress with report_progress(), which sets the task's state meta to the current stage and,
+# where it is known, the fraction of the report completed. ReportsStatus returns this meta as the job's info.
+#
+# A report is cancelled with cancel_report(). The task is revoked, so that it is discarded if it has not yet
+# started, and a flag file is written to OUTPUT_PATH/report_cancel/<job id>, which the worker running the report can
+# see. Reports check for the flag each time they publish progress, and between the chunks of samples they process,
+# and stop by raising ReportCancelled. An R script running for the report is stopped (see run_rscript).
+
+import os
+import re
+import time
+
+from celery import current_task
+from werkzeug.exceptions import BadRequest
+
+from app import app
+from extensions import celery
+
+# Flags older than this are removed when a report is cancelled
+CANCEL_FLAG_MAX_AGE = 24 * 3600
+
+
+class ReportCancelled(BadRequest):
+    description = 'The report was cancelled.'
+
+
+def cancel_dir():
+    return os.path.join(app.config['OUTPUT_PATH'], 'report_cancel')
+
+
+def cancel_flag_path(job_id):
+    if not re.fullmatch(r'[A-Za-z0-9_-]+', job_id):
+        raise BadRequest('Invalid report id')
+    return os.path.join(cancel_dir(), job_id)
+
+
+def cancel_report(job_id):
+    flag = cancel_flag_path(job_id)
+    os.makedirs(cancel_dir(), exist_ok=True)
+
+    with open(flag, 'w'):
+        pass
+
+    celery.control.revoke(job_id)
+    prune_cancel_flags()
+
+
+def prune_cancel_flags():
+    cutoff = time.time() - CANCEL_FLAG_MAX_AGE
+
+    for name in os.listdir(cancel_dir()):
+        try:
+            if os.path.getmtime(os.path.join(cancel_dir(), name)) < cutoff:
+                os.remove(os.path.join(cancel_dir(), name))
+        except OSError:
+            pass
+
+
+# The id of the report job being run by the current task, or None outside a task
+
+def current_job_id():
+    return current_task.request.id if current_task else None
+
+
+def cancel_requested():
+    job_id = current_job_id()
+    return job_id is not None and os.path.isfile(os.path.join(cancel_dir(), job_id))
+
+
+def check_cancelled():
+    if cancel_requested():
+        raise ReportCancelled()
+
+
+# Publish the stage the report has reached, and the fraction of the report completed if known. Raises
+# ReportCancelled if the report has been cancelled
+
+def report_progress(stage, fraction=None):
+    check_cancelled()
+
+    if current_job_id() is None:
+        return
+
+    meta = {'stage': stage}
+    if fraction is not None:
+        meta['progress'] = round(min(max(fraction, 0.0), 1.0), 3)
+
+    current_task.update_state(state='PENDING', meta=meta)
@@ -3,13 +3,22 @@
 #
 
 import os.path
+import re
 import pandas as pd
 from werkzeug.exceptions import BadRequest
 import csv
 import tempfile
-from db.vdjbase_model import Allele
+from db.vdjbase_model import Allele, AllelesSample, AllelesPattern, Gene
+from db.vdjbase_airr_model import Sample
+from api.reports.r_worker_pool import r_worker_pool
+from api.reports.report_progress import check_cancelled
 import itertools
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 from app import app
 
 
@@ -102,6 +111,77 @@ def make_output_file(format):
     return output_path
 
 
+# Data frames for the R scripts
+#
+# The scripts read their input with read.delim. Where the R workers can read Feather (see R_scripts/r_interchange.R),
+# frames are passed in that format, so that typed columns are passed without formatting and parsing them as text.
+# Otherwise, or if the frame can't be converted, they are written as TSV, as to_csv(sep='\t') would write them.
+
+def r_feather_enabled():
+    if pyarrow is None or app.config['R_INTERCHANGE'] != 'feather':
+        return False
+    workers = r_worker_pool()
+    return workers is not None and workers.supports('arrow')
+
+
+# Column names as R's make.names(unique=TRUE) would make them, so that the names of the Feather columns are those
+# that read.delim would give the TSV columns. Names that pandas would write as empty, such as those of unnamed index
+# levels, are empty here too
+
+def r_column_names(names):
+    ret = []
+    for name in names:
+        name = re.sub(r'[^A-Za-z0-9._]', '.', '' if name is None else str(name))
+        if not re.match(r'[A-Za-z]|\.(?![0-9])', name):
+            name = 'X' + name
+        ret.append(name)
+
+    seen = set(ret)
+    counts = {}
+    for i, name in enumerate(ret):
+        if name in ret[:i]:
+            n = counts.get(name, 0)
+            while True:
+                n += 1
+                if '%s.%d' % (name, n) not in seen:
+                    break
+            counts[name] = n
+            ret[i] = '%s.%d' % (name, n)
+            seen.add(ret[i])
+
+    return ret
+
+
+def write_r_input(df, index=False):
+    if r_feather_enabled():
+        path = make_output_file('feather')
+        try:
+            frame = df.reset_index() if index else df.reset_index(drop=True)
+            frame.columns = r_column_names((list(df.index.names) if index else []) + list(df.columns))
+            frame.to_feather(path)
+            return path
+        except (pyarrow.ArrowException, ValueError, TypeError) as e:
+            print('Passing frame to R as TSV: %s' % e)
+            os.remove(path)
+
+    path = make_output_file('tsv')
+    df.to_csv(path, sep='\t', index=index)
+    return path
+
+
+# For scripts run by Rscript rather than the R workers: replace Feather input files with TSV
+
+def r_tsv_args(args):
+    ret = []
+    for arg in args:
+        if arg.endswith('.feather') and os.path.isfile(arg):
+            path = make_output_file('tsv')
+            pd.read_feather(arg).to_csv(path, sep='\t', index=False)
+            arg = path
+        ret.append(arg)
+    return ret
+
+
 # Collate samples from different datasets and determine chain
 
 def collate_samples(rep_samples):
@@ -144,6 +224,59 @@ def chunk_list(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
+
+# Alleles recorded in the given samples of an AIRR-seq dataset, as a long-format frame with columns sample, patient,
+# gene, gene_type, allele_id, allele and member. An ambiguous allele has a row for each allele that it may be, given
+# in member, which is otherwise null. Deletions, ORs and alleles below the kdiff threshold are not included. Rows are
+# ordered by gene, in the sort order requested in params
+
+ALLELE_FRAME_CHUNKS = 400
+
+def rep_allele_frame(session, sample_names, wanted_genes, kdiff, params, exclude_novel=False):
+    if 'sort_order' in params and params['sort_order'] == 'Locus':
+        gene_order = Gene.locus_order
+    else:
+        gene_order = Gene.alpha_order
+
+    query = session.query(Sample.sample_name, Sample.patient_id, Gene.name, Gene.type, gene_order, Allele.id,
+                          Allele.name, AllelesPattern.allele_in_p_id) \
+        .join(AllelesSample, AllelesSample.sample_id == Sample.id) \
+        .join(Allele, Allele.id == AllelesSample.allele_id) \
+        .join(Gene, Gene.id == Allele.gene_id) \
+        .outerjoin(AllelesPattern, AllelesPattern.pattern_id == Allele.id) \
+        .filter(Gene.name.in_(wanted_genes)) \
+        .filter(Allele.name.notlike('%Del%')) \
+        .filter(Allele.name.notlike('%OR%')) \
+        .filter(AllelesSample.kdiff >= kdiff)
+
+    if exclude_novel:
+        query = query.filter(Allele.novel == 0)
+
+    if params['ambiguous_alleles'] == 'Exclude':
+        query = query.filter(Allele.is_single_allele == True)
+
+    rows = []
+    for sample_chunk in chunk_list(list(sample_names), ALLELE_FRAME_CHUNKS):
+        check_cancelled()
+        rows.extend(query.filter(Sample.sample_name.in_(sample_chunk)).all())
+
+    alleles = pd.DataFrame(rows, columns=['sample', 'patient', 'gene', 'gene_type', 'gene_order', 'allele_id', 'allele',
+                                          'member'])
+    return alleles.sort_values('gene_order', kind='stable').drop(columns='gene_order').reset_index(drop=True)
+
+
+# If an ambiguous allele and an allele that it may be are both present in a group (rows sharing the given key
+# columns), drop the ambiguous one, so that the allele is not counted twice. Returns one row per sample and allele
+
+def drop_contained_patterns(alleles, keys):
+    present = alleles[keys + ['allele_id']].drop_duplicates().rename(columns={'allele_id': 'member'})
+    patterns = alleles.dropna(subset=['member']).astype({'member': 'int64'})
+    contained = patterns.merge(present.astype({'member': 'int64'}), on=keys + ['member'])[keys + ['allele_id']]
+
+    alleles = alleles.drop(columns='member').drop_duplicates()
+    dropped = alleles.merge(contained.drop_duplicates(), on=keys + ['allele_id'], how='left', indicator=True)['_merge'] == 'both'
+    return alleles[~dropped.values]
+
 # functions to translate from pipeline allele names (in the tigger/rabhit files) and vdjbase names
 
 def find_primer_translations(session):
@@ -15,12 +15,18 @@ from api.vdjbase.vdjbase import find_vdjbase_samples, find_rep_filter_params
 from app import app
 import importlib
 import subprocess
+import time
 import os
 import traceback
 from json.decoder import JSONDecodeError
 import tempfile
+import signal
 from extensions import run_report
-from celery import current_task
+from api.reports.r_worker_pool import r_worker_pool, can_use_pool, RWorkerTimeout, RWorkerCrashed, RWorkerCancelled, CANCEL_POLL_INTERVAL
+from api.reports.report_progress import report_progress, cancel_requested, cancel_report, ReportCancelled
+from api.reports.report_utils import r_tsv_args
+from api.reports.report_cache import report_cache_key, cached_report, cached_job_id, cached_job_key
+import metrics
 import flask_cors
 
 SYSDATA = os.path.join(app.config['R_SCRIPT_PATH'], 'sysdata.rda')
@@ -121,18 +127,50 @@ report_arguments.add_argument('rep_datasets', type=str, location='args')
 report_arguments.add_argument('rep_filters', type=str, location='args')
 report_arguments.add_argument('params', type=str, location='args')
 
+# The same arguments, sent as form fields. A parameter may also be uploaded as a file, in a field named after the
+# parameter, for example a FASTA file of sequences to search for
+
+report_form_arguments = reqparse.RequestParser()
+report_form_arguments.add_argument('format', type=str, location='form')
+report_form_arguments.add_argument('species', type=str, location='form')
+report_form_arguments.add_argument('genomic_datasets', type=str, location='form')
+report_form_arguments.add_argument('genomic_filters', type=str, location='form')
+report_form_arguments.add_argument('rep_datasets', type=str, location='form')
+report_form_arguments.add_argument('rep_filters', type=str, location='form')
+report_form_arguments.add_argument('params', type=str, location='form')
+
+MAX_PARAM_UPLOAD = 1024 * 1024
+
+
 @ns.route('/reports/run/<string:report_name>')
 @api.response(404, 'Malformed request')
 class ReportsRunApi(Resource):
-    @digby_protected()
+    @digby_protected(conditional=False)
     @api.expect(report_arguments, validate=True)
     def get(self, report_name):
+        return self.start_report(report_name, report_arguments, {})
+
+    @digby_protected(conditional=False)
+    @api.expect(report_form_arguments, validate=True)
+    def post(self, report_name):
+        uploads = {}
+        for name, upload in request.files.items():
+            content = upload.read(MAX_PARAM_UPLOAD + 1)
+            if len(content) > MAX_PARAM_UPLOAD:
+                raise BadRequest('Uploaded file %s is larger than %d bytes' % (name, MAX_PARAM_UPLOAD))
+            uploads[name] = content.decode('utf-8', errors='replace')
+
+        return self.start_report(report_name, report_form_arguments, uploads)
+
+    # Validate a report request and queue the report, with any uploaded parameters replacing those in params
+
+    def start_report(self, report_name, arguments, uploads):
         try:
             if app.config['TESTING']:
                 with open('report_request.log', 'a') as fo:
                     fo.write('%s\n' % request.url)
 
-            args = report_arguments.parse_args(request)
+            args = arguments.parse_args(request)
 
             if report_name not in report_defs:
                 print("Bad Request: no such report")
@@ -168,6 +206,10 @@ class ReportsRunApi(Resource):
                 print("Bad Request: no samples selected")
                 raise BadRequest('No samples selected')
 
+            for p in report_defs[report_name]['params']:
+                if p['id'] in uploads:
+                    params[p['id']] = uploads[p['id']]
+
             # maybe we should check types as well
             for p in report_defs[report_name]['params']:
                 if p['id'] not in params.keys():
@@ -186,7 +228,13 @@ class ReportsRunApi(Resource):
             # When working with Celery, remember that the code for reports (run() and its dependencies) must be
             # saved *and Celery restarted* for changes to take effect
 
-            result = run_report.delay(report_name, args.format, args.species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params)
+            cache_key = report_cache_key(report_name, args.format, args.species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params)
+            cached = cached_report(cache_key)
+
+            if cached is not None:
+                return {'id': cached_job_id(cache_key), 'status': 'SUCCESS', 'results': cached}
+
+            result = run_report.delay(report_name, args.format, args.species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params, queued=time.time(), cache_key=cache_key)
             return {'id': result.id, 'status': 'queued'}
         except JSONDecodeError:
             print('Exception encountered processing JSON-encoded field: %s' % traceback.format_exc())
@@ -205,15 +253,25 @@ class ReportsRunApi(Resource):
 @ns.route('/reports/status/<string:job_id>')
 @api.response(404, 'Malformed request')
 class ReportsStatus(Resource):
-    @digby_protected()
+    @digby_protected(conditional=False)
     def get(self, job_id):
+        cache_key = cached_job_key(job_id)
+
+        if cache_key is not None:
+            results = cached_report(cache_key)
+            if results is None:
+                results = {'status': 'error', 'description': 'This report is no longer available. Please run it again.'}
+            return {'id': job_id, 'status': 'SUCCESS', 'results': results}, {'Cache-Control': 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0'}
+
         res = celery.AsyncResult(job_id)
         status = res.status
 
         print('Get report status called for %s: returning %s, %s' % (job_id, status, res.info))
 
         try:
-            if status in ['SUCCESS', 'FAILURE']:
+            if status == 'REVOKED':
+                return {'id': job_id, 'status': status, 'results': {'status': 'error', 'description': ReportCancelled.description}}, {'Cache-Control': 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0'}
+            elif status in ['SUCCESS', 'FAILURE']:
                 if status == 'FAILURE':
                     app.logger.error('Report status FAILURE: results %s' % res.info)
                 elif res.info['status'] == 'error':
@@ -231,19 +289,66 @@ class ReportsStatus(Resource):
             raise BadRequest('Error encountered while processing report request: %s' % str(e))
 
 
+# Cancel a report. A report that has not started is discarded, and one that is running stops at its next check (see
+# report_progress.py). A report that has completed is unaffected
+
+@ns.route('/reports/cancel/<string:job_id>')
+@api.response(404, 'Malformed request')
+class ReportsCancel(Resource):
+    @digby_protected(conditional=False)
+    def post(self, job_id):
+        if cached_job_key(job_id) is not None:
+            return {'id': job_id, 'status': 'SUCCESS'}
+
+        cancel_report(job_id)
+        return {'id': job_id, 'status': 'cancelling'}
+
+
 # R Script Runner
+# Scripts are run by the R worker pool if it is enabled, otherwise by a new Rscript process. Either way, the script
+# is stopped if the report is cancelled
 def run_rscript(script, args, cwd=app.config['R_SCRIPT_PATH']):
-    current_task.update_state(state='PENDING', meta={'stage': 'running report'})
+    report_progress('running report')
     cmd_line = ['Rscript', os.path.join(app.config['R_SCRIPT_PATH'], script)]#
     cmd_line.extend(args)
-    print("Running Rscript: '%s'\n" % ' '.join(cmd_line))
-    proc = subprocess.Popen(cmd_line, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    proc.wait()
-    (stdout, stderr) = proc.communicate()
+    workers = r_worker_pool()
+    start = time.perf_counter()
+
+    if workers is not None and can_use_pool(args):
+        print("Running in R worker: '%s'\n" % ' '.join(cmd_line))
+        try:
+            returncode, stdout, stderr = workers.run(cmd_line[1], args, cwd, cancel_requested)
+        except RWorkerCancelled:
+            metrics.rscript_duration.observe(script, 'cancelled', value=time.perf_counter() - start)
+            raise ReportCancelled()
+        except RWorkerTimeout:
+            metrics.rscript_duration.observe(script, 'timeout', value=time.perf_counter() - start)
+            raise BadRequest('Error running report: the report took too long to produce')
+        except RWorkerCrashed:
+            metrics.rscript_duration.observe(script, 'error', value=time.perf_counter() - start)
+            raise BadRequest('Error running report: R exited unexpectedly')
+    else:
+        cmd_line = cmd_line[:2] + r_tsv_args(args)
+        print("Running Rscript: '%s'\n" % ' '.join(cmd_line))
+        proc = subprocess.Popen(cmd_line, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+
+        while True:
+            try:
+                (stdout, stderr) = proc.communicate(timeout=CANCEL_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_requested():
+                    stop_rscript(proc)
+                    metrics.rscript_duration.observe(script, 'cancelled', value=time.perf_counter() - start)
+                    raise ReportCancelled()
+
+        returncode = proc.returncode
+
+    metrics.rscript_duration.observe(script, 'ok' if returncode == 0 else 'error', value=time.perf_counter() - start)
 
     print(stdout.decode("utf-8"))
 
-    if proc.returncode != 0:
+    if returncode != 0:
         msg = str(stderr.decode("utf-8"))
         if "Execution halted" in msg:
             print("Got error in Rscript:\n" + msg)
@@ -257,6 +362,22 @@ def run_rscript(script, args, cwd=app.config['R_SCRIPT_PATH']):
     return True
 
 
+# Stop an Rscript process and anything it has started: politely at first, then by force
+RSCRIPT_STOP_TIMEOUT = 5
+
+def stop_rscript(proc):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+        try:
+            proc.communicate(timeout=RSCRIPT_STOP_TIMEOUT)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+
 # Send a report - the file should be in OUTPUT_PATH
 def send_report(filename, format, attachment_filename=None):
     return {'status': 'ok', 'filename': attachment_filename, 'url': app.config['OUTPUT_REPORT_LINK'] + os.path.basename(filename)}
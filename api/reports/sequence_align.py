@@ -0,0 +1,134 @@
+# Scoring of sequences against a target for the sequence search report, and the k-mer index used to shortlist the
+# sequences worth aligning. This module does not import the app, so that it can be used by pool processes and tests.
+#
+# The shortlist is exact: a sequence is only left out if no alignment with the target could reach the score. With
+# the scoring used here (match 1, mismatch -0.5, gap open -0.5, gap extend -0.1), the target's length less the
+# score bounds the total cost of the mismatches and gaps in an alignment. Each of these breaks a limited number of
+# the target's k-mers, so at least a known number of the target's k-mers must occur in the sequence. The bound
+# allows SCORE_TOLERANCE for rounding, so that sequences scoring exactly the required score are kept.
+
+from collections import defaultdict
+
+import numpy as np
+from Bio.Align import PairwiseAligner
+
+KMER_LENGTH = 6
+
+MATCH_SCORE = 1
+MISMATCH_SCORE = -0.5
+OPEN_GAP_SCORE = -0.5
+EXTEND_GAP_SCORE = -0.1
+
+SCORE_TOLERANCE = 1e-9
+
+
+class KmerIndex:
+    def __init__(self, sequences):
+        self.sequences = list(dict.fromkeys(seq for seq in sequences if seq))
+        self.positions = {seq: i for i, seq in enumerate(self.sequences)}
+
+        postings = defaultdict(list)
+        for i, seq in enumerate(self.sequences):
+            for kmer in set(seq[p:p + KMER_LENGTH] for p in range(len(seq) - KMER_LENGTH + 1)):
+                postings[kmer].append(i)
+
+        self.postings = {kmer: np.array(ids, dtype=np.int32) for kmer, ids in postings.items()}
+
+    # For each indexed sequence, the number of positions in the target at which the k-mer occurs in the sequence
+
+    def shared_kmers(self, target):
+        hits = [self.postings[target[p:p + KMER_LENGTH]] for p in range(len(target) - KMER_LENGTH + 1)
+                if target[p:p + KMER_LENGTH] in self.postings]
+
+        if not hits:
+            return np.zeros(len(self.sequences), dtype=np.int64)
+
+        return np.bincount(np.concatenate(hits), minlength=len(self.sequences))
+
+    # Those of the given sequences that could align with the target with at least min_score. Sequences that are not
+    # in the index are included
+
+    def shortlist(self, target, min_score, sequences):
+        shared = self.shared_kmers(target)
+        return [seq for seq in sequences
+                if seq not in self.positions or may_reach_score(len(target), len(seq), shared[self.positions[seq]], min_score)]
+
+
+# Whether an alignment between a target and a sequence of the given lengths, which share the given number of target
+# k-mers, could have at least min_score
+
+def may_reach_score(target_length, seq_length, shared, min_score):
+    budget = target_length * MATCH_SCORE - min_score + SCORE_TOLERANCE
+
+    if budget < 0:
+        return False
+
+    # the difference in length must be taken up by gaps
+
+    excess = seq_length - target_length
+    if excess > 0 and -OPEN_GAP_SCORE - EXTEND_GAP_SCORE * (excess - 1) > budget:
+        return False
+    if excess < 0 and -excess * MATCH_SCORE - OPEN_GAP_SCORE - EXTEND_GAP_SCORE * (-excess - 1) > budget:
+        return False
+
+    # Within the budget, find the largest number of target k-mers that could be broken. A single-position insertion
+    # in the target breaks k-1 k-mers, and the sequence's excess length allows that many for the cost of a gap
+    # opening each. Beyond those, an insertion must be paired with a deletion. A mismatch or deleted position breaks
+    # k k-mers, and costs at least its lost match and the mismatch or gap score
+
+    k = KMER_LENGTH
+    insertions = min(max(excess, 0), budget / -OPEN_GAP_SCORE)
+    remaining = budget + OPEN_GAP_SCORE * insertions
+    ratio = max(k / (MATCH_SCORE - MISMATCH_SCORE),
+                k / (MATCH_SCORE - EXTEND_GAP_SCORE),
+                (2 * k - 1) / (MATCH_SCORE - EXTEND_GAP_SCORE - OPEN_GAP_SCORE))
+    broken = (k - 1) * insertions + ratio * remaining
+
+    return shared >= (target_length - k + 1) - broken
+
+
+def make_aligner():
+    aligner = PairwiseAligner()
+    aligner.mode = 'global'
+    aligner.match_score = MATCH_SCORE
+    aligner.mismatch_score = MISMATCH_SCORE
+    aligner.open_gap_score = OPEN_GAP_SCORE
+    aligner.extend_gap_score = EXTEND_GAP_SCORE
+    return aligner
+
+
+# The alignment as Bio.pairwise2.format_alignment would present it
+
+def format_alignment(alignment, target, seq, score):
+    target_line, seq_line = [], []
+    t = s = 0
+
+    for (t_start, t_end), (s_start, s_end) in zip(*alignment.aligned):
+        target_line.append(target[t:t_start] + '-' * (s_start - s))
+        seq_line.append('-' * (t_start - t) + seq[s:s_start])
+        target_line.append(target[t_start:t_end])
+        seq_line.append(seq[s_start:s_end])
+        t, s = t_end, s_end
+
+    target_line.append(target[t:] + '-' * (len(seq) - s))
+    seq_line.append('-' * (len(target) - t) + seq[s:])
+    target_line, seq_line = ''.join(target_line), ''.join(seq_line)
+
+    match_line = ''.join('|' if a == b else ' ' if '-' in (a, b) else '.' for a, b in zip(target_line, seq_line))
+    return '\n'.join([target_line, match_line, seq_line + '\n  Score=%g\n' % score])
+
+
+# Score each sequence against the target. Returns (sequence, score, formatted alignment) for those scoring at least
+# min_score, with the alignment only if requested
+
+def score_sequences(target, sequences, min_score, with_alignment):
+    aligner = make_aligner()
+    results = []
+
+    for seq in sequences:
+        score = aligner.score(target, seq)
+        if score >= min_score:
+            pretty = format_alignment(aligner.align(target, seq)[0], target, seq, score) if with_alignment else None
+            results.append((seq, score, pretty))
+
+    return results
@@ -0,0 +1,113 @@
+# Search of dataset allele sequences for sequences similar to a target
+#
+# Each dataset's allele sequences are held in a k-mer index (see sequence_align), built when the dataset is first
+# searched and rebuilt when its content version changes. A search uses the index to shortlist the sequences that
+# could reach the required alignment score, and aligns only those, with PairwiseAligner, spread over a pool of
+# SEQUENCE_SEARCH_PROCESSES processes if there are many of them. Several targets can be searched for at once,
+# sharing the indexes and the process pool.
+#
+# The pool is a billiard Pool, as searches run in Celery worker processes, which multiprocessing does not allow to
+# have children. If a pool can't be started, the sequences are aligned in the calling process.
+
+import threading
+
+from billiard import Pool
+
+from app import app, vdjbase_dbs, genomic_dbs
+from api.reports.sequence_align import KmerIndex, score_sequences
+from db.vdjbase_model import Allele
+from db.genomic_db import Sequence as GenomicSequence
+
+# Shortlists smaller than this are aligned in the calling process. Larger ones are aligned in batches of
+# PARALLEL_BATCH_SIZE sequences
+MIN_PARALLEL_SEQUENCES = 200
+PARALLEL_BATCH_SIZE = 50
+
+SEARCH_REGIONS = ['V-REGION', 'D-REGION', 'J-REGION']
+
+
+# Sequences as they are searched: gaps removed from AIRR-seq alleles, genomic sequences in lower case
+
+def airrseq_search_sequence(seq):
+    return seq.replace('.', '') if seq else None
+
+
+def genomic_search_sequence(seq):
+    return seq.lower() if seq else None
+
+
+index_cache = {}
+index_lock = threading.Lock()
+
+
+def dataset_search_sequences(kind, session):
+    if kind == 'AIRR-seq':
+        return [airrseq_search_sequence(seq) for (seq,) in session.query(Allele.seq).distinct()]
+    else:
+        return [genomic_search_sequence(seq) for (seq,) in session.query(GenomicSequence.sequence)
+                .filter(GenomicSequence.type.in_(SEARCH_REGIONS)).distinct()]
+
+
+# The index of a dataset (kind is 'AIRR-seq' or 'Genomic'), built if necessary
+
+def dataset_index(kind, species, dataset):
+    dbs = vdjbase_dbs if kind == 'AIRR-seq' else genomic_dbs
+    version = dbs[species].entries[dataset].version
+    key = (kind, species, dataset)
+
+    with index_lock:
+        cached = index_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    index = KmerIndex(dataset_search_sequences(kind, dbs[species][dataset].session))
+
+    with index_lock:
+        index_cache[key] = (version, index)
+
+    return index
+
+
+# Run each of a list of searches, given as (target, sequences, min_score). Returns the results of each search, as
+# returned by score_sequences. If progress is given, it is called with the fraction of the work completed as the
+# searches proceed. If it raises an exception, outstanding work is abandoned
+
+def search_sequences(searches, with_alignment, progress=None):
+    pool = None
+
+    if app.config['SEQUENCE_SEARCH_PROCESSES'] > 1 and sum(len(search[1]) for search in searches) >= MIN_PARALLEL_SEQUENCES:
+        try:
+            pool = Pool(app.config['SEQUENCE_SEARCH_PROCESSES'])
+        except (OSError, AssertionError) as e:
+            app.logger.warning('Sequence search pool could not be started, aligning in process: %s' % e)
+
+    if pool is None:
+        results = []
+        for target, sequences, min_score in searches:
+            if progress is not None:
+                progress(len(results) / len(searches))
+            results.append(score_sequences(target, sequences, min_score, with_alignment))
+        return results
+
+    results = [[] for _ in searches]
+
+    try:
+        batches = []
+        for i, (target, sequences, min_score) in enumerate(searches):
+            for start in range(0, len(sequences), PARALLEL_BATCH_SIZE):
+                batches.append((i, pool.apply_async(score_sequences, (target, sequences[start:start + PARALLEL_BATCH_SIZE],
+                                                                      min_score, with_alignment))))
+
+        for done, (i, batch) in enumerate(batches):
+            if progress is not None:
+                progress(done / len(batches))
+            results[i].extend(batch.get())
+
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return results
@@ -1,5 +1,6 @@
 # Sequence search for AIRR-seq and genomic samples
 
+import html
 from werkzeug.exceptions import BadRequest
 from api.reports.report_utils import make_output_file, collate_samples, chunk_list, collate_gen_samples, splitlines, chunks
 from api.reports.reports import send_report
@@ -11,155 +12,184 @@ from db.genomic_db import Sequence as GenomicSequence, SampleSequence as Genomic
 
 from db.vdjbase_airr_model import Patient, Sample
 from api.vdjbase.vdjbase import apply_rep_filter_params
-from Bio import pairwise2
+from api.reports.sequence_index import dataset_index, search_sequences, airrseq_search_sequence, genomic_search_sequence, SEARCH_REGIONS
+from api.reports.report_progress import report_progress
 from receptor_utils import simple_bio_seq as simple
 
 SAMPLE_CHUNKS = 400
 
+# Limits on the sequences searched for in one report
+MAX_QUERIES = 200
+MAX_QUERY_TEXT = 1024 * 1024
+
+
+# Add the (sequence, appearances, gene name, allele name) records of a dataset to the sequences to search
+
+def add_search_sequences(seqs_to_search, kind, dataset, recs):
+    for seq, appearances, gene_name, allele_name in recs:
+        if not seq:
+            continue
+        if seq not in seqs_to_search:
+            seqs_to_search[seq] = {}
+            seqs_to_search[seq]['datasets'] = []
+            seqs_to_search[seq]['sequence'] = seq
+        seqs_to_search[seq]['datasets'].append({
+            'type': kind,
+            'dataset': dataset,
+            'appearances': appearances,
+            'gene': gene_name,
+            'allele_name': allele_name,
+        })
+
+
+# The queries in the sequence parameter, which is either a single sequence or FASTA records. Returns a list of
+# (name, sequence), in which name is None for a single sequence
+
+def parse_queries(text):
+    text = text.replace('\r', '')
+
+    if len(text) > MAX_QUERY_TEXT:
+        raise BadRequest('Please search for at most %d characters of sequence' % MAX_QUERY_TEXT)
+
+    if not text.lstrip().startswith('>'):
+        return [(None, text)]
+
+    queries = []
+    for record in text.lstrip()[1:].split('\n>'):
+        header, _, seq = record.partition('\n')
+        queries.append((header.strip() or 'Query %d' % (len(queries) + 1), seq))
+
+    if len(queries) > MAX_QUERIES:
+        raise BadRequest('Please search for at most %d sequences at a time' % MAX_QUERIES)
+
+    return queries
+
+
 def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params):
     if format not in ["html", "xls"]:
         raise BadRequest('Invalid format requested')
 
-    if 'sequence' not in params or len(params['sequence']) <= 5:
+    if 'sequence' not in params:
         raise BadRequest('Please specify a longer sequence to search for')
 
+    queries = []
+    for name, seq in parse_queries(params['sequence']):
+        if len(seq.replace('\n', '')) <= 5:
+            raise BadRequest('Please specify a longer sequence to search for' + (' (%s)' % name if name else ''))
+
+        queries.append({
+            'name': name,
+            'target': seq.lower().replace('.', '').replace('\n', ''),
+            'display': seq.replace('\n', '').lower(),
+        })
+
+    fasta = queries[0]['name'] is not None
+
     r_chain, rep_samples_by_dataset = collate_samples(rep_samples)
     g_chain, gen_samples_by_dataset = collate_gen_samples(genomic_samples)
 
+    # collect the candidate sequences of each dataset, along with the dataset's index
+
     seqs_to_search = {}
+    candidates = []
+    datasets = len(rep_samples_by_dataset) + len(gen_samples_by_dataset)
 
     for dataset in rep_samples_by_dataset.keys():
+        report_progress('collecting sequences', 0.4 * len(candidates) / datasets)
         session = vdjbase_dbs[species][dataset].session
-        allele_recs = []
+        sample_list = []
 
         for sample_chunk in chunk_list(rep_samples_by_dataset[dataset], SAMPLE_CHUNKS):
-            sample_list = session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(sample_chunk)).all()
-            sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
-            sample_list = [s[0] for s in sample_list]
-
-            query = session.query(Allele) \
-                .join(Gene) \
-                .join(AllelesSample) \
-                .join(Sample) \
-                .join(Patient, Patient.id == Sample.patient_id) \
-                .filter(Gene.name.in_(wanted_genes)) \
-                .filter(Allele.name.notlike('%Del%')) \
-                .filter(Allele.name.notlike('%OR%')) \
-                .filter(Sample.sample_name.in_(sample_list))
-
-            if params['novel_alleles'] == 'Exclude':
-                query = query.filter(Allele.novel == 0)
-
-            if params['ambiguous_alleles'] == 'Exclude':
-                query = query.filter(Allele.is_single_allele == 1)
-
-            for allele in query.all():
-                if allele not in allele_recs:
-                    allele_recs.append(allele)
-
-        for allele in allele_recs:
-            seq = allele.seq.replace('.', '')
-            if seq not in seqs_to_search:
-                seqs_to_search[seq] = {}
-                seqs_to_search[seq]['datasets'] = []
-                seqs_to_search[seq]['sequence'] = seq
-            seqs_to_search[seq]['datasets'].append({
-                'type': 'AIRR-seq',
-                'dataset': dataset,
-                'appearances': allele.appears,
-                'gene': allele.gene.name,
-                'allele_name': allele.name,
-            })
+            sample_list.extend(session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(sample_chunk)).all())
+
+        sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
+        sample_list = [s[0] for s in sample_list]
+
+        query = session.query(Allele.id, Allele.seq, Allele.appears, Gene.name, Allele.name) \
+            .join(Gene) \
+            .join(AllelesSample) \
+            .join(Sample) \
+            .join(Patient, Patient.id == Sample.patient_id) \
+            .filter(Gene.name.in_(wanted_genes)) \
+            .filter(Allele.name.notlike('%Del%')) \
+            .filter(Allele.name.notlike('%OR%'))
+
+        if params['novel_alleles'] == 'Exclude':
+            query = query.filter(Allele.novel == 0)
+
+        if params['ambiguous_alleles'] == 'Exclude':
+            query = query.filter(Allele.is_single_allele == 1)
+
+        allele_recs = {}
+        for sample_chunk in chunk_list(sample_list, SAMPLE_CHUNKS):
+            for allele_id, seq, appears, gene_name, allele_name in query.filter(Sample.sample_name.in_(sample_chunk)).distinct():
+                allele_recs[allele_id] = (airrseq_search_sequence(seq), appears, gene_name, allele_name)
+
+        add_search_sequences(seqs_to_search, 'AIRR-seq', dataset, allele_recs.values())
+        candidates.append((dataset_index('AIRR-seq', species, dataset), [rec[0] for rec in allele_recs.values() if rec[0]]))
 
     for dataset in gen_samples_by_dataset.keys():
+        report_progress('collecting sequences', 0.4 * len(candidates) / datasets)
         session = genomic_dbs[species][dataset].session
-        sequence_recs = []
+        sample_list = []
 
         for sample_chunk in chunk_list(gen_samples_by_dataset[dataset], SAMPLE_CHUNKS):
-            sample_list = session.query(GenomicSample.sample_name).filter(GenomicSample.sample_name.in_(sample_chunk)).all()
-            sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
-            sample_list = [s[0] for s in sample_list]
-
-            query = session.query(GenomicSequence)\
-                .join(GenomicSampleSequence, GenomicSampleSequence.sequence_id == GenomicSequence.id)\
-                .join(GenomicSample, GenomicSampleSequence.sample_id == GenomicSample.id)\
-                .join(GenomicGene, GenomicSequence.gene_id == GenomicGene.id)\
-                .filter(GenomicSequence.type.in_(['V-REGION', 'D-REGION', 'J-REGION'])) \
-                .filter(GenomicSample.sample_name.in_(sample_list))\
-                .filter(GenomicGene.name.in_(wanted_genes))
-
-            if params['novel_alleles'] == 'Exclude':
-                query = query.filter(GenomicSequence.novel == 0)
-
-            if not params['f_pseudo_genes']:
-                query = query.filter(GenomicSequence.functional == 'Functional')
-
-            for sequence in query.all():
-                if sequence not in sequence_recs:
-                    sequence_recs.append(sequence)
-
-        for sequence in sequence_recs:
-            seq = sequence.sequence.lower()
-            if seq not in seqs_to_search:
-                seqs_to_search[seq] = {}
-                seqs_to_search[seq]['datasets'] = []
-                seqs_to_search[seq]['sequence'] = seq
-            seqs_to_search[seq]['datasets'].append({
-                'type': 'Genomic',
-                'dataset': dataset,
-                'appearances': sequence.appearances,
-                'gene': sequence.gene.name,
-                'allele_name': sequence.name,
-            })
-
-    target_seq = params['sequence'].lower().replace('.', '').replace('\n', '')
-    target_score = len(target_seq) * 0.9
-
-    for seq in seqs_to_search.keys():
-        seqs_to_search[seq]['score'] = pairwise2.align.globalms(target_seq, seq, 1, -0.5, -0.5, -0.1, score_only=True)
-
-    results = [x for x in seqs_to_search.values() if x['score'] >= target_score]
-
-    if results:
-        results = sorted(results, key=lambda x: x['score'], reverse=True)
+            sample_list.extend(session.query(GenomicSample.sample_name).filter(GenomicSample.sample_name.in_(sample_chunk)).all())
 
+        sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
+        sample_list = [s[0] for s in sample_list]
 
-    if format == 'html':
-        target = params['sequence'].replace('\n', '').replace('\r', '').lower()
+        query = session.query(GenomicSequence.id, GenomicSequence.sequence, GenomicSequence.appearances, GenomicGene.name, GenomicSequence.name)\
+            .join(GenomicSampleSequence, GenomicSampleSequence.sequence_id == GenomicSequence.id)\
+            .join(GenomicSample, GenomicSampleSequence.sample_id == GenomicSample.id)\
+            .join(GenomicGene, GenomicSequence.gene_id == GenomicGene.id)\
+            .filter(GenomicSequence.type.in_(SEARCH_REGIONS)) \
+            .filter(GenomicGene.name.in_(wanted_genes))
 
-        while target[-1] == '':
-            target = target[:-1]
+        if params['novel_alleles'] == 'Exclude':
+            query = query.filter(GenomicSequence.novel == 0)
 
-        doc = '<html><head><title>Sequence Search Results</title></head><body>'
-        doc += f'Target sequence: <pre><code>'
-        for line in chunks(target, 80):
-            doc += line + '\n'
+        if not params['f_pseudo_genes']:
+            query = query.filter(GenomicSequence.functional == 'Functional')
 
-        doc += '</code></pre><br>'
+        sequence_recs = {}
+        for sample_chunk in chunk_list(sample_list, SAMPLE_CHUNKS):
+            for sequence_id, seq, appearances, gene_name, sequence_name in query.filter(GenomicSample.sample_name.in_(sample_chunk)).distinct():
+                sequence_recs[sequence_id] = (genomic_search_sequence(seq), appearances, gene_name, sequence_name)
 
-        for result in results:
-            alignment = pairwise2.align.globalms(target_seq, result['sequence'], 1, -0.5, -0.5, -0.1, one_alignment_only=True)
-            pretty = pairwise2.format_alignment(*alignment[0])
+        add_search_sequences(seqs_to_search, 'Genomic', dataset, sequence_recs.values())
+        candidates.append((dataset_index('Genomic', species, dataset), [rec[0] for rec in sequence_recs.values() if rec[0]]))
 
-            pretty = pretty.replace('\r', '')
-            pretty = pretty.split('\n')
-            rep = pretty[:-2]
+    # shortlist and score the candidates for each query, keeping the alignments of those that match for the html report
 
-            maxlen = max([len(x) for x in rep])
-            for i in range(len(rep)):
-                rep[i] = rep[i].rjust(maxlen)
+    report_progress('shortlisting sequences', 0.4)
 
-            rep = splitlines('\n'.join(rep), 80, 0)
+    searches = []
+    for query in queries:
+        query['min_score'] = len(query['target']) * 0.9
+        shortlist = set()
+        for index, sequences in candidates:
+            shortlist.update(index.shortlist(query['target'], query['min_score'], sequences))
+        searches.append((query['target'], sorted(shortlist), query['min_score']))
 
-            headers = []
-            for ds in result['datasets']:
-                headers.append(f"{ds['type']} {ds['dataset']} {ds['allele_name']} ({ds['appearances']} appearances)")
+    matches_by_query = search_sequences(searches, format == 'html', lambda f: report_progress('aligning sequences', 0.5 + 0.5 * f))
 
-            headers = '; '.join(headers)
-            doc += f'<pre><code>\n\n{headers}\n{pretty[-2]}\n{rep}<code></pre>'
+    for query, matches in zip(queries, matches_by_query):
+        results = [dict(seqs_to_search[seq], score=score, alignment=pretty) for seq, score, pretty in matches]
+        query['results'] = sorted(results, key=lambda x: x['score'], reverse=True)
 
-        if not results:
-            doc += '<div>No results found with >= 90% sequence identity.</div>'
+    if format == 'html':
+        doc = '<html><head><title>Sequence Search Results</title></head><body>'
+
+        if fasta:
+            for i, query in enumerate(queries):
+                doc += f'<a href="#query-{i + 1}">{html.escape(query["name"])}</a> ({len(query["results"])} matches)<br>'
+            doc += '<br>'
+
+        for i, query in enumerate(queries):
+            if fasta:
+                doc += f'<h3 id="query-{i + 1}">{html.escape(query["name"])}</h3>'
+            doc += html_query_results(query['display'], query['results'])
 
         doc += '</body></html>'
 
@@ -170,32 +200,71 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     if format == 'xls':
         doc = []
 
-        for result in results:
-            for ds in result['datasets']:
-                doc.append({
-                    'Score': result['score'],
-                    'Dataset': ds['dataset'],
-                    'Type': ds['type'],
-                    'Gene': ds['gene'],
-                    'Allele': ds['allele_name'],
-                    'Appearances': ds['appearances'],
-                    'Allele Sequence': result['sequence'],
-                    'Target Sequence': target_seq,
+        for query in queries:
+            rows = []
+
+            for result in query['results']:
+                for ds in result['datasets']:
+                    rows.append({
+                        'Score': result['score'],
+                        'Dataset': ds['dataset'],
+                        'Type': ds['type'],
+                        'Gene': ds['gene'],
+                        'Allele': ds['allele_name'],
+                        'Appearances': ds['appearances'],
+                        'Allele Sequence': result['sequence'],
+                        'Target Sequence': query['target'],
+                    })
+
+            if not query['results']:
+                rows.append({
+                    'Score': '',
+                    'Dataset': '',
+                    'Type': '',
+                    'Gene': '',
+                    'Allele': '',
+                    'Appearances': '',
+                    'Allele Sequence': '',
+                    'Target Sequence': query['target'],
                 })
 
-        if not results:
-            doc.append({
-                'Score': '',
-                'Dataset': '',
-                'Type': '',
-                'Gene': '',
-                'Allele': '',
-                'Appearances': '',
-                'Allele Sequence': '',
-                'Target Sequence': target_seq,
-            })
+            if fasta:
+                rows = [dict({'Query': query['name']}, **row) for row in rows]
+
+            doc.extend(rows)
 
         output_path = make_output_file('csv')
         simple.write_csv(output_path, doc)
 
     return send_report(output_path, format, 'sequence_search.csv')
+
+
+def html_query_results(target, results):
+    doc = f'Target sequence: <pre><code>'
+    for line in chunks(target, 80):
+        doc += line + '\n'
+
+    doc += '</code></pre><br>'
+
+    for result in results:
+        pretty = result['alignment'].replace('\r', '')
+        pretty = pretty.split('\n')
+        rep = pretty[:-2]
+
+        maxlen = max([len(x) for x in rep])
+        for i in range(len(rep)):
+            rep[i] = rep[i].rjust(maxlen)
+
+        rep = splitlines('\n'.join(rep), 80, 0)
+
+        headers = []
+        for ds in result['datasets']:
+            headers.append(f"{ds['type']} {ds['dataset']} {ds['allele_name']} ({ds['appearances']} appearances)")
+
+        headers = '; '.join(headers)
+        doc += f'<pre><code>\n\n{headers}\n{pretty[-2]}\n{rep}<code></pre>'
+
+    if not results:
+        doc += '<div>No results found with >= 90% sequence identity.</div>'
+
+    return doc
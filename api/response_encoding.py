@@ -0,0 +1,159 @@
+# Response encoding for the APIs
+#
+# - JSON is serialised with orjson if it is installed, otherwise with the standard library
+# - rows from the list queries are converted with per-column functions chosen once from the column types in the
+#   filter definitions, rather than by checking the type of every value
+# - large responses are compressed with br (if brotli is installed) or gzip, when the client accepts it
+
+import datetime
+import decimal
+import gzip
+import json
+from enum import Enum
+
+from flask import request
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def encode_default(o):
+    if isinstance(o, BaseModel):
+        return o.dict()
+    if isinstance(o, Enum):
+        return o.value
+    if isinstance(o, (datetime.datetime, datetime.date)):
+        return o.isoformat()
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=encode_default, option=ORJSON_OPTIONS)
+else:
+    def dumps(obj):
+        return json.dumps(obj, default=encode_default).encode('utf-8')
+
+
+# Column converters
+
+def format_decimal(v):
+    return '%0.2f' % v
+
+
+def format_datetime(v):
+    return v.date().isoformat()
+
+
+def format_date(v):
+    return v.isoformat()
+
+
+# Used where the type of a column can't be determined
+def format_any(v):
+    if isinstance(v, datetime.datetime):
+        return v.date().isoformat()
+    if isinstance(v, datetime.date):
+        return v.isoformat()
+    if isinstance(v, decimal.Decimal):
+        return '%0.2f' % v
+    return v
+
+
+def column_python_type(field):
+    try:
+        return field.type.python_type
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+# Return {column: converter} for those of the query's columns that need converting, keyed by the name under which
+# each column appears in the result rows. decimal_converter overrides the conversion of Decimal values (None leaves
+# them to the encoder)
+
+def field_converters(fields, decimal_converter=format_decimal):
+    converters = {}
+
+    for field in fields:
+        key = getattr(field, 'key', None)
+        if key is None:
+            continue
+
+        python_type = column_python_type(field)
+
+        if python_type is None:
+            converters[key] = format_any
+        elif issubclass(python_type, decimal.Decimal):
+            if decimal_converter is not None:
+                converters[key] = decimal_converter
+        elif issubclass(python_type, datetime.datetime):
+            converters[key] = format_datetime
+        elif issubclass(python_type, datetime.date):
+            converters[key] = format_date
+
+    return converters
+
+
+# As field_converters, for the named columns of one of the filter definitions, e.g. sample_info_filters
+
+def column_converters(filters, columns, decimal_converter=format_decimal):
+    fields = [filters[col]['field'] for col in columns if col in filters and filters[col].get('field') is not None]
+    return field_converters(fields, decimal_converter)
+
+
+def convert_row(row, converters):
+    for col, converter in converters.items():
+        v = row.get(col)
+        if v is not None and not isinstance(v, str):
+            row[col] = converter(v)
+    return row
+
+
+def convert_rows(rows, converters):
+    if converters:
+        for row in rows:
+            convert_row(row, converters)
+    return rows
+
+
+# Compression
+
+def accepts_encoding(encoding):
+    return encoding in request.accept_encodings
+
+
+def compress_response(response, min_size):
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers:
+        return response
+
+    body = response.get_data()
+
+    if len(body) < min_size:
+        return response
+
+    if brotli is not None and accepts_encoding('br'):
+        response.set_data(brotli.compress(body, quality=4))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepts_encoding('gzip'):
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    return response
@@ -1,7 +1,9 @@
 import traceback
 
+from flask import make_response
 from flask_restx import Api
 from app import app
+from api.response_encoding import dumps
 from sqlalchemy.orm.exc import NoResultFound
 
 # Template modelled after https://github.com/postrational/rest_api_demo by Michał Karzyński
@@ -9,6 +11,14 @@ from sqlalchemy.orm.exc import NoResultFound
 api = Api(version='1.0', title='DIgServer API', description='API for Ig Receptor gene data')
 
 
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    resp = make_response(dumps(data), code)
+    resp.headers.extend(headers or {})
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+
 @api.errorhandler
 def default_error_handler(e):
     message = 'An unhandled exception occurred.'
@@ -0,0 +1,86 @@
+# Streaming export of list API results as NDJSON or CSV
+#
+# Rows are serialised as they are produced, so that the size of the export does not affect memory use, and the
+# first rows are sent before the query has completed. Output is buffered into chunks of around EXPORT_CHUNK bytes,
+# apart from the first row, which is sent immediately.
+#
+# NDJSON rows are encoded as in the other API responses. In CSV, nested values (lists and dicts) are written as JSON.
+
+import csv
+import io
+from flask import Response, stream_with_context
+
+from api.response_encoding import dumps
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+# Rows fetched from the database at a time
+EXPORT_BATCH = 1000
+
+EXPORT_CHUNK = 64 * 1024
+
+
+def ndjson_chunks(rows):
+    buf = []
+    size = 0
+    first = True
+
+    for row in rows:
+        line = dumps(row) + b'\n'
+        buf.append(line)
+        size += len(line)
+        if first or size >= EXPORT_CHUNK:
+            yield b''.join(buf)
+            buf = []
+            size = 0
+            first = False
+
+    if buf:
+        yield b''.join(buf)
+
+
+def csv_value(v):
+    if isinstance(v, (dict, list, tuple, set, frozenset)):
+        return dumps(v).decode('utf-8')
+    return v
+
+
+def csv_row(row):
+    return {k: csv_value(v) for k, v in row.items()}
+
+
+def csv_chunks(rows):
+    buf = io.StringIO()
+    writer = None
+
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(buf, fieldnames=list(row.keys()), extrasaction='ignore')
+            writer.writeheader()
+            writer.writerow(csv_row(row))
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            continue
+
+        writer.writerow(csv_row(row))
+        if buf.tell() >= EXPORT_CHUNK:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    if buf.tell():
+        yield buf.getvalue()
+
+
+# Return a streaming response for the rows, which should be a generator of dicts with the same keys
+
+def stream_rows(rows, format, filename):
+    if format == 'csv':
+        chunks, mimetype = csv_chunks(rows), 'text/csv'
+    else:
+        chunks, mimetype = ndjson_chunks(rows), 'application/x-ndjson'
+
+    resp = Response(stream_with_context(chunks), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (filename, format)
+    return resp
@@ -1,14 +1,18 @@
 # Services related to vdjbase repseq-based data sets
+import hashlib
+import os
 from functools import wraps
 
 import requests
-from flask import jsonify
+from flask import jsonify, request, Response
+from werkzeug.http import quote_etag
 from flask_jwt_extended import create_access_token, set_access_cookies, jwt_required, get_jwt_identity, \
     verify_jwt_in_request, decode_token, create_refresh_token
 from flask_restx import Resource, reqparse, fields, marshal, inputs
 from api.restx import api
 import json
-from app import vdjbase_dbs, app, db
+import metrics
+from app import vdjbase_dbs, genomic_dbs, app, db
 from datetime import datetime
 import time
 
@@ -89,7 +93,114 @@ class RefreshApi(Resource):
         return response
 
 
-def digby_protected():
+# Versions of the datasets a request can depend on. Datasets are identified by the species and dataset arguments
+# in the URL; if there are none, every dataset of the species (or of every species) is included
+
+DATASET_VIEW_ARGS = ('dataset', 'genomic_datasets', 'data_sets')
+
+
+def request_dataset_versions():
+    view_args = request.view_args or {}
+    species = view_args.get('species')
+    names = None
+
+    for arg in DATASET_VIEW_ARGS:
+        if arg in view_args:
+            names = set(view_args[arg].split(','))
+
+    versions = []
+
+    for kind, dbs in (('rep', vdjbase_dbs), ('gen', genomic_dbs)):
+        for sp in sorted(dbs.keys()):
+            if species is not None and sp != species:
+                continue
+            for name, entry in dbs[sp].entries.items():
+                if names is None or name in names:
+                    versions.append((kind, sp, name, entry.version, entry.modified))
+
+    return versions
+
+
+# A hash of the source files under the given paths, with the suffixes of the app's code, R scripts and report
+# definitions
+
+SOURCE_SUFFIXES = ('.py', '.R', '.rda', '.json')
+
+
+def source_hash(paths):
+    digest = hashlib.sha256()
+
+    for path in paths:
+        root = path if os.path.isdir(path) else os.path.dirname(path)
+        files = [path] if os.path.isfile(path) else []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+            files.extend(os.path.join(dirpath, fn) for fn in sorted(filenames) if fn.endswith(SOURCE_SUFFIXES))
+
+        for fn in files:
+            digest.update(os.path.relpath(fn, root).encode('utf-8'))
+            with open(fn, 'rb') as fi:
+                digest.update(hashlib.sha256(fi.read()).digest())
+
+    return digest.hexdigest()
+
+
+# The version of the app's code, included in the validators so that those issued before a deploy are not honoured
+# after it. APP_VERSION may be set in the config, for example to the release or commit deployed; otherwise the
+# version is a hash of the app's source files, computed once per process
+
+APP_SOURCE_DIRS = ('api', 'api_v1', 'db')
+
+_app_version = None
+
+
+def app_version():
+    global _app_version
+
+    if _app_version is None:
+        _app_version = app.config.get('APP_VERSION')
+
+        if not _app_version:
+            base = app.config['BASE_PATH']
+            paths = sorted(os.path.join(base, fn) for fn in os.listdir(base) if fn.endswith('.py'))
+            _app_version = source_hash(paths + [os.path.join(base, d) for d in APP_SOURCE_DIRS])
+
+    return _app_version
+
+
+# Validators for a response: a weak ETag covering the app version, the request and the dataset versions. Only the
+# ETag is used: the latest modification time of the datasets can go backwards when a dataset is removed, so it can't
+# safely answer If-Modified-Since
+
+def dataset_validators():
+    versions = request_dataset_versions()
+    tag = hashlib.sha1(repr((app_version(), request.full_path, [v[:4] for v in versions])).encode('utf-8')).hexdigest()
+    headers = {'ETag': quote_etag(tag, weak=True)}
+    return tag, headers
+
+
+def not_modified(tag):
+    return bool(request.if_none_match) and request.if_none_match.contains_weak(tag)
+
+
+def add_headers(resp, headers):
+    if isinstance(resp, Response):
+        for k, v in headers.items():
+            resp.headers[k] = v
+        return resp
+    if isinstance(resp, tuple):
+        if len(resp) == 2:
+            return resp + (headers,)
+        return resp[0], resp[1], dict(resp[2], **headers)
+    return resp, 200, headers
+
+
+# Wraps a GET endpoint. Unless conditional is False, the response carries validators derived from the dataset
+# versions and the app version, and a request whose validators match is answered with 304 without calling the
+# endpoint. Endpoints whose responses change other than by publication of a dataset or a deploy, such as report status
+# or static files, should set conditional=False.
+
+def digby_protected(conditional=True):
     def wrapper(fn):
         @wraps(fn)
         def decorator(*args, **kwargs):
@@ -99,10 +210,34 @@ def digby_protected():
                 return "Unauthorized", 403
             current_identity = get_jwt_identity()
             if current_identity or (app.config['JWT_USER'] == '' and app.config['JWT_PASSWORD'] == ''):
-                return fn(*args, **kwargs)
+                if not conditional or request.method != 'GET':
+                    return fn(*args, **kwargs)
+
+                tag, headers = dataset_validators()
+                if not_modified(tag):
+                    return Response(status=304, headers=headers)
+
+                resp = fn(*args, **kwargs)
+                if isinstance(resp, tuple) and len(resp) > 1 and resp[1] != 200:
+                    return resp
+                return add_headers(resp, headers)
             else:
                 return "Unauthorized", 403
         return decorator
     return wrapper
 
 
+@ns.route('/dataset_cache')
+class DatasetCacheApi(Resource):
+    @digby_protected(conditional=False)
+    def get(self):
+        """ Return the number of datasets open in this worker, and the hit and miss counts of the dataset cache """
+        return {'vdjbase': vdjbase_dbs.stats(), 'genomic': genomic_dbs.stats()}
+
+
+@ns.route('/metrics')
+class MetricsApi(Resource):
+    @digby_protected(conditional=False)
+    def get(self):
+        """ Return metrics for all web and Celery worker processes, in the Prometheus text format """
+        return Response(metrics.render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
@@ -3,9 +3,9 @@
 from flask import request
 from flask_restx import Resource, reqparse
 
-from api.reports.report_utils import make_output_file
+from api.reports.report_utils import make_output_file, chunk_list
 from api.restx import api
-from sqlalchemy import inspect, func, or_
+from sqlalchemy import inspect, func, or_, case
 from sqlalchemy import null as sa_null
 from math import ceil
 import json
@@ -13,9 +13,16 @@ from sqlalchemy_filters import apply_filters
 from werkzeug.exceptions import BadRequest
 import datetime
 import decimal
+from itertools import islice
 import os.path
 from os.path import isfile
 from db.filter_list import apply_filter_to_list
+from db.sql_sort import sort_key_columns, row_sort_key, iter_merged_streams, values_table, check_sort_specs
+from db.list_cursor import decode_keyset_cursor, keyset_page_query, merge_keyset_pages
+from db.facets import FacetIndex, SKIP, get_facet_index, merge_facet_counts
+from db.dataset_fan_out import map_datasets, iter_datasets
+from api.stream_export import EXPORT_FORMATS, EXPORT_BATCH, stream_rows
+from api.response_encoding import column_converters, convert_row, convert_rows
 from api.system.system import digby_protected
 
 from app import vdjbase_dbs, app, genomic_dbs
@@ -28,6 +35,9 @@ from api.reports.genotypes import process_repseq_genotype
 
 VDJBASE_SAMPLE_PATH = os.path.join(app.config['STATIC_PATH'], 'study_data/VDJbase/samples')
 
+# Maximum number of values in an IN clause (SQLite's default limit on host parameters is 999)
+SQL_IN_CHUNK = 500
+
 
 # Return SqlAlchemy row as a dict, using correct column names
 def object_as_dict(obj):
@@ -70,20 +80,22 @@ class NovelsApi(Resource):
         """ Returns the list all novel alleles across all datasets """
         ret = {}
         species = get_vdjbase_species()
+
+        def dataset_novels(session, dset):
+            return session.query(Allele.name, Allele.seq, Allele.appears).filter(Allele.novel == 1).all()
+
         for sp in species:
             if sp in vdjbase_dbs:
-                for ds_name, ds in vdjbase_dbs[sp].items():
-                    if '_description' not in ds_name:
-                        session = ds.session
-                        novels = session.query(Allele).filter(Allele.novel == 1).all()
-
-                        if novels:
-                            if sp not in ret:
-                                ret[sp] = {}
-                            if ds_name not in ret[sp]:
-                                ret[sp][ds_name] = {}
-                            for novel in novels:
-                                ret[sp][ds_name][novel.name] = (novel.seq.replace('.', ''), novel.appears)
+                ds_names = [ds_name for ds_name in vdjbase_dbs[sp].keys() if '_description' not in ds_name]
+
+                for ds_name, novels in zip(ds_names, map_datasets(dataset_novels, vdjbase_providers(sp, ds_names))):
+                    if novels:
+                        if sp not in ret:
+                            ret[sp] = {}
+                        if ds_name not in ret[sp]:
+                            ret[sp][ds_name] = {}
+                        for novel in novels:
+                            ret[sp][ds_name][novel.name] = (novel.seq.replace('.', ''), novel.appears)
 
         return ret
 
@@ -310,6 +322,8 @@ filter_arguments.add_argument('page_size', type=int, location='args')
 filter_arguments.add_argument('filter', type=str, location='args')
 filter_arguments.add_argument('sort_by', type=str, location='args')
 filter_arguments.add_argument('cols', type=str, location='args')
+filter_arguments.add_argument('cursor', type=str, location='args')
+filter_arguments.add_argument('format', type=str, location='args', choices=('json',) + EXPORT_FORMATS)
 
 
 @ns.route('/samples/<string:species>/<string:dataset>')
@@ -350,42 +364,42 @@ class SamplesApi(Resource):
 
         attribute_query.append(Sample.id)
 
+        datasets = dataset.split(',')
         filter = json.loads(args['filter']) if args['filter'] else []
-        ret = find_vdjbase_samples(attribute_query, species, dataset.split(','), filter)
 
-        total_size = len(ret)
+        sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None) else []
+        if len(sort_specs) == 0:
+            sort_specs = [{'field': 'name', 'order': 'asc'}]
+
+        if args['format'] in EXPORT_FORMATS:
+            rows = iter_vdjbase_samples(attribute_query, species, datasets, filter, sort_specs)
+            return stream_rows(export_sample_rows(species, rows, required_cols), args['format'], '%s_%s_samples' % (species, dataset.replace(',', '_')))
 
         uniques = {}
 
         for f in required_cols:
             uniques[f] = []
 
-        uniques['dataset'] = dataset.split(',')
+        uniques['dataset'] = datasets
 
         # special column for names by dataset
 
         uniques['names_by_dataset'] = {}
         filter_applied = len(filter) > 0
+        facet_cols = [f for f in required_cols if f in sample_facet_cols]
+
         if filter_applied:
-            for dataset in uniques['dataset']:
-                uniques['names_by_dataset'][dataset] = []
-
-        for s in ret:
-            for f in required_cols:
-                if sample_info_filters[f]['field'] is not None and 'no_uniques' not in sample_info_filters[f]:
-                    el = s[f]
-                    if isinstance(el, (datetime.datetime, datetime.date)):
-                        el = el.date().isoformat()
-                    elif isinstance(el, bool):
-                        if f in rep_sample_bool_values:
-                            el = rep_sample_bool_values[f][0 if el else 1]
-                    if (not isinstance(el, str) or len(el) > 0) and el not in uniques[f]:
-                        uniques[f].append(el)
-                    if (sample_info_filters[f]['field'].type.python_type is str) and len(el) == 0 and '(blank)' not in uniques[f]:
-                        uniques[f].append('(blank)')
-
-            if filter_applied:
-                uniques['names_by_dataset'][s['dataset']].append(s['sample_name'])
+            for dset in uniques['dataset']:
+                uniques['names_by_dataset'][dset] = []
+
+            uniques['names_by_dataset'].update(find_vdjbase_sample_names(species, datasets, filter))
+
+            counts = merge_facet_counts([vdjbase_sample_facets(species, dset).counts(facet_cols, names) for dset, names in uniques['names_by_dataset'].items()])
+        else:
+            counts = merge_facet_counts([vdjbase_sample_facets(species, dset).counts(facet_cols) for dset in datasets])
+
+        for f in facet_cols:
+            uniques[f] = list(counts[f].keys()) if f in counts else []
 
         def name_sort_key(name):
             name = name.split('_')
@@ -415,104 +429,272 @@ class SamplesApi(Resource):
 
         if 'haplotypes' in required_cols:
             uniques['haplotypes'] = []
-            for dset in dataset.split(','):
+            for dset in datasets:
                 session = vdjbase_dbs[species][dset].session
                 haplotypes = session.query(HaplotypesFile.by_gene_s).distinct().order_by(HaplotypesFile.by_gene_s).all()
                 x = [(h[0]) for h in haplotypes]
                 uniques['haplotypes'].extend(x)
             uniques['haplotypes'] = list(set(uniques['haplotypes']))
 
-        sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None) else []
-        if len(sort_specs) == 0:
-            sort_specs = [{'field': 'name', 'order': 'asc'}]
-
-        for spec in sort_specs:
-            f = spec['field']
-            if f in sample_info_filters.keys():
-                if 'sort' in sample_info_filters[f] and sample_info_filters[f]['sort'] == 'underscore':
-                    ret = sorted(ret, key=lambda x: name_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-                elif 'sort' in sample_info_filters[f] and sample_info_filters[f]['sort'] == 'numeric':
-                    ret = sorted(ret, key=lambda x: num_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-                else:
-                    ret = sorted(ret, key=lambda x: ((x[f] is None or x[f] == ''), x[f]), reverse=(spec['order'] == 'desc'))
-
-        if args['page_size']:
-            first = (args['page_number']) * args['page_size']
-            ret = ret[first:first + args['page_size']]
-
-        for rec in ret:
-            for k, v in rec.items():
-                if isinstance(v, (datetime.datetime, datetime.date)):
-                    rec[k] = v.date().isoformat()
-                elif isinstance(v, decimal.Decimal):
-                    rec[k] = '%0.2f' % v
-
-        if 'genotypes' in required_cols:
-            for r in ret:
-                r['genotypes'] = {}
-                r['genotypes']['analysis'] = json.dumps({'species': species, 'repSeqs': [r['dataset']], 'name': r['sample_name'], 'sort_order': 'Locus'})
-
-                r['genotypes']['path'] = app.config['BACKEND_LINK']
-                sp = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset']]) + '/'
-                r['genotypes']['tigger'] = sp + r['genotype'].replace('samples', '') if r['genotype_stats'] else ''
-                r['genotypes']['ogrdbstats'] = sp + r['genotype_stats'].replace('samples', '') if r['genotype_stats'] else ''
-                r['genotypes']['ogrdbplot'] = sp + r['genotype_report'].replace('samples', '') if r['genotype_report'] else ''
-                del r['genotype_stats']
-                del r['genotype_report']
-
-                session = vdjbase_dbs[species][r['dataset']].session
-                igsnper_path = session.query(Sample.igsnper_plot_path, Sample.genotype_report).filter(Sample.sample_name == r['sample_name']).one_or_none()
-
-                if igsnper_path is not None and igsnper_path[0] is not None:
-                    r['genotypes']['igsnper'] = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset'], igsnper_path[0]])
-                else:
-                    r['genotypes']['igsnper'] = ''
-
+        ret, total_size, next_cursor = find_vdjbase_samples_page(attribute_query, species, datasets, filter, sort_specs, args['page_number'] or 0, args['page_size'], args['cursor'])
 
-        if 'haplotypes' in required_cols:
-            for r in ret:
-                session = vdjbase_dbs[species][r['dataset']].session
-                haplotypes = session.query(Sample.sample_name, func.group_concat(HaplotypesFile.by_gene_s), func.group_concat(HaplotypesFile.file))
-                h = haplotypes.filter(Sample.sample_name == r['sample_name'])\
-                    .join(SamplesHaplotype, SamplesHaplotype.samples_id == Sample.id)\
-                    .join(HaplotypesFile, HaplotypesFile.id == SamplesHaplotype.haplotypes_file_id)\
-                    .one_or_none()
-                if h is not None and h[1] is not None:
-                    r['haplotypes'] = {}
-                    r['haplotypes']['path'] = app.config['BACKEND_LINK']
-                    for (hap, filename) in zip(h[1].split(','), h[2].split(',')):
-                        filename = filename.replace('samples/', '')
-                        fp = os.path.join(VDJBASE_SAMPLE_PATH, species, r['dataset'], filename)
-                        sp = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset'], filename])
-                        if isfile(fp):
-                            r['haplotypes'][hap] = {}
-                            r['haplotypes'][hap]['analysis'] = json.dumps({'species': species, 'repSeqs': [r['dataset']], 'name': r['sample_name'], 'hap_gene': hap, 'sort_order' : 'Locus'})
-                            r['haplotypes'][hap]['rabhit'] = sp
-                else:
-                    r['haplotypes'] = ''
+        convert_rows(ret, column_converters(sample_info_filters, required_cols))
+        add_sample_file_links(species, ret, required_cols)
 
         return {
             'samples': ret,
             'uniques': uniques,
             'total_items': total_size,
             'page_size': args['page_size'],
-            'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1
+            'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1,
+            'next_cursor': next_cursor,
         }
 
+# Format sample rows for export, adding file links a batch at a time
+
+def export_sample_rows(species, rows, required_cols):
+    converters = column_converters(sample_info_filters, required_cols)
+
+    while True:
+        batch = [convert_row(rec, converters) for rec in islice(rows, EXPORT_BATCH)]
+        if not batch:
+            return
+        add_sample_file_links(species, batch, required_cols)
+        yield from batch
+
+
+# Add links to the genotype and haplotype files of a page of samples. The database is queried once per dataset,
+# and haplotype files are checked against the dataset's file manifest
+
+def add_sample_file_links(species, samples, required_cols):
+    names_by_dataset = {}
+    for r in samples:
+        names_by_dataset.setdefault(r['dataset'], []).append(r['sample_name'])
+
+    if 'genotypes' in required_cols:
+        igsnper_paths = {}
+
+        for dset, names in names_by_dataset.items():
+            session = vdjbase_dbs[species][dset].session
+            for chunk in chunk_list(names, SQL_IN_CHUNK):
+                for sample_name, igsnper_path in session.query(Sample.sample_name, Sample.igsnper_plot_path).filter(Sample.sample_name.in_(chunk)).all():
+                    igsnper_paths[(dset, sample_name)] = igsnper_path
+
+        for r in samples:
+            r['genotypes'] = {}
+            r['genotypes']['analysis'] = json.dumps({'species': species, 'repSeqs': [r['dataset']], 'name': r['sample_name'], 'sort_order': 'Locus'})
+
+            r['genotypes']['path'] = app.config['BACKEND_LINK']
+            sp = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset']]) + '/'
+            r['genotypes']['tigger'] = sp + r['genotype'].replace('samples', '') if r['genotype_stats'] else ''
+            r['genotypes']['ogrdbstats'] = sp + r['genotype_stats'].replace('samples', '') if r['genotype_stats'] else ''
+            r['genotypes']['ogrdbplot'] = sp + r['genotype_report'].replace('samples', '') if r['genotype_report'] else ''
+            del r['genotype_stats']
+            del r['genotype_report']
+
+            igsnper_path = igsnper_paths.get((r['dataset'], r['sample_name']))
+
+            if igsnper_path is not None:
+                r['genotypes']['igsnper'] = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset'], igsnper_path])
+            else:
+                r['genotypes']['igsnper'] = ''
+
+    if 'haplotypes' in required_cols:
+        haplotypes = {}
+
+        for dset, names in names_by_dataset.items():
+            session = vdjbase_dbs[species][dset].session
+            sample_files = vdjbase_dbs[species][dset].sample_files(os.path.join(VDJBASE_SAMPLE_PATH, species, dset))
+
+            for chunk in chunk_list(names, SQL_IN_CHUNK):
+                rows = session.query(Sample.sample_name, HaplotypesFile.by_gene_s, HaplotypesFile.file)\
+                    .join(SamplesHaplotype, SamplesHaplotype.samples_id == Sample.id)\
+                    .join(HaplotypesFile, HaplotypesFile.id == SamplesHaplotype.haplotypes_file_id)\
+                    .filter(Sample.sample_name.in_(chunk))\
+                    .order_by(Sample.sample_name, HaplotypesFile.by_gene_s)\
+                    .all()
+
+                for sample_name, hap, filename in rows:
+                    if filename is not None:
+                        filename = filename.replace('samples/', '')
+                        haplotypes.setdefault((dset, sample_name), []).append((hap, filename, os.path.normpath(filename) in sample_files))
+
+        for r in samples:
+            if (r['dataset'], r['sample_name']) in haplotypes:
+                r['haplotypes'] = {}
+                r['haplotypes']['path'] = app.config['BACKEND_LINK']
+                for (hap, filename, exists) in haplotypes[(r['dataset'], r['sample_name'])]:
+                    if exists:
+                        r['haplotypes'][hap] = {}
+                        r['haplotypes'][hap]['analysis'] = json.dumps({'species': species, 'repSeqs': [r['dataset']], 'name': r['sample_name'], 'hap_gene': hap, 'sort_order' : 'Locus'})
+                        r['haplotypes'][hap]['rabhit'] = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset'], filename])
+            else:
+                r['haplotypes'] = ''
+
+
+# Columns for which uniques are listed, and the form in which each value is listed
+
+sample_facet_cols = [f for f in sample_info_filters.keys() if sample_info_filters[f]['field'] is not None and 'no_uniques' not in sample_info_filters[f]]
+
+
+def sample_facet_value(f, el):
+    if isinstance(el, bool):
+        if f in rep_sample_bool_values:
+            el = rep_sample_bool_values[f][0 if el else 1]
+    if not isinstance(el, str) or len(el) > 0:
+        return el
+    if sample_info_filters[f]['field'].type.python_type is str:
+        return '(blank)'
+    return SKIP
+
+
+def vdjbase_sample_facets(species, dset):
+    def build():
+        attribute_query = [sample_info_filters['sample_id']['field']]
+        for f in sample_facet_cols:
+            if f != 'sample_id':
+                attribute_query.append(sample_info_filters[f]['field'])
+        rows = find_vdjbase_samples(attribute_query, species, [dset], [])
+        return FacetIndex(rows, 'sample_name', sample_facet_cols, sample_facet_value)
+
+    return get_facet_index(vdjbase_dbs[species][dset], 'samples', build)
+
+
 def find_vdjbase_samples(attribute_query, species, datasets, filter):
-    hap_filters = None
-    allele_filters = None
-    dataset_filters = []
-    filter_spec = []
+    sample_filter = parse_vdjbase_sample_filter(filter)
+
+    def dataset_samples(session, dset):
+        return [vdjbase_sample_row(r, dset) for r in vdjbase_sample_query(session, attribute_query, sample_filter).all()]
+
+    ret = []
+    for rows in map_datasets(dataset_samples, vdjbase_providers(species, select_vdjbase_datasets(datasets, sample_filter))):
+        ret.extend(rows)
+
+    return ret
+
+
+# Return {dataset: [sample names]} for the samples selected by the filter
+
+def find_vdjbase_sample_names(species, datasets, filter):
+    sample_filter = parse_vdjbase_sample_filter(filter)
+    datasets = select_vdjbase_datasets(datasets, sample_filter)
+
+    def dataset_sample_names(session, dset):
+        return [r[0] for r in vdjbase_sample_query(session, [Sample.sample_name], sample_filter).all()]
+
+    return dict(zip(datasets, map_datasets(dataset_sample_names, vdjbase_providers(species, datasets))))
+
+
+# Return one page of samples, sorted and paged by the database. Each dataset's query is limited to the rows
+# that could fall on the page, and the results are merged, so the cost depends on the page rather than the
+# number of samples.
+# If a cursor is given, the page starts after the row it identifies (keyset pagination), rather than at page_number.
+# Returns (samples, total_size, next_cursor)
+
+def find_vdjbase_samples_page(attribute_query, species, datasets, filter, sort_specs, page_number=0, page_size=None, cursor=None):
+    sort_keys = sort_key_columns(sample_info_filters, sort_specs)
+    id_keys = [(Sample.id.label('_sort_id'), False)]
+    offset = page_number * page_size if page_size and not cursor else 0
+    sample_filter = parse_vdjbase_sample_filter(filter)
+    datasets = select_vdjbase_datasets(datasets, sample_filter)
+    last = None
+
+    if cursor:
+        try:
+            last = decode_keyset_cursor(cursor, datasets, sort_keys, id_keys)
+        except ValueError as e:
+            raise BadRequest(f'Bad cursor: {e}')
+
+    def dataset_page(session, dset):
+        query = vdjbase_sample_query(session, attribute_query + [k for k, _ in sort_keys + id_keys], sample_filter)
+        count = query.with_entities(Sample.id).count()
+        query = keyset_page_query(query, sort_keys, id_keys, datasets.index(dset), last, offset + page_size + 1 if page_size else None)
+        return count, query.all()
+
+    results = map_datasets(dataset_page, vdjbase_providers(species, datasets))
+    total_size = sum(count for count, _ in results)
+    merged, next_cursor = merge_keyset_pages([(dset, rows) for dset, (_, rows) in zip(datasets, results)], sort_keys, id_keys, offset, page_size)
+
+    ret = []
+    for dset, r in merged:
+        s = vdjbase_sample_row(r, dset)
+        for k in list(s.keys()):
+            if k.startswith('_sort_'):
+                del s[k]
+        ret.append(s)
+
+    return ret, total_size, next_cursor
+
+
+# Generator over all selected samples in sort order, for streaming export, starting after the cursor if one is
+# given. Each dataset's query is read a batch at a time, and the datasets are merged as they are read. The filter
+# and cursor are checked before the generator is returned
+
+def iter_vdjbase_samples(attribute_query, species, datasets, filter, sort_specs, cursor=None):
+    sort_keys = sort_key_columns(sample_info_filters, sort_specs)
+    id_keys = [(Sample.id.label('_sort_id'), False)]
+    sample_filter = parse_vdjbase_sample_filter(filter)
+    datasets = select_vdjbase_datasets(datasets, sample_filter)
+    last = None
+
+    if cursor:
+        try:
+            last = decode_keyset_cursor(cursor, datasets, sort_keys, id_keys)
+        except ValueError as e:
+            raise BadRequest(f'Bad cursor: {e}')
+
+    def keyed_rows(query, ds_index, dset):
+        for r in query:
+            yield row_sort_key(r, sort_keys) + (ds_index, r._sort_id), (dset, r)
+
+    def samples():
+        sessions = []
+        try:
+            streams = []
+            for ds_index, (dset, provider) in enumerate(vdjbase_providers(species, datasets)):
+                session = provider.new_session()
+                sessions.append(session)
+                query = vdjbase_sample_query(session, attribute_query + [k for k, _ in sort_keys + id_keys], sample_filter)
+                query = keyset_page_query(query, sort_keys, id_keys, ds_index, last).yield_per(EXPORT_BATCH)
+                streams.append(keyed_rows(query, ds_index, dset))
+
+            for dset, r in iter_merged_streams(streams):
+                s = vdjbase_sample_row(r, dset)
+                for k in list(s.keys()):
+                    if k.startswith('_sort_'):
+                        del s[k]
+                yield s
+        finally:
+            for session in sessions:
+                session.close()
+
+    return samples()
+
+
+def vdjbase_providers(species, datasets):
+    return [(dset, vdjbase_dbs[species][dset]) for dset in datasets]
+
+
+# Convert a sample filter from the API into sqlalchemy_filters form, separating out the filters that need
+# special handling
+
+def parse_vdjbase_sample_filter(filter):
+    sample_filter = {
+        'filter_spec': [],
+        'hap_filters': None,
+        'allele_filters': None,
+        'dataset_filters': [],
+    }
 
     for f in list(filter):
         try:
+            f = dict(f)
             if f['field'] == 'haplotypes':
-                hap_filters = f
+                sample_filter['hap_filters'] = f
             elif f['field'] == 'allele':
-                allele_filters = f
+                sample_filter['allele_filters'] = f
             elif f['field'] == 'dataset':
-                dataset_filters.append(f)
+                sample_filter['dataset_filters'].append(f)
             else:
                 f['model'] = sample_info_filters[f['field']]['model']
                 if 'fieldname' in sample_info_filters[f['field']]:
@@ -534,52 +716,60 @@ def find_vdjbase_samples(attribute_query, species, datasets, filter):
                     
                     f = {'or': value_specs}
 
-                filter_spec.append(f)
+                sample_filter['filter_spec'].append(f)
 
         except Exception as e:
             raise BadRequest(f'Bad filter string: {f}: {e}')
-    ret = []
 
-    if len(dataset_filters) > 0:
-        apply_filter_to_list(datasets, dataset_filters)
+    return sample_filter
 
-    for dset in datasets:
-        session = vdjbase_dbs[species][dset].session
 
-        query = session.query(*attribute_query)\
-            .join(GenoDetection, Sample.geno_detection_id == GenoDetection.id)\
-            .join(Patient, Sample.patient_id == Patient.id)\
-            .join(SeqProtocol, Sample.seq_protocol_id == SeqProtocol.id)\
-            .join(TissuePro, Sample.tissue_pro_id == TissuePro.id)\
-            .join(Study, Sample.study_id == Study.id)
-        query = apply_filters(query, filter_spec)
-
-        if hap_filters:
-            hap_samples = session.query(Sample.sample_name.distinct()).join(SamplesHaplotype).join(HaplotypesFile).filter(
-                HaplotypesFile.by_gene_s.in_(hap_filters['value']))
-            query = query.filter(Sample.sample_name.in_(hap_samples))
-
-        if allele_filters:
-            allele_samples = session.query(Sample.sample_name.distinct()).join(AllelesSample,
-                                                                        Sample.id == AllelesSample.sample_id).join(
-                Allele, Allele.id == AllelesSample.allele_id).filter(Allele.name.in_(allele_filters['value'])).all()
-            if allele_samples is None:
-                allele_samples = []
-            query = query.filter(Sample.sample_name.in_([s[0] for s in allele_samples]))
-
-        res = query.all()
-
-        for r in res:
-            s = r._asdict()
-            for k, v in s.items():
-                if isinstance(v, (datetime.datetime, datetime.date)):
-                    s[k] = v.date().isoformat()
-                if v is None:
-                    s[k] = ''
-            s['dataset'] = dset
-            s['id'] = '%s.%d' % (dset, s['id'])
-            ret.append(s)
-    return ret
+def select_vdjbase_datasets(datasets, sample_filter):
+    datasets = list(datasets)
+    if len(sample_filter['dataset_filters']) > 0:
+        apply_filter_to_list(datasets, sample_filter['dataset_filters'])
+    return datasets
+
+
+def vdjbase_sample_query(session, attribute_query, sample_filter):
+    query = session.query(*attribute_query)\
+        .join(GenoDetection, Sample.geno_detection_id == GenoDetection.id)\
+        .join(Patient, Sample.patient_id == Patient.id)\
+        .join(SeqProtocol, Sample.seq_protocol_id == SeqProtocol.id)\
+        .join(TissuePro, Sample.tissue_pro_id == TissuePro.id)\
+        .join(DataPro, Sample.data_pro_id == DataPro.id)\
+        .join(Study, Sample.study_id == Study.id)
+    query = apply_filters(query, sample_filter['filter_spec'])
+
+    hap_filters = sample_filter['hap_filters']
+    if hap_filters:
+        hap_samples = session.query(Sample.sample_name.distinct()).join(SamplesHaplotype).join(HaplotypesFile).filter(
+            HaplotypesFile.by_gene_s.in_(hap_filters['value']))
+        query = query.filter(Sample.sample_name.in_(hap_samples))
+
+    allele_filters = sample_filter['allele_filters']
+    if allele_filters:
+        allele_samples = session.query(Sample.sample_name.distinct()).join(AllelesSample,
+                                                                    Sample.id == AllelesSample.sample_id).join(
+            Allele, Allele.id == AllelesSample.allele_id).filter(Allele.name.in_(allele_filters['value'])).all()
+        if allele_samples is None:
+            allele_samples = []
+        query = query.filter(Sample.sample_name.in_([s[0] for s in allele_samples]))
+
+    return query
+
+
+def vdjbase_sample_row(r, dset):
+    s = r._asdict()
+    for k, v in s.items():
+        if isinstance(v, (datetime.datetime, datetime.date)):
+            s[k] = v.date().isoformat()
+        if v is None:
+            s[k] = ''
+    s['dataset'] = dset
+    if 'id' in s:
+        s['id'] = '%s.%d' % (dset, s['id'])
+    return s
 
 
 rep_sequence_bool_values = {
@@ -616,28 +806,42 @@ class SequencesApi(Resource):
             required_cols.append('igsnper_plot_path')
 
         datasets = dataset.split(',')
-        ret = find_vdjbase_sequences(species, datasets, required_cols, json.loads(args['filter']) if args['filter'] else [])
-        total_size = len(ret)
+        seq_filter = json.loads(args['filter']) if args['filter'] else []
+
+        if args['format'] in EXPORT_FORMATS:
+            rows = find_vdjbase_sequences(species, datasets, required_cols, seq_filter, stream=True)
+            converters = column_converters(sequence_filters, required_cols)
+            return stream_rows((convert_row(rec, converters) for rec in rows), args['format'], '%s_%s_sequences' % (species, dataset.replace(',', '_')))
+
+        sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None)  else [{'field': 'name', 'order': 'asc'}]
+        ret, total_size, next_cursor, selected = find_vdjbase_sequences_page(species, datasets, required_cols, seq_filter, sort_specs, args['page_number'] or 0, args['page_size'], args['cursor'], names=len(seq_filter) > 0)
 
         uniques = {}
         for f in required_cols:
             uniques[f] = []
 
-        for s in ret:
-            for f in required_cols:
-                if sequence_filters[f]['field'] is not None and 'no_uniques' not in sequence_filters[f]:
-                    el = s[f]
-                    if isinstance(el, (datetime.datetime, datetime.date)):        # convert and add to uniques. Can't convert the returned records until we sort
-                        el = el.date().isoformat()
-                    elif isinstance(el, decimal.Decimal):
-                        el = '%0.2f' % el
-                    elif isinstance(el, bool):
-                        if f in rep_sequence_bool_values:
-                            el = rep_sequence_bool_values[f][0 if el else 1]
-                    if (not isinstance(el, str) or len(el) > 0) and el not in uniques[f]:
-                        uniques[f].append(el)
-                    if isinstance(el, str) and len(el) == 0 and '(blank)' not in uniques[f]:
-                        uniques[f].append('(blank)')
+        facet_cols = [f for f in required_cols if f in sequence_facet_cols]
+
+        if len(seq_filter) > 0:
+            dataset_counts = []
+            for dset, names, appears in selected:
+                counts = vdjbase_sequence_facets(species, dset).counts(facet_cols, names)
+
+                # appearances are recalculated for the selected samples, so can't be taken from the index
+                if 'appears' in facet_cols and appears:
+                    counts['appears'] = {}
+                    for name in names:
+                        el = sequence_facet_value('appears', appears[name])
+                        if el is not SKIP:
+                            counts['appears'][el] = counts['appears'].get(el, 0) + 1
+
+                dataset_counts.append(counts)
+            counts = merge_facet_counts(dataset_counts)
+        else:
+            counts = merge_facet_counts([vdjbase_sequence_facets(species, dset).counts(facet_cols) for dset in datasets])
+
+        for f in facet_cols:
+            uniques[f] = list(counts[f].keys()) if f in counts else []
 
         uniques['dataset'] = dataset.split(',')
 
@@ -676,29 +880,7 @@ class SequencesApi(Resource):
             except:
                 pass
 
-        sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None)  else [{'field': 'name', 'order': 'asc'}]
-
-        if len(sort_specs) > 0:
-            for spec in sort_specs:
-                if spec['field'] in sequence_filters.keys():
-                    f = spec['field']
-                    if 'sort' in sequence_filters[f] and sequence_filters[f]['sort'] == 'numeric':
-                        ret = sorted(ret, key=lambda x: num_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-                    else:
-                        ret = sorted(ret, key=lambda x: ((x[f] is None or x[f] == ''), x[f]), reverse=(spec['order'] == 'desc'))
-        else:
-            ret = sorted(ret, key=lambda x : allele_sort_key(x['name']))
-
-        if args['page_size']:
-            first = (args['page_number']) * args['page_size']
-            ret = ret[first : first + args['page_size']]
-
-        for rec in ret:
-            for k, v in rec.items():
-                if isinstance(v, (datetime.datetime, datetime.date)):
-                    rec[k] = v.date().isoformat()
-                elif isinstance(v, decimal.Decimal):
-                    rec[k] = '%0.2f' % v
+        convert_rows(ret, column_converters(sequence_filters, required_cols))
 
 
 
@@ -707,17 +889,46 @@ class SequencesApi(Resource):
             'uniques': uniques,
             'total_items': total_size,
             'page_size': args['page_size'],
-            'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1
+            'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1,
+            'next_cursor': next_cursor,
         }
 
 
-def find_vdjbase_sequences(species, datasets, required_cols, seq_filter):
+sequence_facet_cols = [f for f in sequence_filters.keys() if sequence_filters[f]['field'] is not None and 'no_uniques' not in sequence_filters[f]]
+
+
+def sequence_facet_value(f, el):
+    if isinstance(el, (datetime.datetime, datetime.date)):
+        el = el.date().isoformat()
+    elif isinstance(el, decimal.Decimal):
+        el = '%0.2f' % el
+    elif isinstance(el, bool):
+        if f in rep_sequence_bool_values:
+            el = rep_sequence_bool_values[f][0 if el else 1]
+    if not isinstance(el, str) or len(el) > 0:
+        return el
+    return '(blank)'
+
+
+def vdjbase_sequence_facets(species, dset):
+    def build():
+        rows = find_vdjbase_sequences(species, [dset], list(sequence_facet_cols), [])
+        return FacetIndex(rows, 'name', sequence_facet_cols, sequence_facet_value)
+
+    return get_facet_index(vdjbase_dbs[species][dset], 'sequences', build)
+
+
+# Convert a sequence filter from the API into sqlalchemy_filters form. Returns the filter spec, and the sample and
+# dataset filters, which need special handling
+
+def parse_vdjbase_sequence_filter(seq_filter):
     sample_id_filter = None
     filter_spec = []
     dataset_filters = []
     if seq_filter:
         for f in seq_filter:
             try:
+                f = dict(f)
                 if f['field'] == 'sample_id':
                     sample_id_filter = f
                 elif f['field'] == 'dataset':
@@ -756,91 +967,226 @@ def find_vdjbase_sequences(species, datasets, required_cols, seq_filter):
             except Exception as e:
                 raise BadRequest(f'Bad filter string: {f}: {e}')
 
+    return filter_spec, sample_id_filter, dataset_filters
+
+
+def vdjbase_sequence_attributes(required_cols):
     if 'notes_count' in required_cols and 'notes' not in required_cols:
         required_cols.append('notes')
-    ret = []
+
+    attribute_query = []
+
+    for col in required_cols:
+        if col not in sequence_filters or 'field' not in sequence_filters[col]:
+            raise BadRequest(f'Bad column: {col}')
+        if sequence_filters[col]['field'] is not None:
+            attribute_query.append(sequence_filters[col]['field'])
+
+    return attribute_query
+
+
+# The query for a dataset's sequences, and, if there is a sample filter, the appearances of the alleles in the
+# selected samples ({} otherwise). If the filter selects no samples in the dataset, the dataset's sequences are not
+# restricted. The query is grouped by allele if notes are included
+
+def vdjbase_sequence_query(session, dset, attribute_query, filter_spec, sample_id_filter, grouped):
+    query = session.query(*attribute_query).join(Gene, Allele.gene_id == Gene.id)
+    query = apply_filters(query, filter_spec)
+
+    if grouped:
+        query = query.outerjoin(AlleleConfidenceReport, Allele.id == AlleleConfidenceReport.allele_id).group_by(
+            Allele.id)
+
+    appears = {}
+
+    if sample_id_filter is not None:
+        required_ids = []
+        if dset in sample_id_filter['value']:
+            for id in sample_id_filter['value'][dset]:
+                required_ids.append(id)
+
+        appears = allele_appearances(session, required_ids)
+
+        if appears:
+            query = query.filter(Allele.id.in_(session.query(AllelesSample.allele_id)
+                                               .join(Sample, Sample.id == AllelesSample.sample_id)
+                                               .filter(Sample.sample_name.in_(required_ids))))
+
+    return query, appears
+
+
+def vdjbase_sequence_row(r, species, dset, appears):
+    s = r._asdict()
+
+    if len(appears) > 0:
+        s['appears'] = appears[r.name]
+
+    for k, v in s.items():
+        if k == 'similar' and v is not None:
+            s[k] = v.replace('|', '')
+    s['dataset'] = dset
+
+    if 'igsnper_plot_path' in s and s['igsnper_plot_path'] is not None and len(s['igsnper_plot_path']) > 0:
+        s['igsnper_plot_path'] = '/'.join(
+            [app.config['BACKEND_LINK'], 'static/study_data/VDJbase/samples', species, dset,
+             s['igsnper_plot_path']])
+    else:
+        s['igsnper_plot_path'] = ''
+
+    for k in list(s.keys()):
+        if k.startswith('_sort_'):
+            del s[k]
+
+    return s
+
+
+# Returns a list of sequence rows, or, if stream is set, a generator that fetches them a batch at a time
+
+def find_vdjbase_sequences(species, datasets, required_cols, seq_filter, stream=False):
+    filter_spec, sample_id_filter, dataset_filters = parse_vdjbase_sequence_filter(seq_filter)
+    attribute_query = vdjbase_sequence_attributes(required_cols)
+
     if len(dataset_filters) > 0:
         apply_filter_to_list(datasets, dataset_filters)
-    for dset in datasets:
-        session = vdjbase_dbs[species][dset].session
 
-        attribute_query = []
+    def dataset_sequence_rows(session, dset, batch=None):
+        query, appears = vdjbase_sequence_query(session, dset, attribute_query, filter_spec, sample_id_filter, 'notes' in required_cols)
 
-        for col in required_cols:
-            if col not in sequence_filters or 'field' not in sequence_filters[col]:
-                breakpoint()
-            if sequence_filters[col]['field'] is not None:
-                attribute_query.append(sequence_filters[col]['field'])
-
-        query = session.query(*attribute_query).join(Gene, Allele.gene_id == Gene.id)
-        query = apply_filters(query, filter_spec)
-
-        if 'notes' in required_cols:
-            query = query.outerjoin(AlleleConfidenceReport, Allele.id == AlleleConfidenceReport.allele_id).group_by(
-                Allele.id)
-
-        res = query.all()
-
-        required_names = []
-        appears = {}
-
-        if sample_id_filter is not None:
-            required_ids = []
-            if dset in sample_id_filter['value']:
-                for id in sample_id_filter['value'][dset]:
-                    required_ids.append(id)
-
-            alleles_with_samples = session.query(Allele) \
-                .join(AllelesSample) \
-                .join(Sample) \
-                .filter(Sample.sample_name.in_(required_ids)).all()
-
-            for a in alleles_with_samples:
-                appearances = session.query(AllelesSample.patient_id) \
-                    .filter(AllelesSample.hap == 'geno') \
-                    .filter(AllelesSample.allele_id == a.id) \
-                    .join(Sample) \
-                    .filter(Sample.sample_name.in_(required_ids)) \
-                    .filter(AllelesSample.hap == 'geno') \
-                    .distinct().count()
-
-                if a.similar is not None and a.similar != '':
-                    sims = a.similar.split(', ')
-                    for sim in sims:
-                        sim = sim.replace('|', '')
-                        appearances += session.query(AllelesSample.patient_id) \
-                            .join(Allele) \
-                            .filter(AllelesSample.hap == 'geno') \
-                            .filter(Allele.name.ilike(sim)) \
-                            .distinct().count()
-
-                required_names.append(a.name)
-                appears[a.name] = appearances
-
-        for r in res:
-            if len(required_names) == 0 or r.name in required_names:
-                s = r._asdict()
-
-                if len(required_names) > 0:
-                    s['appears'] = appears[r.name]
-
-                for k, v in s.items():
-                    if k == 'similar' and v is not None:
-                        s[k] = v.replace('|', '')
-                s['dataset'] = dset
-
-                if 'igsnper_plot_path' in s and s['igsnper_plot_path'] is not None and len(s['igsnper_plot_path']) > 0:
-                    s['igsnper_plot_path'] = '/'.join(
-                        [app.config['BACKEND_LINK'], 'static/study_data/VDJbase/samples', species, dset,
-                         s['igsnper_plot_path']])
-                else:
-                    s['igsnper_plot_path'] = ''
+        for r in (query.yield_per(batch) if batch else query.all()):
+            yield vdjbase_sequence_row(r, species, dset, appears)
+
+    if stream:
+        return iter_datasets(lambda session, dset: dataset_sequence_rows(session, dset, EXPORT_BATCH), vdjbase_providers(species, datasets))
 
-                ret.append(s)
+    def dataset_sequences(session, dset):
+        return list(dataset_sequence_rows(session, dset))
+
+    ret = []
+    for rows in map_datasets(dataset_sequences, vdjbase_providers(species, datasets)):
+        ret.extend(rows)
 
     return ret
 
 
+# Sort keys for the sequence list. Without sort specs, sequences are listed in gene order, then by allele. With a
+# sample filter, appearances are counted in the selected samples, and appears_field is the count to sort by
+
+def vdjbase_sequence_sort_keys(sort_specs, appears_field=None):
+    if not sort_specs:
+        star = func.instr(Allele.name, '*')
+        return [(case([(Gene.alpha_order.is_(None), 999)], else_=Gene.alpha_order).label('_sort_0'), False),
+                (case([(star > 0, func.substr(Allele.name, star + 1))], else_='').label('_sort_1'), False)]
+
+    filters = sequence_filters
+    if appears_field is not None:
+        filters = dict(filters, appears=dict(filters['appears'], field=appears_field))
+
+    return sort_key_columns(filters, sort_specs)
+
+
+# Return one page of sequences, sorted and paged by the database, in the same way as find_vdjbase_samples_page.
+# Returns (sequences, total_size, next_cursor, selected), where selected lists (dataset, names, appears) for all
+# sequences matching the filter, if names is set, for use in counting facets. Sequences can be sorted on any field in
+# sequence_filters that has a column, whether or not it is among the required columns
+
+def find_vdjbase_sequences_page(species, datasets, required_cols, seq_filter, sort_specs, page_number=0, page_size=None, cursor=None, names=False):
+    filter_spec, sample_id_filter, dataset_filters = parse_vdjbase_sequence_filter(seq_filter)
+    attribute_query = vdjbase_sequence_attributes(required_cols)
+    try:
+        check_sort_specs(sequence_filters, sort_specs)
+    except ValueError as e:
+        raise BadRequest(f'Bad sort: {e}')
+
+    grouped = 'notes' in required_cols or any(spec['field'] in ('notes', 'notes_count') for spec in sort_specs)
+    sort_keys = vdjbase_sequence_sort_keys(sort_specs)
+    id_keys = [(Allele.id.label('_sort_id'), False)]
+    offset = page_number * page_size if page_size and not cursor else 0
+    last = None
+
+    if len(dataset_filters) > 0:
+        apply_filter_to_list(datasets, dataset_filters)
+
+    if cursor:
+        try:
+            last = decode_keyset_cursor(cursor, datasets, sort_keys, id_keys)
+        except ValueError as e:
+            raise BadRequest(f'Bad cursor: {e}')
+
+    def dataset_page(session, dset):
+        query, appears = vdjbase_sequence_query(session, dset, attribute_query, filter_spec, sample_id_filter, grouped)
+
+        if names:
+            dataset_names = [r[0] for r in query.with_entities(Allele.name).all()]
+            count = len(dataset_names)
+        else:
+            dataset_names = None
+            count = query.count()
+
+        keys = sort_keys
+        if appears and any(spec['field'] == 'appears' for spec in sort_specs):
+            appears_table = values_table(session, 'allele_appears', appears.items())
+            query = query.outerjoin(appears_table, appears_table.c.key == Allele.name)
+            keys = vdjbase_sequence_sort_keys(sort_specs, func.coalesce(appears_table.c.value, 0))
+
+        query = query.add_columns(*[k for k, _ in keys + id_keys])
+        query = keyset_page_query(query, keys, id_keys, datasets.index(dset), last, offset + page_size + 1 if page_size else None, grouped)
+        return count, dataset_names, appears, query.all()
+
+    results = map_datasets(dataset_page, vdjbase_providers(species, datasets))
+    total_size = sum(r[0] for r in results)
+    merged, next_cursor = merge_keyset_pages([(dset, r[3]) for dset, r in zip(datasets, results)], sort_keys, id_keys, offset, page_size)
+    appears = {dset: r[2] for dset, r in zip(datasets, results)}
+    ret = [vdjbase_sequence_row(r, species, dset, appears[dset]) for dset, r in merged]
+    selected = [(dset, r[1], r[2]) for dset, r in zip(datasets, results)] if names else None
+
+    return ret, total_size, next_cursor, selected
+
+
+# For each allele present in the selected samples, count the subjects in which it was genotyped, plus the
+# subjects (in any sample) genotyped with each of the alleles listed in its 'similar' field.
+# Returns {allele name: count}, using one grouped query for each part of the count
+
+def allele_appearances(session, sample_names):
+    selected = session.query(Allele.id, Allele.name, Allele.similar)\
+        .join(AllelesSample, AllelesSample.allele_id == Allele.id)\
+        .join(Sample, Sample.id == AllelesSample.sample_id)\
+        .filter(Sample.sample_name.in_(sample_names))\
+        .distinct().all()
+
+    geno_counts = session.query(AllelesSample.allele_id, func.count(AllelesSample.patient_id.distinct()))\
+        .join(Sample, Sample.id == AllelesSample.sample_id)\
+        .filter(AllelesSample.hap == 'geno')\
+        .filter(Sample.sample_name.in_(sample_names))\
+        .group_by(AllelesSample.allele_id)\
+        .all()
+    geno_counts = {allele_id: count for allele_id, count in geno_counts}
+
+    similar_names = set()
+    for allele_id, name, similar in selected:
+        if similar:
+            for sim in similar.split(', '):
+                similar_names.add(sim.replace('|', '').lower())
+
+    similar_counts = {}
+    for chunk in chunk_list(list(similar_names), SQL_IN_CHUNK):
+        counts = session.query(func.lower(Allele.name), func.count(AllelesSample.patient_id.distinct()))\
+            .join(AllelesSample, AllelesSample.allele_id == Allele.id)\
+            .filter(AllelesSample.hap == 'geno')\
+            .filter(func.lower(Allele.name).in_(chunk))\
+            .group_by(func.lower(Allele.name))\
+            .all()
+        similar_counts.update({name: count for name, count in counts})
+
+    appears = {}
+    for allele_id, name, similar in selected:
+        appears[name] = geno_counts.get(allele_id, 0)
+        if similar:
+            for sim in similar.split(', '):
+                appears[name] += similar_counts.get(sim.replace('|', '').lower(), 0)
+
+    return appears
+
+
 @ns.route('/genotype/<string:species>/<string:sample_name>')
 class SamplesApi(Resource):
     @digby_protected()
@@ -968,10 +1314,7 @@ def find_rep_filter_params(species, datasets):
 # Test if session refers to an AIRR-seq database
 
 def is_session_airrseq(session):
-    for species in vdjbase_dbs.keys():
-        for dataset in vdjbase_dbs[species].keys():
-            if vdjbase_dbs[species][dataset] == session:
-                return True
+    return vdjbase_dbs.owns_engine(session.bind)
 
 # Apply filter params to a list of samples in the context of a specific dataset
 # wanted_genes is returned in the required search order
@@ -5,8 +5,11 @@ import datetime as dt
 from app import app
 from datetime import datetime
 from flask import Blueprint, request, jsonify, Response, send_from_directory
-from api.vdjbase.vdjbase import get_vdjbase_species, find_datasets, vdjbase_dbs, sample_info_filters, find_vdjbase_samples, rep_sample_bool_values, VDJBASE_SAMPLE_PATH
-from api.genomic.genomic import get_genomic_species, get_genomic_datasets, find_genomic_samples, ceil, genomic_sample_filters, get_genomic_db
+from api.vdjbase.vdjbase import get_vdjbase_species, find_datasets, vdjbase_dbs, sample_info_filters, find_vdjbase_samples_page, iter_vdjbase_samples, rep_sample_bool_values, VDJBASE_SAMPLE_PATH
+from api.response_encoding import dumps
+from api.stream_export import EXPORT_FORMATS, stream_rows
+from werkzeug.exceptions import BadRequest
+from api.genomic.genomic import get_genomic_species, get_genomic_datasets, find_genomic_samples_page, iter_genomic_samples, ceil, genomic_sample_filters, get_genomic_db
 from db.vdjbase_model import HaplotypesFile, SamplesHaplotype
 from db.vdjbase_airr_model import Sample as Airr_Sample
 from schema.models import *
@@ -24,25 +27,8 @@ from typing import Any, Optional, Union, get_args, get_origin, List, get_type_hi
 api_bp = Blueprint('api_v1', __name__)
 
 def custom_jsonify(obj):
-    """Custom JSON encoder for special object types."""
-
-    def encode_obj(o):
-        if isinstance(o, Enum):
-            return o.value
-        if isinstance(o, BaseModel):
-            return o.dict()
-        if isinstance(o, date):
-            return o.isoformat()
-        if isinstance(o, dict):
-            return {k: encode_obj(v) for k, v in o.items()}
-        if isinstance(o, list):
-            return [encode_obj(i) for i in o]
-        return o
-    
-    return Response(
-        json.dumps(encode_obj(obj)),
-        mimetype='application/json'
-    )
+    """JSON response for objects that may include enums, pydantic models and dates."""
+    return Response(dumps(obj), mimetype='application/json')
 
 
 """Get species list based on type."""
@@ -99,371 +85,152 @@ def get_species_datasets(type, species):
         return jsonify(error_response.dict()), 500
 
 
+# Default number of subjects returned in a page. page_size=0 returns all subjects
+SUBJECT_PAGE_SIZE = 100
+
+
+def subject_list_args():
+    """Parse the paging arguments of a subject list request. Raises ValueError if they are invalid."""
+    try:
+        page_size = int(request.args.get('page_size', SUBJECT_PAGE_SIZE))
+        page_number = int(request.args.get('page_number', 0))
+    except ValueError:
+        raise ValueError('page_size and page_number must be integers')
+
+    if page_size < 0 or page_number < 0:
+        raise ValueError('page_size and page_number must not be negative')
+
+    format = request.args.get('format', 'json')
+    if format not in ('json',) + EXPORT_FORMATS:
+        raise ValueError('format must be one of json, %s' % ', '.join(EXPORT_FORMATS))
+
+    return {
+        'page_number': page_number,
+        'page_size': page_size,
+        'cursor': request.args.get('cursor'),
+        'format': format,
+    }
+
+
 @api_bp.route('/<type>/subjects/<species>/<dataset>', methods=['GET'])
 def get_subject_datasets(type, species, dataset):
-    """Get subject datasets for a species and dataset based on type."""
-    if type == "genomic":
-        subjects_list, is_currect = get_genomic_list_subjects(species, dataset)
-        if not is_currect:
-            error_response = ErrorResponse(message=str(subjects_list))
-            return jsonify(error_response.dict()), 500
-        
-        else:
-            dataset_list = []
-            for sample in subjects_list.get('samples'):
-                subject_identifier = sample['sample_name'].split('_')[0:1]
-                subject_identifier = '_'.join(sample['sample_name'].rsplit('_', 1)[:-1])
-
-                subject_dataset_obj = SubjectDataset(id=sample['sample_id'], 
-                                                     study_name=sample['study_name'], 
-                                                     subject_identifier=subject_identifier, 
-                                                     sample_identifier=sample['sample_name'],
-                                                     dataset=sample['dataset'])
-                dataset_list.append(subject_dataset_obj)
-            subject_dataset_response_obj = SubjectDatasetResponse(subject_datasets=dataset_list)
-          
-            try:
-                return jsonify(subject_dataset_response_obj.dict()), 200
-
-            except Exception as e:
-                error_response = ErrorResponse(message=str(e))
-                return jsonify(error_response.dict()), 500
+    """Get subject datasets for a species and dataset based on type.
 
-    elif type == "airrseq":
-        subjects_list, is_currect = get_airrseq_list_subjects(species, dataset)
-        if not is_currect:
-            error_response = ErrorResponse(message=str(subjects_list))
-            return jsonify(error_response.dict()), 500
-        
-        else:
-            dataset_list = []
-            for sample in subjects_list.get('samples'):
-                subject_identifier = sample['sample_name'].split('_')[0:1]
-                subject_identifier = '_'.join(sample['sample_name'].rsplit('_', 1)[:-1])
-
-                subject_dataset_obj = SubjectDataset(id=sample['sample_name'], 
-                                                     study_name=sample['sample_name'].split('_')[0], 
-                                                     subject_identifier=sample['patient_name'], 
-                                                     sample_identifier=sample['sample_name'],
-                                                     dataset=sample['dataset'])
-                dataset_list.append(subject_dataset_obj)
-            subject_dataset_response_obj = SubjectDatasetResponse(subject_datasets=dataset_list)
-          
-            try:
-                return jsonify(subject_dataset_response_obj.dict()), 200
-
-            except Exception as e:
-                error_response = ErrorResponse(message=str(e))
-                return jsonify(error_response.dict()), 500
-
-
-def get_genomic_list_subjects(species, genomic_datasets):
-    """Get a list of genomic subjects for a species and datasets."""
-    args = {
-        "page_number": 0,
-        "page_size": 100,
-        "filter": None,
-        "sort_by": None,
-        "cols": '["sample_name","study_id"]'
-    }
+    Query parameters: page_size (default 100, 0 for all), page_number, or cursor (the next_cursor returned with the
+    previous page), and format (json, or ndjson/csv to stream every subject from the cursor onwards)
+    """
+    if type not in ('genomic', 'airrseq'):
+        error_response = ErrorResponse(message="type not exists")
+        return jsonify(error_response.dict()), 404
 
-    required_cols = json.loads(args['cols']) if 'cols' in args and args['cols'] else list(genomic_sample_filters.keys())
-
-    for col in required_cols:
-        if col not in genomic_sample_filters.keys():
-            return 'Bad filter string %s' % args['filter'], False
-
-    if 'study_name' not in required_cols:
-        required_cols = ['study_name'] + required_cols
-    if 'dataset' not in required_cols:
-        required_cols.append('dataset')
-    if 'sample_id' not in required_cols:
-        required_cols.append('sample_id')
-    if 'annotation_path' in required_cols:
-        if 'annotation_reference' not in required_cols:
-            required_cols.append('annotation_reference')
-        if 'annotation_method' not in required_cols:
-            required_cols.append('annotation_method')
-        if 'contig_bam_path' not in required_cols:
-            required_cols.append('contig_bam_path')
-
-    attribute_query = [genomic_sample_filters['sample_id']['field']]        # the query requires the first field to be from Sample
-
-    for col in required_cols:
-        if col != 'sample_id' and genomic_sample_filters[col]['field'] is not None:
-            attribute_query.append(genomic_sample_filters[col]['field'])
+    try:
+        args = subject_list_args()
+    except ValueError as e:
+        error_response = ErrorResponse(message=str(e))
+        return jsonify(error_response.dict()), 400
 
-    filter = json.loads(args['filter']) if args['filter'] else []
-    datasets = genomic_datasets.split(',')
-    ret = find_genomic_samples(attribute_query, species, datasets, filter)
+    if args['format'] in EXPORT_FORMATS:
+        args['page_size'] = 0
 
-    uniques = {}
-    for f in required_cols:
-        uniques[f] = []
-    uniques['dataset'] = datasets
+    if type == "genomic":
+        subjects_list, status = get_genomic_list_subjects(species, dataset, args)
+    else:
+        subjects_list, status = get_airrseq_list_subjects(species, dataset, args)
 
-    # special column for names by dataset
+    if status != 200:
+        error_response = ErrorResponse(message=str(subjects_list))
+        return jsonify(error_response.dict()), status
 
-    uniques['names_by_dataset'] = {}
-    filter_applied = len(filter) > 0
-    if filter_applied:
-        for dataset in uniques['dataset']:
-            uniques['names_by_dataset'][dataset] = []
+    if args['format'] in EXPORT_FORMATS:
+        return stream_rows((subject.dict() for subject in subjects_list['subjects']), args['format'], '%s_%s_subjects' % (species, dataset.replace(',', '_')))
 
-    def num_sort_key(x):
-        if x is None or x == '':
-            return -1
-        else:
-            try:
-                return float(x)
-            except:
-                return 0
-
-    def name_sort_key(name):
-        name = name.split('_')
-        for i in range(len(name)):
-            name[i] = name[i][1:].zfill(4)
-        return name
-
-    for s in ret:
-        for f in required_cols:
-            if genomic_sample_filters[f]['field'] is not None and 'no_uniques' not in genomic_sample_filters[f]:
-                el = s[f]
-                if isinstance(el, datetime):
-                    el = el.date().isoformat()
-                elif isinstance(el, str) and len(el) == 0:
-                    el = '(blank)'
-                if el not in uniques[f]:
-                    uniques[f].append(el)
-        if filter_applied:
-            uniques['names_by_dataset'][s['dataset']].append(s['sample_id'])
-
-    for f in required_cols:
-        try:
-            if 'sort' in genomic_sample_filters[f] and genomic_sample_filters[f]['sort'] == 'numeric':
-                uniques[f].sort(key=num_sort_key)
-            elif 'sort' in genomic_sample_filters[f] and genomic_sample_filters[f]['sort'] == 'underscore':
-                uniques[f].sort(key=name_sort_key)
-            else:
-                uniques[f].sort(key=lambda x: (x is None or x == '', x))
-        except:
-            pass
-
-    sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None) else []
-    if len(sort_specs) == 0:
-        sort_specs = [{'field': 'sample_identifier', 'order': 'asc'}]
-
-    for spec in sort_specs:
-        f = spec['field']
-        if f in genomic_sample_filters.keys():
-            if 'sort' in genomic_sample_filters[f] and genomic_sample_filters[f]['sort'] == 'underscore':
-                ret = sorted(ret, key=lambda x: name_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-            elif 'sort' in genomic_sample_filters[f] and genomic_sample_filters[f]['sort'] == 'numeric':
-                ret = sorted(ret, key=lambda x: num_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-            else:
-                ret = sorted(ret, key=lambda x: ((x[f] is None or x[f] == ''),  x[f]), reverse=(spec['order'] == 'desc'))
-
-    total_size = len(ret)
-
-    if args['page_size']:
-        first = (args['page_number']) * args['page_size']
-        ret = ret[first : first + args['page_size']]
+    subject_dataset_response_obj = SubjectDatasetResponse(subject_datasets=list(subjects_list['subjects']), next_cursor=subjects_list['next_cursor'])
 
-    return {
-        'samples': ret,
-        'uniques': uniques,
-        'total_items': total_size,
-        'page_size': args['page_size'],
-        'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1
-    }, True
-
-
-def get_airrseq_list_subjects(species, dataset):
-    """Get a list of AIRR-seq subjects for a species and dataset."""
-    if species not in vdjbase_dbs or set(dataset.split(',')).difference(set(vdjbase_dbs[species])):
-        return list()
-
-    args = {
-        "page_number": 0,
-        "page_size": 100,
-        "filter": None,
-        "sort_by": None,
-        "cols": '["sample_name","patient_name"]'
-    }
+    try:
+        return custom_jsonify(subject_dataset_response_obj.dict()), 200
 
-    required_cols = json.loads(args['cols']) if args['cols'] else list(sample_info_filters.keys())
-    if 'sample_name' not in required_cols:
-        required_cols.append('sample_name')
-    if 'dataset' not in required_cols:
-        required_cols.append('dataset')
+    except Exception as e:
+        error_response = ErrorResponse(message=str(e))
+        return jsonify(error_response.dict()), 500
 
-    for col in required_cols:
-        if col not in sample_info_filters.keys():
-            return 'Bad filter string %s' % args['filter'], False
 
-    if 'genotype' in required_cols:                # needed to compose paths to files
-        for field in ('patient_name', 'study_name'):
-            if field not in required_cols:
-                required_cols.append(field)
-        required_cols.append('genotypes')
-        required_cols.append('genotype_stats')
-        required_cols.append('genotype_report')
+def genomic_subject(sample):
+    subject_identifier = '_'.join(sample['sample_name'].rsplit('_', 1)[:-1])
 
-    attribute_query = [sample_info_filters['sample_id']['field']]        # the query requires the first field to be from Sample
+    return SubjectDataset(id=sample['sample_id'],
+                          study_name=sample['study_name'],
+                          subject_identifier=subject_identifier,
+                          sample_identifier=sample['sample_name'],
+                          dataset=sample['dataset'])
 
-    for col in required_cols:
-        if col != 'sample_id' and sample_info_filters[col]['field'] is not None:
-            attribute_query.append(sample_info_filters[col]['field'])
 
-    attribute_query.append(Airr_Sample.id)
+def airrseq_subject(sample):
+    return SubjectDataset(id=sample['sample_name'],
+                          study_name=sample['sample_name'].split('_')[0],
+                          subject_identifier=sample['patient_name'],
+                          sample_identifier=sample['sample_name'],
+                          dataset=sample['dataset'])
 
-    filter = json.loads(args['filter']) if args['filter'] else []
-    ret = find_vdjbase_samples(attribute_query, species, dataset.split(','), filter)
 
-    total_size = len(ret)
+# The subject lists return (result, HTTP status). On error, the result is the error message
 
-    uniques = {}
+def get_genomic_list_subjects(species, genomic_datasets, args):
+    """Get a page of genomic subjects for a species and datasets, sorted by sample name and paged in the database.
+    Only the columns used in the response are fetched. In streaming formats, subjects are returned as a generator."""
+    datasets = genomic_datasets.split(',')
 
-    for f in required_cols:
-        uniques[f] = []
+    if species not in get_genomic_species() or any(get_genomic_db(species, d) is None for d in datasets):
+        return 'Bad species or dataset name', 404
 
-    uniques['dataset'] = dataset.split(',')
+    attribute_query = [genomic_sample_filters['sample_id']['field'], genomic_sample_filters['study_name']['field'], genomic_sample_filters['sample_name']['field']]
+    sort_specs = [{'field': 'sample_name', 'order': 'asc'}]
 
-    # special column for names by dataset
+    try:
+        if args['format'] in EXPORT_FORMATS:
+            rows = iter_genomic_samples(attribute_query, species, datasets, [], sort_specs, args['cursor'])
+            return {
+                'subjects': (genomic_subject(s) for s in rows),
+                'next_cursor': None,
+            }, 200
 
-    uniques['names_by_dataset'] = {}
-    filter_applied = len(filter) > 0
-    if filter_applied:
-        for dataset in uniques['dataset']:
-            uniques['names_by_dataset'][dataset] = []
+        ret, total_size, next_cursor, _, _ = find_genomic_samples_page(attribute_query, species, datasets, [], sort_specs, args['page_number'], args['page_size'], args['cursor'])
+    except BadRequest as e:
+        return e.description, 400
 
-    for s in ret:
-        for f in required_cols:
-            if sample_info_filters[f]['field'] is not None and 'no_uniques' not in sample_info_filters[f]:
-                el = s[f]
-                if isinstance(el, (dt.datetime, dt.date)):
-                    el = el.date().isoformat()
-                elif isinstance(el, bool):
-                    if f in rep_sample_bool_values:
-                        el = rep_sample_bool_values[f][0 if el else 1]
-                if (not isinstance(el, str) or len(el) > 0) and el not in uniques[f]:
-                    uniques[f].append(el)
-                if (sample_info_filters[f]['field'].type.python_type is str) and len(el) == 0 and '(blank)' not in uniques[f]:
-                    uniques[f].append('(blank)')
+    return {
+        'subjects': [genomic_subject(s) for s in ret],
+        'next_cursor': next_cursor,
+    }, 200
 
-        if filter_applied:
-            uniques['names_by_dataset'][s['dataset']].append(s['sample_name'])
 
-    def name_sort_key(name):
-        name = name.split('_')
-        for i in range(len(name)):
-            name[i] = name[i][1:].zfill(4)
-        return name
+def get_airrseq_list_subjects(species, dataset, args):
+    """Get a page of AIRR-seq subjects for a species and dataset, sorted by sample name and paged in the database.
+    In streaming formats, subjects are returned as a generator."""
+    datasets = dataset.split(',')
 
-    def num_sort_key(x):
-        if x is None or x == '':
-            return -1
-        else:
-            try:
-                return float(x)
-            except:
-                return 0
-
-    for f in required_cols:
-        try:
-            if 'sort' in sample_info_filters[f] and sample_info_filters[f]['sort'] == 'underscore':
-                uniques[f].sort(key=name_sort_key)
-            elif 'sort' in sample_info_filters[f] and sample_info_filters[f]['sort'] == 'numeric':
-                uniques[f].sort(key=num_sort_key)
-            elif f != 'names_by_dataset':
-                uniques[f].sort(key=lambda x: (x is None or x == '', x))
-        except:
-            pass
-
-    if 'haplotypes' in required_cols:
-        uniques['haplotypes'] = []
-        for dset in dataset.split(','):
-            session = vdjbase_dbs[species][dset].session
-            haplotypes = session.query(HaplotypesFile.by_gene_s).distinct().order_by(HaplotypesFile.by_gene_s).all()
-            x = [(h[0]) for h in haplotypes]
-            uniques['haplotypes'].extend(x)
-        uniques['haplotypes'] = list(set(uniques['haplotypes']))
-
-    sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None) else []
-    if len(sort_specs) == 0:
-        sort_specs = [{'field': 'name', 'order': 'asc'}]
-
-    for spec in sort_specs:
-        f = spec['field']
-        if f in sample_info_filters.keys():
-            if 'sort' in sample_info_filters[f] and sample_info_filters[f]['sort'] == 'underscore':
-                ret = sorted(ret, key=lambda x: name_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-            elif 'sort' in sample_info_filters[f] and sample_info_filters[f]['sort'] == 'numeric':
-                ret = sorted(ret, key=lambda x: num_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-            else:
-                ret = sorted(ret, key=lambda x: ((x[f] is None or x[f] == ''), x[f]), reverse=(spec['order'] == 'desc'))
-
-    if args['page_size']:
-        first = (args['page_number']) * args['page_size']
-        ret = ret[first:first + args['page_size']]
-
-    for rec in ret:
-        for k, v in rec.items():
-            if isinstance(v, (dt.datetime, dt.date)):
-                rec[k] = v.date().isoformat()
-            elif isinstance(v, decimal.Decimal):
-                rec[k] = '%0.2f' % v
-
-    if 'genotypes' in required_cols:
-        for r in ret:
-            r['genotypes'] = {}
-            r['genotypes']['analysis'] = json.dumps({'species': species, 'repSeqs': [r['dataset']], 'name': r['sample_name'], 'sort_order': 'Locus'})
-
-            r['genotypes']['path'] = app.config['BACKEND_LINK']
-            sp = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset']]) + '/'
-            r['genotypes']['tigger'] = sp + r['genotype'].replace('samples', '') if r['genotype_stats'] else ''
-            r['genotypes']['ogrdbstats'] = sp + r['genotype_stats'].replace('samples', '') if r['genotype_stats'] else ''
-            r['genotypes']['ogrdbplot'] = sp + r['genotype_report'].replace('samples', '') if r['genotype_report'] else ''
-            del r['genotype_stats']
-            del r['genotype_report']
-
-            session = vdjbase_dbs[species][r['dataset']].session
-            igsnper_path = session.query(Airr_Sample.igsnper_plot_path, Airr_Sample.genotype_report).filter(Airr_Sample.sample_name == r['sample_name']).one_or_none()
-
-            if igsnper_path is not None and igsnper_path[0] is not None:
-                r['genotypes']['igsnper'] = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset'], igsnper_path[0]])
-            else:
-                r['genotypes']['igsnper'] = ''
-
-    if 'haplotypes' in required_cols:
-        for r in ret:
-            session = vdjbase_dbs[species][r['dataset']].session
-            haplotypes = session.query(Airr_Sample.sample_name, func.group_concat(HaplotypesFile.by_gene_s), func.group_concat(HaplotypesFile.file))
-            h = haplotypes.filter(Airr_Sample.sample_name == r['sample_name'])\
-                .join(SamplesHaplotype, SamplesHaplotype.samples_id == Airr_Sample.id)\
-                .join(HaplotypesFile, HaplotypesFile.id == SamplesHaplotype.haplotypes_file_id)\
-                .one_or_none()
-            if h is not None and h[1] is not None:
-                r['haplotypes'] = {}
-                r['haplotypes']['path'] = app.config['BACKEND_LINK']
-                for (hap, filename) in zip(h[1].split(','), h[2].split(',')):
-                    filename = filename.replace('samples/', '')
-                    fp = os.path.join(VDJBASE_SAMPLE_PATH, species, r['dataset'], filename)
-                    sp = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset'], filename])
-                    if isfile(fp):
-                        r['haplotypes'][hap] = {}
-                        r['haplotypes'][hap]['analysis'] = json.dumps({'species': species, 'repSeqs': [r['dataset']], 'name': r['sample_name'], 'hap_gene': hap, 'sort_order' : 'Locus'})
-                        r['haplotypes'][hap]['rabhit'] = sp
-            else:
-                r['haplotypes'] = ''
+    if species not in vdjbase_dbs or set(datasets).difference(set(vdjbase_dbs[species])):
+        return 'Bad species or dataset name', 404
+
+    attribute_query = [sample_info_filters['sample_name']['field'], sample_info_filters['patient_name']['field'], Airr_Sample.id]
+    sort_specs = [{'field': 'sample_name', 'order': 'asc'}]
+
+    try:
+        if args['format'] in EXPORT_FORMATS:
+            rows = iter_vdjbase_samples(attribute_query, species, datasets, [], sort_specs, args['cursor'])
+            return {
+                'subjects': (airrseq_subject(s) for s in rows),
+                'next_cursor': None,
+            }, 200
+
+        ret, total_size, next_cursor = find_vdjbase_samples_page(attribute_query, species, datasets, [], sort_specs, args['page_number'], args['page_size'], args['cursor'])
+    except BadRequest as e:
+        return e.description, 400
 
     return {
-        'samples': ret,
-        'uniques': uniques,
-        'total_items': total_size,
-        'page_size': args['page_size'],
-        'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1
-    }, True
+        'subjects': [airrseq_subject(s) for s in ret],
+        'next_cursor': next_cursor,
+    }, 200
+
 
 @api_bp.route('/<type>/sample_genotype/<species>/<dataset>/<subject>/<sample>', methods=['GET'])
 def get_sample_genotype(type, species, dataset, subject, sample):
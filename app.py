@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, flash, Blueprint, redirect, url_for, send_from_directory
+from flask import Flask, render_template, request, flash, Blueprint, redirect, url_for, send_from_directory, g
 from flask_migrate import Migrate
 from flask_security import Security, SQLAlchemyUserDatastore, login_required
 from flask_mail import Mail
@@ -6,9 +6,15 @@ from flask_bootstrap import Bootstrap
 from flask_admin import Admin
 from flask_cors import CORS
 import os
+import time
 import custom_logging
+import metrics
 from reverse_proxied import ReverseProxied
-from db.vdjbase_db import study_data_db_init, manage_airrseq, airrseq_import, airrseq_copy, airrseq_remove
+from db.dataset_fan_out import init_dataset_executor
+from api.reports.r_worker_pool import init_r_worker_pool
+from api.response_encoding import compress_response
+from db.query_stats import set_slow_query_threshold, start_query_stats, finish_query_stats, current_stats, stats_listeners
+from db.vdjbase_db import study_data_db_init, upgrade_published_datasets, release_sessions, manage_airrseq, airrseq_import, airrseq_copy, airrseq_remove
 import yaml
 from flask_security.utils import hash_password
 from flask_sqlalchemy import SQLAlchemy
@@ -16,6 +22,7 @@ from flask_swagger_ui import get_swaggerui_blueprint
 
 
 from extensions import celery
+from celery.signals import task_prerun
 
 sql_db = None
 
@@ -44,11 +51,43 @@ if 'STATIC_PATH' not in app.config:
 if 'OUTPUT_PATH' not in app.config:
     app.config['OUTPUT_PATH'] = os.path.join(app.config['STATIC_PATH'], 'output')
 
+# report results are cached for up to REPORT_CACHE_MAX_AGE seconds, in up to REPORT_CACHE_MAX_SIZE bytes of output
+if 'REPORT_CACHE' not in app.config:
+    app.config['REPORT_CACHE'] = True
+
+if 'REPORT_CACHE_MAX_AGE' not in app.config:
+    app.config['REPORT_CACHE_MAX_AGE'] = 7 * 24 * 3600
+
+if 'REPORT_CACHE_MAX_SIZE' not in app.config:
+    app.config['REPORT_CACHE_MAX_SIZE'] = 2 * 1024 * 1024 * 1024
+
 if 'UPLOAD_PATH' not in app.config:
     app.config['UPLOAD_PATH'] = os.path.join(app.config['BASE_PATH'], 'uploads')
 
 app.config['R_SCRIPT_PATH'] = os.path.join(app.config['BASE_PATH'], 'api', 'reports', 'R_scripts')
 
+# report scripts are run by a pool of R_WORKERS persistent R processes in each process that runs reports (0 to run
+# each script with Rscript). Workers are replaced after R_WORKER_MAX_JOBS scripts, and a script is stopped if it
+# runs for longer than R_WORKER_TIMEOUT seconds
+if 'R_WORKERS' not in app.config:
+    app.config['R_WORKERS'] = 1
+
+if 'R_WORKER_MAX_JOBS' not in app.config:
+    app.config['R_WORKER_MAX_JOBS'] = 50
+
+if 'R_WORKER_TIMEOUT' not in app.config:
+    app.config['R_WORKER_TIMEOUT'] = 300
+
+# data frames are passed to the R workers as 'feather' if they can read it, otherwise as 'tsv'
+if 'R_INTERCHANGE' not in app.config:
+    app.config['R_INTERCHANGE'] = 'feather'
+
+# the sequence search report aligns candidate sequences in this many processes (1 to align them in the report worker)
+if 'SEQUENCE_SEARCH_PROCESSES' not in app.config:
+    app.config['SEQUENCE_SEARCH_PROCESSES'] = 4
+
+init_r_worker_pool(app.config['R_SCRIPT_PATH'], app.config['R_WORKERS'], app.config['R_WORKER_MAX_JOBS'], app.config['R_WORKER_TIMEOUT'])
+
 if 'R_LIBS' not in os.environ or os.environ['R_LIBS'] is None or len(os.environ['R_LIBS']) < 1:
     os.environ['R_LIBS'] = app.config['R_SCRIPT_PATH']
 
@@ -64,8 +103,131 @@ else:
 mail = Mail(app)
 custom_logging.init_logging(app, mail)
 
-vdjbase_dbs = study_data_db_init(os.path.join(app.config['STATIC_PATH'], 'study_data','VDJbase','db'))
-genomic_dbs = study_data_db_init(os.path.join(app.config['STATIC_PATH'], 'study_data', 'Genomic', 'db'))
+# responses larger than this are compressed, if the client accepts it
+if 'COMPRESS_MIN_SIZE' not in app.config:
+    app.config['COMPRESS_MIN_SIZE'] = 2048
+
+
+@app.after_request
+def compress(response):
+    return compress_response(response, app.config['COMPRESS_MIN_SIZE'])
+
+
+# dataset queries slower than this (in ms) are logged with their query plan (0 to disable)
+if 'SLOW_QUERY_MS' not in app.config:
+    app.config['SLOW_QUERY_MS'] = 500
+
+set_slow_query_threshold(app.config['SLOW_QUERY_MS'])
+
+
+# Record the dataset queries made by each request. The count and execute time (which excludes the time spent
+# fetching rows: see query_stats.py) are returned in headers, which cover the queries made before the response is
+# returned, so not those made while a streamed response is sent
+
+@app.before_request
+def start_request_query_stats():
+    start_query_stats(request.endpoint)
+
+
+@app.after_request
+def add_query_stats_headers(response):
+    stats = current_stats.get()
+    if stats is not None:
+        response.headers['X-DB-Query-Count'] = str(stats.count)
+        response.headers['X-DB-Execute-Time'] = '%.1f' % (stats.elapsed * 1000)
+        response.headers.add('Server-Timing', 'db-execute;dur=%.1f;desc="%d queries, excluding fetch"' % (stats.elapsed * 1000, stats.count))
+    return response
+
+
+@app.teardown_request
+def finish_request_query_stats(exception):
+    stats = finish_query_stats()
+    if stats is not None and stats.count:
+        app.logger.debug('%s %s: %s' % (request.method, request.path, stats.summary()))
+
+
+if 'DATASET_QUERY_THREADS' not in app.config:
+    app.config['DATASET_QUERY_THREADS'] = 4
+
+init_dataset_executor(app.config['DATASET_QUERY_THREADS'])
+
+# number of datasets of each kind that each worker keeps open (0 for no limit)
+if 'DATASET_CACHE_SIZE' not in app.config:
+    app.config['DATASET_CACHE_SIZE'] = 32
+
+# interval in seconds at which each worker checks for datasets published by other workers (0 to disable)
+if 'DATASET_RELOAD_INTERVAL' not in app.config:
+    app.config['DATASET_RELOAD_INTERVAL'] = 5
+
+# upgrade the schema of any published AIRR-seq datasets that need it when the worker starts. Datasets that have not
+# been upgraded are not served
+if 'UPGRADE_DATASETS_AT_START' not in app.config:
+    app.config['UPGRADE_DATASETS_AT_START'] = True
+
+if app.config['UPGRADE_DATASETS_AT_START']:
+    for dataset in upgrade_published_datasets(os.path.join(app.config['STATIC_PATH'], 'study_data', 'VDJbase', 'db')):
+        app.logger.info('Upgraded the schema of dataset %s' % dataset)
+
+vdjbase_dbs = study_data_db_init(os.path.join(app.config['STATIC_PATH'], 'study_data','VDJbase','db'), app.config['DATASET_CACHE_SIZE'], app.config['DATASET_RELOAD_INTERVAL'])
+genomic_dbs = study_data_db_init(os.path.join(app.config['STATIC_PATH'], 'study_data', 'Genomic', 'db'), app.config['DATASET_CACHE_SIZE'], app.config['DATASET_RELOAD_INTERVAL'])
+
+
+@app.before_request
+def refresh_datasets():
+    vdjbase_dbs.refresh_if_due()
+    genomic_dbs.refresh_if_due()
+
+
+@task_prerun.connect
+def refresh_task_datasets(**kwargs):
+    refresh_datasets()
+
+
+# metrics of the web and Celery worker processes are combined through files in this directory
+if 'METRICS_DIR' not in app.config:
+    app.config['METRICS_DIR'] = os.path.join(app.config['BASE_PATH'], 'metrics')
+
+metrics.init_metrics(app.config['METRICS_DIR'])
+stats_listeners.append(metrics.record_queries)
+
+
+def collect_dataset_metrics():
+    for kind, dbs in (('vdjbase', vdjbase_dbs), ('genomic', genomic_dbs)):
+        stats = dbs.stats()
+        metrics.dataset_cache_lookups.set(kind, 'hit', value=stats['hits'])
+        metrics.dataset_cache_lookups.set(kind, 'miss', value=stats['misses'])
+        metrics.datasets_open.set(kind, value=stats['open'])
+
+
+metrics.collectors.append(collect_dataset_metrics)
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.http_in_flight.inc()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.http_request_duration.observe(route, request.method, response.status_code,
+                                              value=time.perf_counter() - g.request_start)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exception):
+    if g.pop('request_start', None) is not None:
+        metrics.http_in_flight.dec()
+    metrics.flush_metrics()
+
+
+@app.teardown_appcontext
+def release_dataset_sessions(exception):
+    release_sessions(vdjbase_dbs, genomic_dbs)
+
 
 admin_obj = Admin(app, template_mode='bootstrap3')
 
@@ -145,7 +307,8 @@ def static(path):
     else:
         return send_from_directory(app.config['STATIC_PATH'], path)
 
-@digby_protected()
+# static files change without a dataset being published, so are not answered from the dataset validators
+@digby_protected(conditional=False)
 def send_from_gff(path):
     return send_from_directory(app.config['STATIC_PATH'], path)
 
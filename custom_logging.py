@@ -4,12 +4,19 @@
 import logging.handlers
 from flask import request
 from flask import has_request_context
+from db.query_stats import current_stats
 import sys
 from mail_log_handler import FlaskMailLogHandler
 from rabbit_log import FlaskRabbitLogHandler
 
+# Records are given the dataset query count and time of the current request or task, if these are being recorded
+
 class RequestFormatter(logging.Formatter):
     def format(self, record):
+        stats = current_stats.get()
+        if not hasattr(record, 'db_queries'):
+            record.db_queries = stats.count if stats is not None else 0
+            record.db_time = stats.elapsed if stats is not None else 0.0
         if has_request_context():
             record.url = request.url
             record.remote_addr = request.remote_addr
@@ -23,7 +30,7 @@ class RequestFormatter(logging.Formatter):
 formatter = RequestFormatter(
     '--------------------------------\n'
     '[%(asctime)s] %(levelname)s (%(module)s) :\n'
-    '%(remote_addr)s %(url)s\n%(message)s\n'
+    '%(remote_addr)s %(url)s (db: %(db_queries)d queries, %(db_time).3fs executing)\n%(message)s\n'
 )
 
 
@@ -0,0 +1,56 @@
+# Run a per-dataset query against several datasets concurrently
+#
+# Each dataset is a separate SQLite file, so the queries for a multi-dataset listing are independent of each other.
+# They are run on a small, bounded thread pool, each worker using its own session on the dataset's engine, and the
+# results are returned in the order in which the datasets were given, so that merges downstream are deterministic.
+#
+# Workers must not themselves call map_datasets, as they could then wait on a pool that they are occupying. Each
+# worker runs in a copy of the caller's context, so that context variables such as the request's query statistics
+# are visible to it.
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+dataset_executor = None
+
+
+def init_dataset_executor(threads):
+    global dataset_executor
+
+    if dataset_executor is not None:
+        dataset_executor.shutdown(wait=False)
+
+    dataset_executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='dataset') if threads > 1 else None
+
+
+def run_in_session(provider, fn, dset):
+    session = provider.new_session()
+    try:
+        return fn(session, dset)
+    finally:
+        session.close()
+
+
+# Call fn(session, dset) for each (dset, provider) in providers, and return the results as a list in the same order.
+# Falls back to running serially if the pool is disabled or there is only one dataset
+
+def map_datasets(fn, providers):
+    if dataset_executor is None or len(providers) < 2:
+        return [run_in_session(provider, fn, dset) for dset, provider in providers]
+
+    futures = [dataset_executor.submit(contextvars.copy_context().run, run_in_session, provider, fn, dset)
+               for dset, provider in providers]
+    return [future.result() for future in futures]
+
+
+# Generator over the results of fn(session, dset) for each (dset, provider) in providers, in order. fn should
+# itself be a generator. The datasets are read one at a time, each with its own session, so that rows can be
+# streamed without holding the whole result
+
+def iter_datasets(fn, providers):
+    for dset, provider in providers:
+        session = provider.new_session()
+        try:
+            yield from fn(session, dset)
+        finally:
+            session.close()
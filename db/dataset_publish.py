@@ -0,0 +1,111 @@
+# Publication of datasets
+#
+# A published dataset directory, such as db/<species>/<dataset>, is a symbolic link to a versioned directory alongside
+# it, db/<species>/.<dataset>@<version>. A new version is built in full in its own directory, and is then published by
+# replacing the link in a single rename, so that readers in any process see either the old version or the new one,
+# never a partial copy.
+#
+# Workers only notice a new version when they next rescan the datasets (every DATASET_RELOAD_INTERVAL seconds), and
+# reports already reading the old version may run for up to the report time limit, so a superseded version is still
+# in use for a while after it is replaced. When a version is superseded, its directory's modification time is set to
+# the time at which it was replaced. The most recent VERSIONS_KEPT versions are kept; older ones are removed by a
+# later publication once they have been superseded for at least PRUNE_AFTER seconds.
+#
+# Directories published before this scheme was introduced are real directories rather than links. They are moved
+# to a versioned name when the dataset is next published or removed.
+
+import os
+import shutil
+import time
+from datetime import datetime
+from os.path import join, dirname, basename, islink, isdir
+
+VERSION_SEPARATOR = '@'
+VERSIONS_KEPT = 2
+
+# Comfortably more than the reload interval plus the time limit of a report
+PRUNE_AFTER = 15 * 60
+
+
+def new_version():
+    return datetime.now().strftime('%Y%m%d%H%M%S%f')
+
+
+def versioned_dir(link_path, version):
+    return join(dirname(link_path), '.%s%s%s' % (basename(link_path), VERSION_SEPARATOR, version))
+
+
+def version_dirs(link_path):
+    prefix = '.%s%s' % (basename(link_path), VERSION_SEPARATOR)
+    parent = dirname(link_path)
+    if not isdir(parent):
+        return []
+    return sorted(join(parent, name) for name in os.listdir(parent) if name.startswith(prefix))
+
+
+# Move a directory published before links were introduced to a versioned name. Returns its new path
+
+def move_legacy_dir(link_path):
+    if isdir(link_path) and not islink(link_path):
+        target = versioned_dir(link_path, new_version())
+        os.rename(link_path, target)
+        return target
+    return None
+
+
+# Create a new, empty, versioned directory for link_path, in which the next version can be built
+
+def create_version_dir(link_path):
+    os.makedirs(dirname(link_path), exist_ok=True)
+    target = versioned_dir(link_path, new_version())
+    os.mkdir(target)
+    return target
+
+
+# Point link_path at target, atomically replacing any previous version, then remove the versions that are no longer
+# needed
+
+def publish_dir(link_path, target):
+    # a legacy directory can't be replaced by a rename, so it is briefly unpublished while it is moved
+    previous = move_legacy_dir(link_path)
+    if previous is None and islink(link_path):
+        previous = os.path.realpath(link_path)
+
+    temp_link = join(dirname(link_path), '.%s.link' % basename(link_path))
+    if islink(temp_link):
+        os.unlink(temp_link)
+    os.symlink(basename(target), temp_link)
+    os.replace(temp_link, link_path)
+
+    # record when the previous version was superseded
+    if previous is not None and isdir(previous):
+        os.utime(previous)
+
+    prune_versions(link_path)
+
+
+# Remove the versions, other than the most recent keep, that were superseded at least prune_after seconds ago
+
+def prune_versions(link_path, keep=VERSIONS_KEPT, prune_after=PRUNE_AFTER):
+    current = os.path.realpath(link_path)
+    versions = [v for v in version_dirs(link_path) if os.path.realpath(v) != current]
+    cutoff = time.time() - prune_after
+
+    for old in versions[:max(len(versions) - (keep - 1), 0)]:
+        try:
+            if os.path.getmtime(old) < cutoff:
+                shutil.rmtree(old, ignore_errors=True)
+        except OSError:
+            pass
+
+
+# Unpublish the dataset at link_path and remove all of its versions
+
+def unpublish_dir(link_path):
+    if islink(link_path):
+        os.unlink(link_path)
+    elif isdir(link_path):
+        shutil.rmtree(link_path, ignore_errors=True)
+
+    for version in version_dirs(link_path):
+        shutil.rmtree(version, ignore_errors=True)
@@ -0,0 +1,283 @@
+# Registry of the datasets served by the app
+#
+# Datasets are discovered at startup by a directory scan, which reads only each dataset's description and content
+# version. A dataset's ContentProvider is opened when the dataset is first used, and the most recently used
+# providers are kept open, up to a configurable number, so that the engines, caches and file handles held by each
+# worker stay bounded as the catalogue grows.
+#
+# The registry is a dict of species -> SpeciesDatasets. SpeciesDatasets is a mapping with the same keys as the dicts
+# it replaces - each dataset name, and <dataset>_description - so that vdjbase_dbs[species][dataset] still returns a
+# ContentProvider, and vdjbase_dbs[species][dataset + '_description'] the description. Iterating over the keys, or
+# testing membership, does not open any datasets.
+#
+# Datasets are published by switching a link to a new directory (see dataset_publish), possibly by another worker.
+# Each worker rescans the catalogue at most once every check_interval seconds, and replaces the entries of datasets
+# whose content version has changed. Providers that are replaced or evicted are retired rather than closed: they are
+# no longer handed out, and are disposed once the sessions that were using them have returned their connections.
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+DESCRIPTION_SUFFIX = '_description'
+
+
+class DatasetEntry:
+    def __init__(self, species, name, path, description, version, modified):
+        self.species = species
+        self.name = name
+        self.path = path
+        self.description = description
+        self.version = version
+        self.modified = modified
+
+
+class SpeciesDatasets(MutableMapping):
+    def __init__(self, registry, species):
+        self.registry = registry
+        self.species = species
+        self.entries = {}
+
+    def description_key(self, key):
+        if isinstance(key, str) and key.endswith(DESCRIPTION_SUFFIX) and key[:-len(DESCRIPTION_SUFFIX)] in self.entries:
+            return key[:-len(DESCRIPTION_SUFFIX)]
+        return None
+
+    def __getitem__(self, key):
+        name = self.description_key(key)
+        if name is not None:
+            return self.entries[name].description
+        return self.registry.provider(self.species, key)
+
+    def __setitem__(self, key, value):
+        name = self.description_key(key)
+        if name is not None:
+            self.entries[name].description = value
+        elif isinstance(value, DatasetEntry):
+            self.entries[key] = value
+        else:
+            raise TypeError('datasets must be added to the registry with DatasetRegistry.add')
+
+    def __delitem__(self, key):
+        if self.description_key(key) is None:
+            self.registry.remove(self.species, key)
+
+    def __contains__(self, key):
+        return key in self.entries or self.description_key(key) is not None
+
+    def __iter__(self):
+        return iter(sorted(list(self.entries) + [name + DESCRIPTION_SUFFIX for name in self.entries]))
+
+    def __len__(self):
+        return 2 * len(self.entries)
+
+    # Names of the datasets, without the description keys
+    def names(self):
+        return sorted(self.entries)
+
+
+# opener(entry) returns a new ContentProvider for the entry. capacity is the number of providers to keep open,
+# or 0 for no limit. scanner() returns {(species, name): (path, version, modified)} for the datasets currently
+# published, and describe(path) returns a dataset's description
+
+class DatasetRegistry(dict):
+    def __init__(self, opener, capacity=0, scanner=None, describe=None, check_interval=0):
+        super().__init__()
+        self.opener = opener
+        self.capacity = capacity
+        self.scanner = scanner
+        self.describe = describe
+        self.check_interval = check_interval
+        self.last_check = time.monotonic()
+        self.open_providers = OrderedDict()
+        self.retired = []
+        self.lock = threading.RLock()
+        self.opening = {}
+        self.used = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    # Add a dataset, or replace it if it is already present. A provider opened on the old entry is retired
+
+    def add(self, species, name, path, description, version, modified):
+        with self.lock:
+            provider = self.open_providers.pop((species, name), None)
+            if provider is not None:
+                self.retired.append(provider)
+
+            if species not in self:
+                self[species] = SpeciesDatasets(self, species)
+
+            entry = DatasetEntry(species, name, path, description, version, modified)
+            self[species][name] = entry
+
+        self.drain()
+        return entry
+
+    def remove(self, species, name):
+        with self.lock:
+            provider = self.open_providers.pop((species, name), None)
+            if species in self:
+                self[species].entries.pop(name, None)
+            if provider is not None:
+                self.retired.append(provider)
+
+        self.drain()
+
+    def entry(self, species, name):
+        return self[species].entries[name]
+
+    # Order the species with Human first, followed by the others alphabetically
+    def sort_species(self):
+        species = sorted(self.items(), key=lambda kv: 'aaaaa' if kv[0] == 'Human' else kv[0])
+        self.clear()
+        self.update(species)
+
+    # The provider for a dataset, opening it if necessary. The provider is recorded as used by the calling thread,
+    # so that its session can be released at the end of the request, even if it has been retired in the meantime.
+    # A dataset is opened outside the registry lock, so that a slow open holds up only the requests for that dataset
+
+    def provider(self, species, name):
+        key = (species, name)
+        provider = self.cached_provider(key)
+
+        if provider is None:
+            with self.opening_lock(key):
+                provider = self.cached_provider(key)
+                while provider is None:
+                    with self.lock:
+                        entry = self[species].entries[name]
+                    provider = self.add_provider(key, entry, self.opener(entry))
+
+        if not hasattr(self.used, 'providers'):
+            self.used.providers = set()
+        self.used.providers.add(provider)
+
+        return provider
+
+    # The open provider for a dataset, or None if it is not open. Raises KeyError if there is no such dataset
+
+    def cached_provider(self, key):
+        species, name = key
+
+        with self.lock:
+            if name not in self[species].entries:
+                raise KeyError(name)
+            provider = self.open_providers.get(key)
+            if provider is not None:
+                self.open_providers.move_to_end(key)
+                self.hits += 1
+            return provider
+
+    # The lock held while a dataset is being opened, so that it is opened only once
+
+    def opening_lock(self, key):
+        with self.lock:
+            return self.opening.setdefault(key, threading.Lock())
+
+    # Add a provider opened on entry. If the entry was replaced or removed while the provider was being opened, the
+    # provider is retired and None is returned, so that the caller opens the current entry
+
+    def add_provider(self, key, entry, provider):
+        evicted = False
+
+        with self.lock:
+            if key[0] not in self or self[key[0]].entries.get(key[1]) is not entry:
+                self.retired.append(provider)
+                provider = None
+            else:
+                self.misses += 1
+                entry.version, entry.modified = provider.version, provider.modified
+                self.open_providers[key] = provider
+
+                while self.capacity and len(self.open_providers) > self.capacity:
+                    self.retired.append(self.open_providers.popitem(last=False)[1])
+                    self.evictions += 1
+                    evicted = True
+
+        if evicted or provider is None:
+            self.drain()
+
+        return provider
+
+    # Release the calling thread's sessions on the providers it has used
+
+    def release_sessions(self):
+        providers = getattr(self.used, 'providers', None)
+        if providers:
+            self.used.providers = set()
+            for provider in providers:
+                provider.release_session()
+
+        if self.retired:
+            self.drain()
+
+    # Dispose of the retired providers that no longer have connections checked out
+
+    def drain(self):
+        with self.lock:
+            drained = [provider for provider in self.retired if provider.db.pool.checkedout() == 0]
+            self.retired = [provider for provider in self.retired if provider not in drained]
+
+        for provider in drained:
+            provider.db.dispose()
+
+    # Bring the entries into line with the datasets currently published: add new datasets, replace those whose
+    # content version has changed, and remove those that have gone
+
+    def refresh(self):
+        published = self.scanner()
+
+        with self.lock:
+            current = {(species, name): entry for species, datasets in self.items()
+                       for name, entry in datasets.entries.items()}
+
+        for (species, name), (path, version, modified) in published.items():
+            entry = current.get((species, name))
+            if entry is None or entry.version != version or entry.path != path:
+                self.add(species, name, path, self.describe(path), version, modified)
+                if entry is not None:
+                    self.reloads += 1
+
+        for species, name in current.keys() - published.keys():
+            self.remove(species, name)
+
+        self.drain()
+
+    # Called at the start of each request and task: refresh if check_interval has passed since the last check
+
+    def refresh_if_due(self):
+        if not self.scanner or not self.check_interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_check < self.check_interval:
+                return
+            self.last_check = now
+
+        self.refresh()
+
+    # True if the engine belongs to one of the open providers
+
+    def owns_engine(self, engine):
+        with self.lock:
+            return any(provider.db is engine for provider in self.open_providers.values())
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'datasets': sum(len(datasets.entries) for datasets in self.values()),
+                'open': len(self.open_providers),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'reloads': self.reloads,
+                'retired': len(self.retired),
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
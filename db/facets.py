@@ -0,0 +1,119 @@
+# Facet ('uniques') index for the list APIs
+#
+# For each dataset and listing, the index holds the distinct values of each column, together with a bitmap of the
+# rows in which each value occurs. The index is built on first use and kept with the dataset's ContentProvider, so
+# that a request only has to merge precomputed counts. When a filter is applied, the rows that pass it are
+# converted to a bitmap, and the counts are obtained by intersection rather than by scanning the rows.
+#
+# A bitmap per value takes memory quadratic in the number of rows for columns whose values are (nearly) unique to
+# each row, such as names and sequences. Columns with more than BITMAP_MAX_VALUES distinct values are therefore
+# indexed by the value of each row instead, and are counted by walking the rows that pass the filter.
+
+
+# Returned by a value function to leave a value out of the index
+SKIP = object()
+
+BITMAP_MAX_VALUES = 64
+
+
+def positions_to_bitmap(positions, size):
+    bits = bytearray((size + 7) // 8)
+    for p in positions:
+        bits[p >> 3] |= 1 << (p & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class FacetIndex:
+    # rows: list of dicts, key_col: column holding a value unique to each row, value_fn(col, value) returns the
+    # value to index, or SKIP if the value should not be included
+
+    def __init__(self, rows, key_col, columns, value_fn):
+        self.size = len(rows)
+        self.positions = {}
+        self.bitmaps = {}
+        self.totals = {}
+        self.row_values = {}
+
+        value_positions = {col: {} for col in columns}
+
+        for i, row in enumerate(rows):
+            self.positions[row[key_col]] = i
+            for col in columns:
+                v = value_fn(col, row[col])
+                if v is not SKIP:
+                    value_positions[col].setdefault(v, []).append(i)
+
+        for col, values in value_positions.items():
+            self.totals[col] = {v: len(p) for v, p in values.items()}
+
+            if len(values) <= BITMAP_MAX_VALUES:
+                self.bitmaps[col] = {v: positions_to_bitmap(p, self.size) for v, p in values.items()}
+            else:
+                self.row_values[col] = [SKIP] * self.size
+                for v, p in values.items():
+                    for i in p:
+                        self.row_values[col][i] = v
+
+    # Return {col: {value: count}} for the requested columns, restricted to the rows with the given keys
+    # (or over all rows if keys is None)
+
+    def counts(self, columns, keys=None):
+        ret = {}
+
+        if keys is None:
+            for col in columns:
+                if col in self.totals:
+                    ret[col] = dict(self.totals[col])
+            return ret
+
+        selected = {self.positions[k] for k in keys if k in self.positions}
+        mask = None
+
+        for col in columns:
+            if col in self.bitmaps:
+                if mask is None:
+                    mask = positions_to_bitmap(selected, self.size)
+                ret[col] = {}
+                for v, bitmap in self.bitmaps[col].items():
+                    c = bin(bitmap & mask).count('1')
+                    if c:
+                        ret[col][v] = c
+            elif col in self.row_values:
+                ret[col] = {}
+                values = self.row_values[col]
+                for i in selected:
+                    if values[i] is not SKIP:
+                        ret[col][values[i]] = ret[col].get(values[i], 0) + 1
+
+        return ret
+
+
+# Return the named index for a dataset, building it if necessary. The provider's facets_lock is held while an index
+# is built, so that concurrent requests build it only once
+
+def get_facet_index(provider, name, builder):
+    index = provider.facets.get(name)
+
+    if index is None:
+        with provider.facets_lock:
+            index = provider.facets.get(name)
+            if index is None:
+                index = builder()
+                provider.facets[name] = index
+
+    return index
+
+
+# Combine the counts from several datasets
+
+def merge_facet_counts(counts_list):
+    ret = {}
+
+    for counts in counts_list:
+        for col, values in counts.items():
+            if col not in ret:
+                ret[col] = {}
+            for v, c in values.items():
+                ret[col][v] = ret[col].get(v, 0) + c
+
+    return ret
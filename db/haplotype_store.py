@@ -0,0 +1,152 @@
+# Per-dataset store of haplotype files
+#
+# Each of a dataset's haplotype files (see process_haplotypes_and_stats) is a TSV in the sample's directory. The
+# store consolidates them into a single Parquet file, with a row for each row of each file, keyed by the sample name
+# and the anchor gene of the file (HaplotypesFile.by_gene) in the columns SAMPLE_COL and ANCHOR_COL. Rows are
+# ordered by anchor gene and sample, so that a read filtered on them only touches the row groups that it needs.
+#
+# Files do not all have the same columns: the allele columns are named after the anchor gene's alleles. The columns
+# of each file are therefore recorded in the store's metadata, and a read returns the columns of the files it reads.
+# All values are held as strings, as reports have always read the files with dtype=str.
+#
+# The store is written to the dataset directory when the database is built, and is copied with the database when
+# the dataset is published. For datasets built without one, it is built on first use (see
+# ContentProvider.haplotypes).
+
+import json
+import os
+import tempfile
+
+import pandas as pd
+from db.vdjbase_model import HaplotypesFile, SamplesHaplotype
+from db.vdjbase_airr_model import Sample
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+HAPLOTYPE_STORE = 'haplotypes.parquet'
+
+SAMPLE_COL = '__sample__'
+ANCHOR_COL = '__anchor__'
+COLUMNS_KEY = b'haplotype_columns'
+
+ROW_GROUP_SIZE = 50000
+
+
+# (sample name, anchor gene, file) for each haplotype file of the dataset, or of those with the given anchor gene
+
+def haplotype_files(session, anchor=None):
+    query = session.query(Sample.sample_name, HaplotypesFile.by_gene, HaplotypesFile.file)\
+        .join(SamplesHaplotype, Sample.id == SamplesHaplotype.samples_id)\
+        .join(HaplotypesFile, SamplesHaplotype.haplotypes_file_id == HaplotypesFile.id)
+
+    if anchor is not None:
+        query = query.filter(HaplotypesFile.by_gene == anchor)
+
+    return query.all()
+
+
+def haplotype_file_path(sample_path, filename):
+    return os.path.join(sample_path, filename.replace('samples/', ''))
+
+
+# Read the given files, which are in the dataset's sample directory, sample_path. Returns a single frame holding
+# the rows of all of them, keyed as in the store, and {sample: {anchor: columns}} for the files that were found
+
+def read_haplotype_files(files, sample_path):
+    frames = []
+    columns = {}
+
+    for sample_name, anchor, filename in files:
+        if not filename:
+            continue
+
+        path = haplotype_file_path(sample_path, filename)
+
+        if not os.path.isfile(path):
+            print('Haplotype file %s is missing' % path)
+            continue
+
+        haplotype = pd.read_csv(path, sep='\t', dtype=str)
+        columns.setdefault(sample_name, {})[anchor] = list(haplotype.columns)
+        haplotype[SAMPLE_COL] = sample_name
+        haplotype[ANCHOR_COL] = anchor
+        frames.append(haplotype)
+
+    if not frames:
+        return pd.DataFrame(columns=[SAMPLE_COL, ANCHOR_COL]), columns
+
+    return pd.concat(frames, ignore_index=True, sort=False), columns
+
+
+# Write the store for the dataset open in session to store_path. The file is written alongside, then moved into
+# place, so that readers never see a partial store. Returns the number of files stored
+
+def build_haplotype_store(session, sample_path, store_path):
+    rows, columns = read_haplotype_files(haplotype_files(session), sample_path)
+
+    rows = rows.sort_values([ANCHOR_COL, SAMPLE_COL], kind='stable')
+    data_cols = [c for c in rows.columns if c not in (SAMPLE_COL, ANCHOR_COL)]
+    schema = pyarrow.schema([(c, pyarrow.string()) for c in [SAMPLE_COL, ANCHOR_COL] + data_cols])
+    table = pyarrow.Table.from_pandas(rows[schema.names], schema=schema, preserve_index=False)
+    table = table.replace_schema_metadata({COLUMNS_KEY: json.dumps(columns).encode('utf-8')})
+
+    fd, temp_path = tempfile.mkstemp(suffix='.parquet', dir=os.path.dirname(store_path))
+    os.close(fd)
+
+    try:
+        pyarrow.parquet.write_table(table, temp_path, row_group_size=ROW_GROUP_SIZE)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, store_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    return sum(len(anchors) for anchors in columns.values())
+
+
+# Build the store for a dataset being created in ds_dir. Without pyarrow, no store is built, and reports read the
+# haplotype files directly
+
+def create_haplotype_store(ds_dir, session):
+    store_path = os.path.join(ds_dir, HAPLOTYPE_STORE)
+
+    if pyarrow is None:
+        if os.path.isfile(store_path):
+            os.remove(store_path)
+        return ['pyarrow is not installed: haplotype store not built']
+
+    count = build_haplotype_store(session, os.path.join(ds_dir, 'samples'), store_path)
+    return ['Stored %d haplotype files' % count]
+
+
+# The columns of the named samples' files for the anchor gene, in the order in which they appear in the files
+
+def file_columns(columns, sample_names, anchor):
+    return list(dict.fromkeys(c for s in sample_names if anchor in columns.get(s, {}) for c in columns[s][anchor]))
+
+
+class HaplotypeStore:
+    def __init__(self, path):
+        self.path = path
+        self.columns = json.loads(pyarrow.parquet.read_schema(path).metadata[COLUMNS_KEY])
+
+    def has(self, sample_name, anchor):
+        return anchor in self.columns.get(sample_name, {})
+
+    # The rows of the named samples' files for the anchor gene, indexed by sample name, with the columns of those
+    # files
+
+    def read(self, sample_names, anchor):
+        sample_names = [s for s in sample_names if self.has(s, anchor)]
+        wanted = file_columns(self.columns, sample_names, anchor)
+
+        if not sample_names:
+            return pd.DataFrame(columns=wanted, index=pd.Index([], name=SAMPLE_COL))
+
+        table = pyarrow.parquet.read_table(self.path, columns=[SAMPLE_COL] + wanted,
+                                           filters=[(ANCHOR_COL, '=', anchor), (SAMPLE_COL, 'in', sample_names)])
+        return table.to_pandas().set_index(SAMPLE_COL)
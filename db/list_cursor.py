@@ -0,0 +1,121 @@
+# Opaque cursors for the list APIs
+#
+# A cursor records where the previous page ended, so that the next page can be resumed from that point rather than
+# by counting rows from the start. The content is a small dict, serialised as url-safe base64 JSON. Dates and
+# Decimals, which can occur in sort keys, are tagged so that they round-trip with their types.
+#
+# The lists are sorted and paged by the database. A page is resumed from the sort key of the last row of the
+# previous page (keyset pagination), so it costs the same wherever it falls in the list.
+
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from db.sql_sort import keyset_condition, order_by_clauses, row_sort_key, row_key_values, merge_sorted_streams
+
+
+def encode_value(v):
+    if isinstance(v, datetime):
+        return {'dt': v.isoformat()}
+    if isinstance(v, date):
+        return {'d': v.isoformat()}
+    if isinstance(v, Decimal):
+        return {'n': str(v)}
+    return v
+
+
+def decode_value(v):
+    if isinstance(v, dict):
+        if 'dt' in v:
+            return datetime.fromisoformat(v['dt'])
+        if 'd' in v:
+            return date.fromisoformat(v['d'])
+        if 'n' in v:
+            return Decimal(v['n'])
+        raise ValueError('unrecognised cursor value')
+    return v
+
+
+def encode_cursor(content):
+    content = {k: [encode_value(x) for x in v] if isinstance(v, list) else encode_value(v) for k, v in content.items()}
+    return base64.urlsafe_b64encode(json.dumps(content, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+# Raises ValueError if the cursor can't be decoded
+
+def decode_cursor(cursor):
+    try:
+        content = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except Exception as e:
+        raise ValueError('malformed cursor') from e
+
+    if not isinstance(content, dict):
+        raise ValueError('malformed cursor')
+
+    return {k: [decode_value(x) for x in v] if isinstance(v, list) else decode_value(v) for k, v in content.items()}
+
+
+# Keyset paging over several datasets, each sorted and limited by the database (see db/sql_sort.py). The cursor
+# holds the sort key of the last row returned, the index of its dataset, and its id_keys, which break ties within a
+# dataset. Raises ValueError if the cursor does not match the datasets or sort keys. Returns (values, dataset
+# index, ids)
+
+def decode_keyset_cursor(cursor, datasets, sort_keys, id_keys):
+    content = decode_cursor(cursor)
+
+    try:
+        values, ds_index, ids = content['k'], datasets.index(content['d']), content['i']
+    except (KeyError, TypeError) as e:
+        raise ValueError('malformed cursor') from e
+
+    if not isinstance(values, list) or len(values) != len(sort_keys) or not isinstance(ids, list) or len(ids) != len(id_keys):
+        raise ValueError('cursor does not match sort order')
+
+    return values, ds_index, ids
+
+
+# Order a dataset's query by the sort and id keys, and restrict it to the rows after the cursor position last (as
+# returned by decode_keyset_cursor), if given, and to limit rows. Rows of earlier datasets precede those of later
+# ones with an equal sort key. The query must include the key columns. If it is grouped, set grouped, so that the
+# position is applied after grouping
+
+def keyset_page_query(query, sort_keys, id_keys, ds_index, last=None, limit=None, grouped=False):
+    if last is not None:
+        values, last_ds_index, ids = last
+
+        if ds_index < last_ds_index:
+            condition = keyset_condition(sort_keys, values)
+        elif ds_index == last_ds_index:
+            condition = keyset_condition(sort_keys + id_keys, values + ids)
+        else:
+            condition = keyset_condition(sort_keys, values, inclusive=True)
+
+        query = query.having(condition) if grouped else query.filter(condition)
+
+    query = query.order_by(*order_by_clauses(sort_keys + id_keys))
+
+    if limit:
+        query = query.limit(limit)
+
+    return query
+
+
+# Merge the rows fetched by keyset_page_query from each dataset, given as [(dset, rows)] in dataset order, and
+# return the rows from offset that fall on the page, as [(dset, row)], and the cursor for the next page, if any
+
+def merge_keyset_pages(pages, sort_keys, id_keys, offset=0, page_size=None):
+    def ids(row):
+        return [getattr(row, col.key) for col, _ in id_keys]
+
+    streams = [[(row_sort_key(r, sort_keys) + (ds_index,) + tuple(ids(r)), (dset, r)) for r in rows]
+               for ds_index, (dset, rows) in enumerate(pages)]
+    merged = merge_sorted_streams(streams, offset, page_size + 1 if page_size else None)
+    next_cursor = None
+
+    if page_size and len(merged) > page_size:
+        merged = merged[:page_size]
+        dset, r = merged[-1]
+        next_cursor = encode_cursor({'k': row_key_values(r, sort_keys), 'd': dset, 'i': ids(r)})
+
+    return merged, next_cursor
@@ -0,0 +1,117 @@
+# Instrumentation of the queries made against the datasets
+#
+# Each ContentProvider engine is instrumented with cursor execution events. The number of statements executed and
+# the time spent executing them are added to the QueryStats of the current request or Celery task, overall and per
+# dataset. Statements that take longer than a threshold are logged together with their EXPLAIN QUERY PLAN.
+#
+# The time recorded is that of cursor.execute() alone. SQLite computes rows as they are fetched, so the time spent
+# fetching the rows after the first - often most of the time taken by a query returning many rows - is not
+# included. The times are reported as execute times for this reason.
+#
+# The QueryStats object is held in a context variable. map_datasets runs its workers in a copy of the caller's
+# context, so that queries made on the dataset thread pool are counted against the request that made them.
+
+import contextvars
+import logging
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+# Statements taking longer than this, in seconds, are logged with their query plan (0 to disable)
+slow_query_threshold = 0.5
+
+current_stats = contextvars.ContextVar('query_stats', default=None)
+
+# Called with (dataset, count, elapsed) when a QueryStats is finished, e.g. to update metrics
+stats_listeners = []
+
+
+class QueryStats:
+    def __init__(self, label):
+        self.label = label
+        self.count = 0
+        self.elapsed = 0.0
+        self.datasets = {}
+        self.lock = threading.Lock()
+
+    def add(self, dataset, elapsed):
+        with self.lock:
+            self.count += 1
+            self.elapsed += elapsed
+            count, total = self.datasets.get(dataset, (0, 0.0))
+            self.datasets[dataset] = (count + 1, total + elapsed)
+
+    def summary(self):
+        return '%d queries, %.1f ms executing' % (self.count, self.elapsed * 1000)
+
+
+def logger():
+    return current_app.logger if has_app_context() else logging.getLogger(__name__)
+
+
+def set_slow_query_threshold(ms):
+    global slow_query_threshold
+    slow_query_threshold = ms / 1000
+
+
+# Start recording the queries of a request or task. Returns the QueryStats
+
+def start_query_stats(label):
+    stats = QueryStats(label)
+    current_stats.set(stats)
+    return stats
+
+
+# Stop recording, notify the listeners, and return the QueryStats, or None if nothing was being recorded
+
+def finish_query_stats():
+    stats = current_stats.get()
+    current_stats.set(None)
+
+    if stats is not None:
+        for listener in stats_listeners:
+            for dataset, (count, elapsed) in stats.datasets.items():
+                listener(dataset, count, elapsed)
+
+    return stats
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def handle_error(exception_context):
+    if exception_context.connection is not None and exception_context.connection.info.get('query_start'):
+        exception_context.connection.info['query_start'].pop()
+
+
+def explain_query_plan(conn, statement, parameters):
+    try:
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return '\n'.join(row[-1] for row in cursor.fetchall())
+        finally:
+            cursor.close()
+    except Exception as e:
+        return 'query plan not available: %s' % e
+
+
+def instrument_engine(engine, dataset):
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+
+        stats = current_stats.get()
+        if stats is not None:
+            stats.add(dataset, elapsed)
+
+        if slow_query_threshold and elapsed > slow_query_threshold and not executemany:
+            logger().warning('Slow query on %s (%.1f ms):\n%s\nparameters: %s\nquery plan:\n%s'
+                             % (dataset, elapsed * 1000, statement, parameters,
+                                explain_query_plan(conn, statement, parameters)))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(engine, 'handle_error', handle_error)
@@ -0,0 +1,154 @@
+# Translate the sort specifications used by the list APIs into SQL ORDER BY expressions, so that sorting and
+# paging can be carried out by the database rather than on fully materialised lists in Python.
+#
+# The expressions mirror the Python sort keys used by the API modules:
+#   'underscore' - name_sort_key(): split on '_', drop the first character of each part and zero-fill it to 4
+#   'numeric'    - num_sort_key(): blank sorts as -1, anything else as a float
+#   (default)    - blank values last, then by value
+#
+# A page can also be resumed from the sort key of the last row returned (keyset pagination), using keyset_condition()
+
+import heapq
+from functools import total_ordering
+from itertools import islice
+
+from sqlalchemy import and_, case, cast, false, func, not_, or_, true, text, Column, Float, Integer, MetaData, String, Table
+
+# Separator used when joining the parts of an underscore key. It sorts below any printable character, so that
+# comparing joined keys gives the same result as comparing the lists of parts
+UNDERSCORE_SEP = '\x01'
+
+
+def underscore_sort_key(name):
+    name = '' if name is None else str(name)
+    return UNDERSCORE_SEP.join([part[1:].zfill(4) for part in name.split('_')])
+
+
+# Register the Python sort key functions with a SQLite connection. Used as a 'connect' event listener on the engine
+
+def register_sort_functions(dbapi_connection, connection_record):
+    dbapi_connection.create_function('underscore_sort_key', 1, underscore_sort_key, deterministic=True)
+
+
+def is_blank(field):
+    return or_(field.is_(None), cast(field, String) == '')
+
+
+# Return a list of (labelled expression, descending) tuples implementing the sort_specs.
+# The list APIs apply the specs as successive stable sorts, so the last spec takes precedence
+
+def sort_key_columns(filters, sort_specs):
+    keys = []
+
+    for spec in reversed(sort_specs):
+        f = spec['field']
+        if f not in filters or filters[f]['field'] is None:
+            continue
+
+        field = filters[f]['field']
+        descending = spec.get('order') == 'desc'
+        sort = filters[f]['sort'] if 'sort' in filters[f] else None
+
+        if sort == 'underscore':
+            exprs = [func.underscore_sort_key(field)]
+        elif sort == 'numeric':
+            exprs = [case([(is_blank(field), -1.0)], else_=cast(field, Float))]
+        else:
+            # blank values are all NULL in the second key, so that they tie, as they do in Python
+            exprs = [case([(is_blank(field), 1)], else_=0), case([(not_(is_blank(field)), field)], else_=None)]
+
+        for expr in exprs:
+            keys.append((expr.label('_sort_%d' % len(keys)), descending))
+
+    return keys
+
+
+# A temporary table holding (key, value) rows computed in Python, such as the number of selected samples in which
+# each allele appears, so that they can be joined to a query and sorted on. Joining the table keeps the statement
+# small, however many rows there are. The table belongs to the session's connection, and is refilled on each call
+
+def values_table(session, name, rows):
+    table = Table(name, MetaData(), Column('key', String, primary_key=True), Column('value', Integer))
+    session.execute(text('CREATE TEMP TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value INTEGER)' % name))
+    session.execute(table.delete())
+    rows = [{'key': k, 'value': v} for k, v in rows]
+    if rows:
+        session.execute(table.insert(), rows)
+    return table
+
+
+# Raise ValueError if any of the sort_specs names a field that has no column to sort on, rather than ignoring it
+
+def check_sort_specs(filters, sort_specs):
+    for spec in sort_specs:
+        if not isinstance(spec, dict) or spec.get('field') not in filters or filters[spec['field']].get('field') is None:
+            raise ValueError('cannot sort on %s' % (spec.get('field') if isinstance(spec, dict) else spec))
+
+
+def order_by_clauses(sort_keys):
+    return [col.desc() if descending else col for col, descending in sort_keys]
+
+
+@total_ordering
+class Descending:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+# Python equivalent of the ORDER BY clause, for merging rows fetched from several datasets.
+# Blank values are normalised to '' so that NULL and '' compare equal, as they do in the Python sort keys
+
+def row_sort_key(row, sort_keys):
+    key = []
+    for col, descending in sort_keys:
+        value = getattr(row, col.key)
+        if value is None:
+            value = ''
+        key.append(Descending(value) if descending else value)
+    return tuple(key)
+
+
+def row_key_values(row, sort_keys):
+    return [getattr(row, col.key) for col, _ in sort_keys]
+
+
+def keys_equal(sort_keys, values):
+    clauses = [col.is_(None) if v is None else col == v for (col, _), v in zip(sort_keys, values)]
+    return and_(*clauses) if clauses else true()
+
+
+# Condition selecting the rows that sort after the given key values. A blank (None) value can only be followed
+# by other blanks within the same group, so it contributes no 'after' clause of its own
+
+def keyset_condition(sort_keys, values, inclusive=False):
+    clauses = []
+
+    for i, ((col, descending), v) in enumerate(zip(sort_keys, values)):
+        if v is not None:
+            clauses.append(and_(keys_equal(sort_keys[:i], values[:i]), col < v if descending else col > v))
+
+    if inclusive:
+        clauses.append(keys_equal(sort_keys, values))
+
+    return or_(*clauses) if clauses else false()
+
+
+# Merge per-dataset streams, each already in sort order, and return the requested slice.
+# Each stream is a list of (key, item) tuples
+
+def merge_sorted_streams(streams, offset=0, limit=None):
+    return list(islice(iter_merged_streams(streams), offset, offset + limit if limit else None))
+
+
+# As merge_sorted_streams, but lazy, so that the streams can be iterators over query results
+
+def iter_merged_streams(streams):
+    return (item for _, item in heapq.merge(*streams, key=lambda x: x[0]))
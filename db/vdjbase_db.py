@@ -1,12 +1,20 @@
 # Manage a list of available vdjbase-style databases
+import fcntl
+import hashlib
+import json
+import logging
 import os
 import shutil
+import sqlite3
+import threading
+from urllib.parse import quote
 from os.path import join, isdir, isfile
 from os import listdir
 from time import sleep
 from flask import render_template, request, redirect, url_for, Markup
-from sqlalchemy import create_engine, inspect, text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, inspect, text, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 from flask_table import Table, Col
 from flask_wtf import FlaskForm
 from werkzeug.exceptions import BadRequest
@@ -15,70 +23,285 @@ from flask_wtf.file import FileField, FileRequired
 from wtforms.validators import DataRequired
 from werkzeug.utils import secure_filename
 
-from db.vdjbase_exceptions import DbCreationError
-from db.vdjbase_maint import create_single_database
+from db.vdjbase_exceptions import DbCreationError, DatasetSchemaError
+from db.sql_sort import register_sort_functions
+from db.query_stats import instrument_engine
+from db.haplotype_store import HAPLOTYPE_STORE, HaplotypeStore, build_haplotype_store
+from db.dataset_registry import DatasetRegistry
+from db.dataset_publish import create_version_dir, publish_dir, unpublish_dir
+from db.vdjbase_maint import create_single_database, schema_needs_upgrade, upgrade_schema
 from extensions import celery
 import traceback
 
 Session = sessionmaker()
 
+logger = logging.getLogger(__name__)
+
+# Content version of a dataset, taken from the identity, size and modification time of db.sqlite3 and
+# db_description.txt. The files are only replaced when a dataset is published, so this changes on publication.
+# Returns (version, modification time)
+
+def content_version(path):
+    parts = []
+    modified = 0
+
+    for fn in (path, join(os.path.dirname(path), 'db_description.txt')):
+        if isfile(fn):
+            st = os.stat(fn)
+            parts.append('%s:%d:%d:%d' % (os.path.basename(fn), st.st_ino, st.st_size, st.st_mtime_ns))
+            modified = max(modified, st.st_mtime)
+
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16], modified
+
+
+# Connections held open per dataset, and the number that can be opened beyond that under load
+CONTENT_POOL_SIZE = 5
+CONTENT_POOL_OVERFLOW = 10
+
+# Per-connection settings for served datasets: bytes of the file to memory-map, and KiB of page cache
+CONTENT_MMAP_SIZE = 256 * 1024 * 1024
+CONTENT_CACHE_KB = 64 * 1024
+
+
+# Served datasets are opened read-only and immutable: the web app never writes to them, and a published file is
+# replaced rather than changed, so SQLite can skip locking and change detection
+def immutable_connector(path):
+    uri = 'file:%s?mode=ro&immutable=1' % quote(os.path.abspath(path))
+    return lambda: sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+def set_serving_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA mmap_size = %d' % CONTENT_MMAP_SIZE)
+    cursor.execute('PRAGMA cache_size = -%d' % CONTENT_CACHE_KB)
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    cursor.close()
+
+
+# The manifest of the files in a dataset's sample directory, written to the dataset directory when it is published
+
+SAMPLE_FILE_MANIFEST = 'sample_files.json'
+
+
+def list_sample_files(sample_path):
+    manifest = set()
+    for root, dirs, files in os.walk(sample_path):
+        for name in files:
+            manifest.add(os.path.relpath(os.path.join(root, name), sample_path))
+    return manifest
+
+
+def write_sample_file_manifest(db_dir, sample_path):
+    with open(join(db_dir, SAMPLE_FILE_MANIFEST), 'w') as fo:
+        json.dump(sorted(list_sample_files(sample_path)), fo)
+
+
+# Provides access to a dataset. Each thread (and so each request or Celery task) gets its own session from the
+# session property, drawing on a pool of connections. Sessions are released by release_sessions() when the request
+# or task ends. Unless read_only is False, the file is opened in the read-only serving mode described above. Queries
+# are recorded by query_stats under the given label, or the path if there is none.
+
 class ContentProvider():
     db = None
-    connection = None
-    session = None
-
-    def __init__(self, path):
-        self.db = create_engine('sqlite:///' + path + '?check_same_thread=false', echo=False)
-        self.connection = self.db.connect()
-        self.session = Session(bind=self.connection)
+    sessions = None
+    facets = None
+    facets_lock = None
+    sample_file_manifest = None
+    haplotype_store = None
+    path = None
+    version = None
+    modified = None
+
+    def __init__(self, path, read_only=True, label=None):
+        self.path = path
+        self.version, self.modified = content_version(path)
+
+        if read_only:
+            self.db = create_engine('sqlite://', creator=immutable_connector(path), echo=False, poolclass=QueuePool,
+                                    pool_size=CONTENT_POOL_SIZE, max_overflow=CONTENT_POOL_OVERFLOW)
+            event.listen(self.db, 'connect', set_serving_pragmas)
+        else:
+            self.db = create_engine('sqlite:///' + path + '?check_same_thread=false', echo=False, poolclass=QueuePool,
+                                    pool_size=CONTENT_POOL_SIZE, max_overflow=CONTENT_POOL_OVERFLOW)
+
+        event.listen(self.db, 'connect', register_sort_functions)
+        instrument_engine(self.db, label or path)
+        self.sessions = scoped_session(sessionmaker(bind=self.db))
+        self.facets = {}
+        self.facets_lock = threading.Lock()
+
+    # The calling thread's session
+    @property
+    def session(self):
+        return self.sessions()
+
+    # A session with a connection of its own, for use off the main thread
+    def new_session(self):
+        return Session(bind=self.db)
+
+    def release_session(self):
+        self.sessions.remove()
 
     def close(self):
-        self.connection.close()
+        self.sessions.remove()
         self.db.dispose()
 
+    # Relative paths of all files in the dataset's sample directory, so that links can be checked without a stat
+    # per file. Read from the manifest written when the dataset was published, or built on first use for datasets
+    # published without one
+    def sample_files(self, sample_path):
+        if self.sample_file_manifest is None:
+            self.load_sample_files(sample_path)
+        return self.sample_file_manifest
+
+    def load_sample_files(self, sample_path):
+        manifest_path = join(os.path.dirname(self.path), SAMPLE_FILE_MANIFEST)
+
+        if isfile(manifest_path):
+            with open(manifest_path, 'r') as fi:
+                self.sample_file_manifest = set(json.load(fi))
+        else:
+            self.sample_file_manifest = list_sample_files(sample_path)
+
+    # The dataset's haplotype store (see haplotype_store.py). This is the store built with the database if there is
+    # one, otherwise one built from the files in sample_path at cache_path, on first use
+    def haplotypes(self, sample_path, cache_path):
+        if self.haplotype_store is None:
+            path = join(os.path.dirname(self.path), HAPLOTYPE_STORE)
+
+            if not isfile(path):
+                path = cache_path
+
+                if not isfile(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    session = self.new_session()
+                    try:
+                        build_haplotype_store(session, sample_path, path)
+                    finally:
+                        session.close()
+
+            self.haplotype_store = HaplotypeStore(path)
+
+        return self.haplotype_store
+
+
+# Datasets built before the schema changes in upgrade_schema() are not opened for serving: they must first be
+# upgraded by upgrade_published_datasets(), at worker startup or with upgrade_vdjbase_dbs.py, which publishes an
+# upgraded copy. Datasets are otherwise upgraded when they are built or published. A served file is never altered in place, as other processes may have it open immutable
+
+def check_schema(path):
+    if schema_needs_upgrade(path):
+        raise DatasetSchemaError('Dataset %s has an out of date schema: run upgrade_vdjbase_dbs.py to upgrade it' % path)
+
+
+# Upgrade the schema of published datasets built before the changes in upgrade_schema(). The files of each dataset
+# that needs it are copied to a new version, which is upgraded and then published. Called by each worker at startup
+# (see UPGRADE_DATASETS_AT_START) and by upgrade_vdjbase_dbs.py: a lock file ensures that only one process upgrades
+# a dataset, the others finding it already upgraded. Returns the datasets upgraded
+
+UPGRADE_LOCK = '.upgrade.lock'
+
+
+def upgrade_published_datasets(vdjbase_db_path):
+    upgraded = []
 
-def study_data_db_init(vdjbase_db_path):
-    sqlite_dbs = {}
+    with open(join(vdjbase_db_path, UPGRADE_LOCK), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        for (species, name), (path, version, modified) in scan_datasets(vdjbase_db_path).items():
+            if not schema_needs_upgrade(path):
+                continue
+
+            link_path = join(vdjbase_db_path, species, name)
+            current_path = os.path.dirname(path)
+            new_db_path = create_version_dir(link_path)
+
+            for node in listdir(current_path):
+                if isfile(join(current_path, node)):
+                    shutil.copyfile(join(current_path, node), join(new_db_path, node))
+
+            upgrade_schema(join(new_db_path, 'db.sqlite3'))
+            publish_dir(link_path, new_db_path)
+            upgraded.append('%s/%s' % (species, name))
+
+    return upgraded
+
+
+# Release the calling thread's session on each dataset it has used. Called at the end of each request and Celery task
+
+def release_sessions(*registries):
+    for registry in registries:
+        registry.release_sessions()
+
+
+# Discover the datasets under vdjbase_db_path. Only the descriptions and content versions are read here, and the
+# schemas checked: each dataset is opened for serving on first use, and at most cache_size datasets are kept open
+# (0 for no limit). The directory is rescanned at most every check_interval seconds (0 to disable), so that datasets
+# published by other processes are picked up
+
+def study_data_db_init(vdjbase_db_path, cache_size=0, check_interval=0):
+    genomic = 'genomic' in vdjbase_db_path.lower()
+    schema_checked = {}
+
+    def open_dataset(entry):
+        return ContentProvider(entry.path, label='%s/%s' % (entry.species, entry.name))
+
+    # Datasets whose schema needs to be upgraded are logged and left out of the catalogue, rather than failing when
+    # they are opened. Each version is only checked once
+    def scan():
+        datasets = scan_datasets(vdjbase_db_path)
+
+        if not genomic:
+            for key, (path, version, modified) in list(datasets.items()):
+                if (path, version) not in schema_checked:
+                    try:
+                        check_schema(path)
+                        schema_checked[(path, version)] = True
+                    except DatasetSchemaError as e:
+                        logger.error(str(e))
+                        schema_checked[(path, version)] = False
+
+                if not schema_checked[(path, version)]:
+                    del datasets[key]
+
+        return datasets
+
+    sqlite_dbs = DatasetRegistry(open_dataset, cache_size, scan,
+                                 lambda path: read_description(os.path.dirname(path)), check_interval)
+
+    for (species, name), (path, version, modified) in scan().items():
+        sqlite_dbs.add(species, name, path, read_description(os.path.dirname(path)), version, modified)
+
+    # put Human at the front
+    sqlite_dbs.sort_species()
+
+    return sqlite_dbs
+
+
+# Return {(species, dataset): (path, version, modified)} for the datasets published under vdjbase_db_path. The
+# path is that of the version currently published, so that a provider continues to read the version it was opened
+# on after a new one is published
+
+def scan_datasets(vdjbase_db_path):
+    datasets = {}
 
     for species in listdir(vdjbase_db_path):
         p = join(vdjbase_db_path, species)
         if isdir(p) and species[0] != '.':
             for name in listdir(p):
                 if isdir(join(p, name)) and name[0] != '.' and '.txt' not in name:
-                    description = ''
-                    if isfile(join(p, name, 'db_description.txt')):
-                        with open(join(p, name, 'db_description.txt'), 'r') as fi:
-                            description = ' '.join(fi.readlines())
-                    if species not in sqlite_dbs:
-                        sqlite_dbs[species] = {}
-                    sqlite_dbs[species][name] = ContentProvider(join(p, name, 'db.sqlite3'))
-                    sqlite_dbs[species][name + '_description'] = description
-
-    # temp fix: add asc_genotype column to sample table if not there already
-
-    if 'genomic' not in vdjbase_db_path.lower():
-        for species in sqlite_dbs:
-            for locus in sqlite_dbs[species]:
-                if 'description' not in locus:
-                    inspector = inspect(sqlite_dbs[species][locus].db)
-                    cols = inspector.get_columns('Sample')
-                    if 'asc_genotype' not in [col['name'] for col in cols]:
-                        with sqlite_dbs[species][locus].connection as con:
-                            con.execute('ALTER TABLE Sample ADD COLUMN asc_genotype text')
-                            sqlite_dbs[species][locus].session.commit()
-
-
-    # sort datasets of each species
-
-    for species in sqlite_dbs:
-        sqlite_dbs[species] = dict(sorted(sqlite_dbs[species].items(), key=lambda kv: kv[0]))
-
-    # put Human at the front
-    sqlite_dbs = dict(sorted(sqlite_dbs.items(), key=lambda kv: 'aaaaa' if kv[0] == 'Human' else kv[0]))
+                    path = os.path.realpath(join(p, name, 'db.sqlite3'))
+                    datasets[(species, name)] = (path,) + content_version(path)
 
-    return sqlite_dbs
+    return datasets
 
 
+def read_description(dataset_dir):
+    description = ''
+    if isfile(join(dataset_dir, 'db_description.txt')):
+        with open(join(dataset_dir, 'db_description.txt'), 'r') as fi:
+            description = ' '.join(fi.readlines())
+    return description
 
 
 def manage_airrseq(app):
@@ -204,44 +427,35 @@ def do_airrseq_copy(species, dataset, description, app, vdjbase_dbs):
         raise DbCreationError('Sample directory for %s/%s not found' % (species, dataset))
 
     try:
-        if species in vdjbase_dbs and dataset in vdjbase_dbs[species]:
-            vdjbase_dbs[species][dataset].close()
-            del(vdjbase_dbs[species][dataset])
-
         vdjbase_db_path = os.path.join(app.config['STATIC_PATH'], 'study_data', 'VDJbase', 'db')
         vdjbase_sample_path = os.path.join(app.config['STATIC_PATH'], 'study_data', 'VDJbase', 'samples')
         our_db_path = os.path.join(vdjbase_db_path, species, dataset)
         our_sample_path = os.path.join(vdjbase_sample_path, species, dataset)
 
-        if not os.path.isdir(os.path.join(vdjbase_db_path, species)):
-            os.mkdir(os.path.join(vdjbase_db_path, species))
-
-        if not os.path.isdir(os.path.join(vdjbase_sample_path, species)):
-            os.mkdir(os.path.join(vdjbase_db_path, species))
-
-
-        if isdir(our_db_path):
-            shutil.rmtree(our_db_path, ignore_errors=True)
-
-        if isdir(our_sample_path):
-            shutil.rmtree(our_sample_path, ignore_errors=True)
+        # build the new version alongside the published one, then switch to it
 
-        os.mkdir(our_db_path)
-        os.mkdir(our_sample_path)
+        new_db_path = create_version_dir(our_db_path)
+        new_sample_path = create_version_dir(our_sample_path)
 
-        shutil.copyfile(os.path.join(our_upload_path, 'db.sqlite3'), os.path.join(our_db_path, 'db.sqlite3'))
-        with open(os.path.join(our_db_path, 'db_description.txt'), 'w') as fo:
+        shutil.copyfile(os.path.join(our_upload_path, 'db.sqlite3'), os.path.join(new_db_path, 'db.sqlite3'))
+        upgrade_schema(os.path.join(new_db_path, 'db.sqlite3'))
+        with open(os.path.join(new_db_path, 'db_description.txt'), 'w') as fo:
             fo.write(description)
 
+        if os.path.isfile(os.path.join(our_upload_path, HAPLOTYPE_STORE)):
+            shutil.copyfile(os.path.join(our_upload_path, HAPLOTYPE_STORE), os.path.join(new_db_path, HAPLOTYPE_STORE))
+
         for node in os.listdir(os.path.join(our_upload_path, 'samples')):
             if node[0] != '.' and os.path.isdir(os.path.join(our_upload_path, 'samples', node)):
-                shutil.copytree(os.path.join(our_upload_path, 'samples', node), os.path.join(our_sample_path, node))
+                shutil.copytree(os.path.join(our_upload_path, 'samples', node), os.path.join(new_sample_path, node))
+
+        write_sample_file_manifest(new_db_path, new_sample_path)
 
-        if species not in vdjbase_dbs:
-            vdjbase_dbs[species] = {}
+        publish_dir(our_sample_path, new_sample_path)
+        publish_dir(our_db_path, new_db_path)
 
-        vdjbase_dbs[species][dataset] = ContentProvider(os.path.join(our_db_path, 'db.sqlite3'))
-        vdjbase_dbs[species][dataset + '_description'] = description
+        vdjbase_dbs.add(species, dataset, os.path.join(new_db_path, 'db.sqlite3'), description,
+                        *content_version(os.path.join(new_db_path, 'db.sqlite3')))
 
     except Exception as e:
         raise DbCreationError(str(e))
@@ -253,14 +467,8 @@ def airrseq_remove(species, dataset, app, vdjbase_dbs):
     our_db_path = os.path.join(vdjbase_db_path, species, dataset)
     our_sample_path = os.path.join(vdjbase_sample_path, species, dataset)
 
-    if species in vdjbase_dbs and dataset in vdjbase_dbs[species]:
-        vdjbase_dbs[species][dataset].close()
-        del(vdjbase_dbs[species][dataset])
-
-    if isdir(our_db_path):
-        shutil.rmtree(our_db_path, ignore_errors=True)
-
-    if isdir(our_sample_path):
-        shutil.rmtree(our_sample_path, ignore_errors=True)
+    vdjbase_dbs.remove(species, dataset)
+    unpublish_dir(our_db_path)
+    unpublish_dir(our_sample_path)
 
     return redirect(url_for('airrseq'))
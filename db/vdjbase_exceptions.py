@@ -2,3 +2,8 @@ class DbCreationError(Exception):
     """Raised when a fatal error occurs while creating the database"""
     pass
 
+
+
+class DatasetSchemaError(Exception):
+    """Raised when a dataset is opened whose schema needs to be upgraded"""
+    pass
@@ -19,7 +19,7 @@ def do_igsnper(species, dataset):
         return 'No database found'
 
     igsnper_dir = os.path.join(ds_dir, 'samples', 'igsnper')
-    db = ContentProvider(os.path.join(ds_dir, 'db.sqlite3'))
+    db = ContentProvider(os.path.join(ds_dir, 'db.sqlite3'), read_only=False)
 
     # remove any existing igsnper related database fields
 
@@ -7,7 +7,7 @@ import sys
 import traceback
 import zipfile
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.pool import NullPool
 from sqlalchemy.orm import sessionmaker
 
@@ -18,6 +18,7 @@ from db.vdjbase_model import *
 from db.vdjbase_reference import import_reference_alleles
 from db.vdjbase_projects import import_studies
 from db.vdjbase_genotypes import process_genotypes, add_deleted_alleles, process_haplotypes_and_stats
+from db.haplotype_store import create_haplotype_store
 from db.vdjbase_exceptions import *
 
 
@@ -65,6 +66,8 @@ def create_single_database(job, species, dataset, upload_path, in_situ=False):
         result.extend(process_genotypes(ds_dir, species, dataset, session))
         job.update_state(state='PENDING', meta={'value': 'Processing haplotypes'})
         result.extend(process_haplotypes_and_stats(ds_dir, species, dataset, session))
+        job.update_state(state='PENDING', meta={'value': 'Building haplotype store'})
+        result.extend(create_haplotype_store(ds_dir, session))
         job.update_state(state='PENDING', meta={'value': 'Analyzing allele appearances'})
         result.extend(update_alleles_appearance(session))
         job.update_state(state='PENDING', meta={'value': 'Calculating gene frequencies'})
@@ -85,6 +88,44 @@ def create_single_database(job, species, dataset, upload_path, in_situ=False):
     return success, result
 
 
+# Columns added to the schema since the first datasets were built, with their definitions. Databases built by
+# create_single_database() already have them, but older databases are upgraded by upgrade_schema() when they are
+# published, or by upgrade_vdjbase_dbs.py if they are already published, as the web app opens datasets read-only
+
+ADDED_COLUMNS = [
+    ('Sample', 'asc_genotype', 'text'),
+]
+
+
+def missing_columns(engine):
+    inspector = inspect(engine)
+    missing = []
+
+    for table, column, definition in ADDED_COLUMNS:
+        if column not in [col['name'] for col in inspector.get_columns(table)]:
+            missing.append((table, column, definition))
+
+    return missing
+
+
+def schema_needs_upgrade(db_file):
+    engine = create_engine('sqlite:///file:%s?mode=ro&uri=true' % db_file, echo=False, poolclass=NullPool)
+    try:
+        return len(missing_columns(engine)) > 0
+    finally:
+        engine.dispose()
+
+
+def upgrade_schema(db_file):
+    engine = create_engine('sqlite:///' + db_file, echo=False, poolclass=NullPool)
+    try:
+        with engine.begin() as con:
+            for table, column, definition in missing_columns(engine):
+                con.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, definition))
+    finally:
+        engine.dispose()
+
+
 def extract_files(job, ds_dir, species, dataset):
     result = []
 
@@ -1,6 +1,7 @@
 # Flask / Celery integration
 # from https://stackoverflow.com/questions/12044776/how-to-use-flask-sqlalchemy-in-a-celery-task
 import importlib
+import time
 import traceback
 
 import flask
@@ -8,6 +9,9 @@ from flask_sqlalchemy import SQLAlchemy
 from celery import Celery, current_task
 from werkzeug.exceptions import BadRequest
 
+from db.query_stats import start_query_stats, finish_query_stats
+import metrics
+
 
 class FlaskCelery(Celery):
 
@@ -28,10 +32,21 @@ class FlaskCelery(Celery):
 
             def __call__(self, *args, **kwargs):
                 if flask.has_app_context():
-                    return TaskBase.__call__(self, *args, **kwargs)
+                    return self.call_recording_queries(*args, **kwargs)
                 else:
                     with _celery.app.app_context():
-                        return TaskBase.__call__(self, *args, **kwargs)
+                        return self.call_recording_queries(*args, **kwargs)
+
+            # record the dataset queries made by the task, and log them when it completes
+            def call_recording_queries(self, *args, **kwargs):
+                start_query_stats(self.name)
+                try:
+                    return TaskBase.__call__(self, *args, **kwargs)
+                finally:
+                    stats = finish_query_stats()
+                    flask.current_app.logger.info('Task %s: %s' % (self.name, stats.summary()),
+                                                  extra={'db_queries': stats.count, 'db_time': stats.elapsed})
+                    metrics.flush_metrics(force=True)
 
         self.Task = ContextTask
 
@@ -45,18 +60,41 @@ class FlaskCelery(Celery):
 celery = FlaskCelery('tasks', broker='pyamqp://guest@localhost//', backend='redis://localhost:6379/0')
 
 
+# queued is the time.time() at which the report was queued, if known. If cache_key is given, a successful result
+# is cached under it
+
 @celery.task(bind=True, time_limit=600)
-def run_report(self, report_name, format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params):
+def run_report(self, report_name, format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params, queued=None, cache_key=None):
+    from api.reports.report_progress import report_progress, ReportCancelled
     runner = importlib.import_module('api.reports.' + report_name)
+    start = time.perf_counter()
+    outcome = 'error'
+
+    if queued is not None:
+        metrics.report_wait.observe(report_name, value=max(time.time() - queued, 0))
 
     try:
-        self.update_state(state='PENDING', meta={'stage': 'preparing data'})
-        return runner.run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params)
+        report_progress('preparing data', 0)
+        ret = runner.run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params)
+        outcome = 'ok'
+
+        if cache_key is not None:
+            try:
+                from api.reports.report_cache import store_report
+                store_report(cache_key, report_name, ret)
+            except Exception as e:
+                print('Exception raised caching report result: %s' % traceback.format_exc())
+
+        return ret
     except BadRequest as bad:
+        if isinstance(bad, ReportCancelled):
+            outcome = 'cancelled'
         print('BadRequest raised during report processing: %s' % bad.description)
         return {'status': 'error', 'description': bad.description}
     except Exception as e:
         print('Exception raised during report processing: %s' % traceback.format_exc())
         return {'status': 'error', 'description': 'Unexpected error when running report: %s' % traceback.format_exc()}
+    finally:
+        metrics.report_run.observe(report_name, outcome, value=time.perf_counter() - start)
 
 
@@ -0,0 +1,354 @@
+# Operational metrics, exposed in the Prometheus text format at /system/metrics
+#
+# Each process (web worker or Celery worker) keeps its metrics in memory, and writes them from time to time to a
+# file of its own in a shared local directory. Files are named by process id and start time, so that a process that
+# reuses the id of one that has exited does not overwrite its file. The metrics endpoint merges the files of all
+# processes, using the in-memory values for its own process. Gauges are only taken from processes that are still
+# running. When a process exits, its counters and histograms are added to RETIRED_FILE and its file is removed, so
+# that totals don't go backwards when a worker is recycled, and the directory does not grow without limit.
+
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+# Seconds between writes of this process's metrics to the shared directory
+FLUSH_INTERVAL = 5
+
+# Totals of the processes that have exited, and the lock held while they are updated
+RETIRED_FILE = 'retired.json'
+RETIRED_LOCK = 'retired.lock'
+
+metrics_dir = None
+process_id = None
+last_flush = 0.0
+lock = threading.Lock()
+registry = {}
+
+# Functions called before the metrics are written or rendered, to update metrics taken from elsewhere
+collectors = []
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        registry[name] = self
+
+    def key(self, label_values):
+        if len(label_values) != len(self.labels):
+            raise ValueError('%s requires labels %s' % (self.name, ', '.join(self.labels)))
+        return tuple(str(v) for v in label_values)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        key = self.key(label_values)
+        with lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    # For counters maintained elsewhere, such as the dataset cache statistics
+    def set(self, *label_values, value):
+        with lock:
+            self.values[self.key(label_values)] = value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *label_values, amount=1):
+        key = self.key(label_values)
+        with lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        with lock:
+            self.values[self.key(label_values)] = value
+
+
+# Histogram values are [count in each bucket (not cumulative) ..., sum, count]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value):
+        key = self.key(label_values)
+        with lock:
+            v = self.values.get(key)
+            if v is None:
+                v = self.values[key] = [0] * (len(self.buckets) + 3)
+            i = 0
+            while i < len(self.buckets) and value > self.buckets[i]:
+                i += 1
+            v[i] += 1
+            v[-2] += value
+            v[-1] += 1
+
+
+# Metrics
+
+http_request_duration = Histogram('digby_http_request_duration_seconds', 'Time taken to return a response',
+                                  ('route', 'method', 'status'))
+http_in_flight = Gauge('digby_http_requests_in_flight', 'Requests currently being processed')
+report_wait = Histogram('digby_report_wait_seconds', 'Time between a report being queued and starting to run',
+                        ('report',))
+report_run = Histogram('digby_report_run_seconds', 'Time taken to run a report', ('report', 'outcome'))
+rscript_duration = Histogram('digby_rscript_duration_seconds', 'Time taken by Rscript subprocesses',
+                             ('script', 'outcome'))
+db_queries = Counter('digby_db_queries_total', 'Queries made against each dataset', ('dataset',))
+db_query_time = Counter('digby_db_execute_seconds_total', 'Time spent executing queries against each dataset, '
+                        'excluding the time spent fetching their rows', ('dataset',))
+dataset_cache_lookups = Counter('digby_dataset_cache_lookups_total', 'Dataset lookups, by whether the dataset '
+                                'was already open', ('kind', 'result'))
+datasets_open = Gauge('digby_datasets_open', 'Datasets currently open', ('kind',))
+
+
+def record_queries(dataset, count, elapsed):
+    db_queries.inc(dataset, amount=count)
+    db_query_time.inc(dataset, amount=elapsed)
+
+
+def init_metrics(directory):
+    global metrics_dir
+    os.makedirs(directory, exist_ok=True)
+    metrics_dir = directory
+    atexit.register(retire_metrics)
+
+
+# (pid, start time) of this process. Forked children inherit the parent's value, so it is rechecked against the pid
+
+def process_identity():
+    global process_id
+
+    if process_id is None or process_id[0] != os.getpid():
+        process_id = (os.getpid(), time.time_ns())
+    return process_id
+
+
+def process_file():
+    return '%d-%d.json' % process_identity()
+
+
+def snapshot():
+    for collector in collectors:
+        collector()
+
+    with lock:
+        return {name: {json.dumps(k): (list(v) if isinstance(v, list) else v) for k, v in metric.values.items()}
+                for name, metric in registry.items()}
+
+
+# Write this process's metrics to its file in the shared directory, if FLUSH_INTERVAL has passed since the last
+# write, or if force is set
+
+def flush_metrics(force=False):
+    global last_flush
+
+    if metrics_dir is None:
+        return
+
+    now = time.monotonic()
+    if not force and now - last_flush < FLUSH_INTERVAL:
+        return
+    last_flush = now
+
+    pid, started = process_identity()
+    path = os.path.join(metrics_dir, process_file())
+    temp = path + '.tmp'
+    with open(temp, 'w') as fo:
+        json.dump({'pid': pid, 'started': started, 'metrics': snapshot()}, fo)
+    os.replace(temp, path)
+
+
+def process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_metrics_file(fn):
+    try:
+        with open(os.path.join(metrics_dir, fn), 'r') as fi:
+            return json.load(fi)
+    except (OSError, ValueError):
+        return None
+
+
+def without_gauges(values):
+    return {name: v for name, v in values.items() if name in registry and registry[name].type != 'gauge'}
+
+
+# {file name: content} for the files of other processes
+
+def process_files():
+    files = {}
+
+    for fn in os.listdir(metrics_dir):
+        if fn.endswith('.json') and fn not in (RETIRED_FILE, process_file()):
+            content = read_metrics_file(fn)
+            if content is not None:
+                files[fn] = content
+
+    return files
+
+
+# Files of processes that have exited: the process is no longer running, or its id has been taken by a later one
+
+def exited_process_files(files):
+    latest = {}
+    for content in files.values():
+        latest[content['pid']] = max(latest.get(content['pid'], 0), content.get('started', 0))
+
+    return [fn for fn, content in files.items()
+            if content.get('started', 0) < latest[content['pid']] or not process_running(content['pid'])]
+
+
+# Add the counters and histograms in the named files to RETIRED_FILE, and remove the files. Files that another
+# process has already retired are skipped
+
+def retire_files(names):
+    with open(os.path.join(metrics_dir, RETIRED_LOCK), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        retired = read_metrics_file(RETIRED_FILE) or {'metrics': {}}
+        snapshots = [retired['metrics']]
+        found = []
+
+        for fn in names:
+            content = read_metrics_file(fn)
+            if content is not None:
+                snapshots.append(without_gauges(content['metrics']))
+                found.append(fn)
+
+        if not found:
+            return
+
+        path = os.path.join(metrics_dir, RETIRED_FILE)
+        temp = path + '.tmp'
+        with open(temp, 'w') as fo:
+            json.dump({'metrics': merge_snapshots(snapshots)}, fo)
+        os.replace(temp, path)
+
+        for fn in found:
+            os.remove(os.path.join(metrics_dir, fn))
+
+
+# Called at exit, to retire this process's metrics. Processes that exit without running atexit handlers are retired
+# by the next process to render the metrics
+
+def retire_metrics():
+    if metrics_dir is None:
+        return
+
+    try:
+        flush_metrics(force=True)
+        retire_files([process_file()])
+    except OSError:
+        pass
+
+
+def process_snapshots():
+    snapshots = [snapshot()]
+
+    if metrics_dir is not None:
+        files = process_files()
+        exited = exited_process_files(files)
+        if exited:
+            retire_files(exited)
+
+        for fn, content in files.items():
+            if fn not in exited:
+                snapshots.append(content['metrics'])
+
+        retired = read_metrics_file(RETIRED_FILE)
+        if retired is not None:
+            snapshots.append(without_gauges(retired['metrics']))
+
+    return snapshots
+
+
+def merge_snapshots(snapshots):
+    merged = {}
+
+    for values in snapshots:
+        for name, samples in values.items():
+            if name not in registry:
+                continue
+            target = merged.setdefault(name, {})
+            for key, v in samples.items():
+                if isinstance(v, list):
+                    if key in target and len(target[key]) == len(v):
+                        target[key] = [a + b for a, b in zip(target[key], v)]
+                    else:
+                        target[key] = list(v)
+                else:
+                    target[key] = target.get(key, 0) + v
+
+    return merged
+
+
+def escape_label(v):
+    return v.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, escape_label(v)) for n, v in pairs)
+
+
+def format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+# The metrics of all processes, in the Prometheus text exposition format
+
+def render_metrics():
+    merged = merge_snapshots(process_snapshots())
+    lines = []
+
+    for name, metric in registry.items():
+        lines.append('# HELP %s %s' % (name, metric.help))
+        lines.append('# TYPE %s %s' % (name, metric.type))
+
+        for key in sorted(merged.get(name, {})):
+            v = merged[name][key]
+            label_values = json.loads(key)
+
+            if metric.type == 'histogram':
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), v):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(metric.labels, label_values,
+                                                                         [('le', format_value(float(bound)))]),
+                                                     cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels(metric.labels, label_values), format_value(v[-2])))
+                lines.append('%s_count%s %d' % (name, format_labels(metric.labels, label_values), v[-1]))
+            else:
+                lines.append('%s%s %s' % (name, format_labels(metric.labels, label_values), format_value(v)))
+
+    return '\n'.join(lines) + '\n'
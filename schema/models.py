@@ -40,6 +40,7 @@ class SubjectDataset(BaseModel):
 
 class SubjectDatasetResponse(BaseModel):
     subject_datasets: Optional[List[SubjectDataset]] = None
+    next_cursor: Optional[str] = None
 
 
 class Locus(Enum):
@@ -0,0 +1,104 @@
+# Check the publication of dataset versions behind a link, the move of legacy directories, and the pruning of
+# superseded versions. Run with pytest
+
+import os
+import time
+from os.path import join, islink, isdir
+
+from db.dataset_publish import create_version_dir, publish_dir, move_legacy_dir, prune_versions, unpublish_dir, \
+    version_dirs, VERSIONS_KEPT, PRUNE_AFTER
+
+
+def publish_version(link_path, content):
+    target = create_version_dir(link_path)
+    with open(join(target, 'db.sqlite3'), 'w') as fo:
+        fo.write(content)
+    publish_dir(link_path, target)
+    return target
+
+
+def published_content(link_path):
+    with open(join(link_path, 'db.sqlite3')) as fi:
+        return fi.read()
+
+
+def supersede(path, seconds_ago):
+    t = time.time() - seconds_ago
+    os.utime(path, (t, t))
+
+
+def test_first_publish_moves_legacy_dir(tmp_path):
+    link_path = str(tmp_path / 'Human' / 'ds')
+    os.makedirs(link_path)
+    with open(join(link_path, 'db.sqlite3'), 'w') as fo:
+        fo.write('legacy')
+
+    target = publish_version(link_path, 'v1')
+
+    assert islink(link_path)
+    assert os.path.realpath(link_path) == os.path.realpath(target)
+    assert published_content(link_path) == 'v1'
+
+    # the legacy directory is kept, under a versioned name, until it is pruned
+    legacy = [v for v in version_dirs(link_path) if v != target]
+    assert len(legacy) == 1
+    with open(join(legacy[0], 'db.sqlite3')) as fi:
+        assert fi.read() == 'legacy'
+
+
+def test_move_legacy_dir_ignores_links_and_missing_dirs(tmp_path):
+    link_path = str(tmp_path / 'Human' / 'ds')
+    assert move_legacy_dir(link_path) is None
+
+    publish_version(link_path, 'v1')
+    assert move_legacy_dir(link_path) is None
+    assert islink(link_path)
+
+
+def test_publish_keeps_versions_in_use(tmp_path):
+    link_path = str(tmp_path / 'Human' / 'ds')
+    targets = [publish_version(link_path, 'v%d' % i) for i in range(4)]
+
+    # the superseded versions were replaced moments ago, so may still be read, and none is pruned
+    assert version_dirs(link_path) == sorted(targets)
+    assert published_content(link_path) == 'v3'
+
+
+def test_publish_prunes_old_versions(tmp_path):
+    link_path = str(tmp_path / 'Human' / 'ds')
+    targets = [publish_version(link_path, 'v%d' % i) for i in range(3)]
+
+    for target in targets[:-1]:
+        supersede(target, PRUNE_AFTER + 60)
+
+    latest = publish_version(link_path, 'v3')
+
+    # the current version and the most recently superseded are kept, with VERSIONS_KEPT == 2
+    assert VERSIONS_KEPT == 2
+    assert version_dirs(link_path) == [targets[-1], latest]
+    assert published_content(link_path) == 'v3'
+
+
+def test_prune_versions_waits_for_prune_after(tmp_path):
+    link_path = str(tmp_path / 'Human' / 'ds')
+    targets = [publish_version(link_path, 'v%d' % i) for i in range(4)]
+
+    supersede(targets[0], 120)
+    supersede(targets[1], 30)
+
+    prune_versions(link_path, keep=1, prune_after=60)
+    assert version_dirs(link_path) == targets[1:]
+
+    prune_versions(link_path, keep=1, prune_after=0)
+    assert version_dirs(link_path) == [targets[-1]]
+
+
+def test_unpublish_removes_all_versions(tmp_path):
+    link_path = str(tmp_path / 'Human' / 'ds')
+    for i in range(3):
+        publish_version(link_path, 'v%d' % i)
+
+    unpublish_dir(link_path)
+
+    assert not islink(link_path) and not isdir(link_path)
+    assert os.listdir(str(tmp_path / 'Human')) == []
@@ -0,0 +1,186 @@
+# Check that the dataset registry opens datasets on use, evicts the least recently used, and picks up published
+# versions on refresh, retiring providers that are replaced but only disposing of them when they are no longer in
+# use. Datasets are published in a temporary directory with dataset_publish. Run with pytest
+
+import os
+import sqlite3
+from os.path import join, realpath, basename
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
+
+from db.dataset_publish import create_version_dir, publish_dir, unpublish_dir
+from db.dataset_registry import DatasetRegistry
+
+
+class Provider:
+    def __init__(self, entry):
+        self.path = entry.path
+        self.version = entry.version
+        self.modified = entry.modified
+        self.db = create_engine('sqlite:///' + entry.path, poolclass=QueuePool)
+        self.disposed = False
+
+    def content(self, conn):
+        return conn.execute(text('SELECT content FROM dataset')).scalar()
+
+    def release_session(self):
+        pass
+
+
+class Registry(DatasetRegistry):
+    def drain(self):
+        with self.lock:
+            drained = [provider for provider in self.retired if provider.db.pool.checkedout() == 0]
+        super().drain()
+        for provider in drained:
+            provider.disposed = True
+
+
+def publish(root, species, name, content):
+    link_path = join(root, species, name)
+    target = create_version_dir(link_path)
+    db = sqlite3.connect(join(target, 'db.sqlite3'))
+    db.execute('CREATE TABLE dataset (content TEXT)')
+    db.execute('INSERT INTO dataset VALUES (?)', (content,))
+    db.commit()
+    db.close()
+    publish_dir(link_path, target)
+
+
+# As vdjbase_db.scan_datasets, with the version directory's name as the content version
+
+def scanner(root):
+    def scan():
+        datasets = {}
+        for species in os.listdir(root):
+            for name in os.listdir(join(root, species)):
+                if name[0] != '.':
+                    path = realpath(join(root, species, name, 'db.sqlite3'))
+                    datasets[(species, name)] = (path, basename(os.path.dirname(path)), 0)
+        return datasets
+    return scan
+
+
+def make_registry(root, capacity=0):
+    scan = scanner(root)
+    registry = Registry(Provider, capacity, scan, lambda path: 'description of %s' % path)
+    for (species, name), (path, version, modified) in scan().items():
+        registry.add(species, name, path, 'description', version, modified)
+    return registry
+
+
+def read(registry, species, name):
+    with registry[species][name].db.connect() as conn:
+        return registry[species][name].content(conn)
+
+
+@pytest.fixture
+def root(tmp_path):
+    for name in ('a', 'b', 'c'):
+        publish(str(tmp_path), 'Human', name, '%s 1' % name)
+    return str(tmp_path)
+
+
+def test_datasets_are_opened_on_use(root):
+    registry = make_registry(root)
+
+    assert registry.stats()['open'] == 0
+    assert 'a' in registry['Human'] and 'a_description' in registry['Human']
+    assert registry.stats()['open'] == 0
+
+    assert read(registry, 'Human', 'a') == 'a 1'
+    assert read(registry, 'Human', 'a') == 'a 1'
+    assert registry.stats()['open'] == 1
+    assert registry.stats()['misses'] == 1
+
+
+def test_least_recently_used_is_evicted(root):
+    registry = make_registry(root, capacity=2)
+
+    a = registry.provider('Human', 'a')
+    registry.provider('Human', 'b')
+    registry.provider('Human', 'a')
+    registry.provider('Human', 'c')
+
+    assert list(registry.open_providers) == [('Human', 'a'), ('Human', 'c')]
+    assert registry.stats()['evictions'] == 1
+    assert registry.retired == []
+
+    # an evicted dataset is opened again on its next use
+    assert read(registry, 'Human', 'b') == 'b 1'
+    assert list(registry.open_providers) == [('Human', 'c'), ('Human', 'b')]
+    assert a.disposed
+
+
+def test_evicted_provider_in_use_is_drained_later(root):
+    registry = make_registry(root, capacity=1)
+
+    a = registry.provider('Human', 'a')
+    conn = a.db.connect()
+    registry.provider('Human', 'b')
+
+    assert registry.retired == [a]
+    assert a.content(conn) == 'a 1'
+    assert not a.disposed
+
+    conn.close()
+    registry.drain()
+    assert registry.retired == []
+    assert a.disposed
+
+
+def test_refresh_picks_up_new_version_while_old_is_in_use(root):
+    registry = make_registry(root)
+
+    old = registry.provider('Human', 'a')
+    conn = old.db.connect()
+
+    publish(root, 'Human', 'a', 'a 2')
+    publish(root, 'Human', 'd', 'd 1')
+    registry.refresh()
+
+    # new requests read the new version, while the request holding the old provider can finish reading the old one
+    assert read(registry, 'Human', 'a') == 'a 2'
+    assert read(registry, 'Human', 'd') == 'd 1'
+    assert registry['Human']['a'] is not old
+    assert registry.stats()['reloads'] == 1
+    assert old.content(conn) == 'a 1'
+    assert registry.retired == [old]
+
+    conn.close()
+    registry.drain()
+    assert registry.retired == []
+    assert old.disposed
+
+
+def test_refresh_removes_unpublished_datasets(root):
+    registry = make_registry(root)
+    b = registry.provider('Human', 'b')
+
+    unpublish_dir(join(root, 'Human', 'b'))
+    registry.refresh()
+
+    assert 'b' not in registry['Human']
+    assert registry['Human'].names() == ['a', 'c']
+    assert b.disposed
+
+    with pytest.raises(KeyError):
+        registry.provider('Human', 'b')
+
+
+# A provider opened on an entry that was replaced while it was being opened is retired, and the current entry is
+# opened instead
+
+def test_provider_opened_on_replaced_entry_is_retired(root):
+    registry = make_registry(root)
+    stale_entry = registry.entry('Human', 'a')
+    stale = Provider(stale_entry)
+
+    publish(root, 'Human', 'a', 'a 2')
+    registry.refresh()
+
+    assert registry.add_provider(('Human', 'a'), stale_entry, stale) is None
+    assert stale.disposed
+    assert read(registry, 'Human', 'a') == 'a 2'
@@ -0,0 +1,224 @@
+# Check that keyset paging across datasets returns the same rows, in the same order, as a single sort of all the
+# rows, and that bad cursors are rejected. Each dataset is an in-memory SQLite database. Run with pytest
+
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import create_engine, func, Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from db.list_cursor import decode_keyset_cursor, keyset_page_query, merge_keyset_pages, encode_cursor, decode_cursor
+from db.sql_sort import sort_key_columns, keyset_condition, merge_sorted_streams, check_sort_specs
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'item'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    value = Column(String)
+
+
+filters = {
+    'name': {'field': Item.name},
+    'value': {'field': Item.value, 'sort': 'numeric'},
+    'dataset': {'field': None},
+}
+
+# Duplicate names within and across the datasets, blank names both NULL and '', and blank values
+
+DATASETS = {
+    'first': [('b', '2'), ('a', '10'), (None, '1'), ('', None), ('a', '2'), ('c', ''), ('b', '2')],
+    'second': [('a', '2'), ('', '3'), ('b', None), (None, None), ('d', '1.5'), ('a', '10')],
+}
+
+
+def make_session(rows):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([Item(id=i + 1, name=name, value=value) for i, (name, value) in enumerate(rows)])
+    session.commit()
+    return session
+
+
+@pytest.fixture(scope='module')
+def sessions():
+    return {dset: make_session(rows) for dset, rows in DATASETS.items()}
+
+
+# The order given by the Python sort keys that the SQL keys mirror: successive stable sorts, starting from the rows
+# in dataset and id order
+
+def expected_order(sort_specs):
+    rows = [(dset, i + 1, name, value) for dset, items in DATASETS.items() for i, (name, value) in enumerate(items)]
+
+    for spec in sort_specs:
+        col = 2 if spec['field'] == 'name' else 3
+        reverse = spec.get('order') == 'desc'
+        if spec['field'] == 'value':
+            rows.sort(key=lambda r: -1.0 if r[col] in (None, '') else float(r[col]), reverse=reverse)
+        else:
+            rows.sort(key=lambda r: (r[col] in (None, ''), r[col] or ''), reverse=reverse)
+
+    return [(dset, id) for dset, id, _, _ in rows]
+
+
+def read_pages(sessions, sort_specs, page_size):
+    datasets = list(sessions.keys())
+    sort_keys = sort_key_columns(filters, sort_specs)
+    id_keys = [(Item.id.label('_sort_id'), False)]
+    cursor = None
+    ret = []
+
+    while True:
+        last = decode_keyset_cursor(cursor, datasets, sort_keys, id_keys) if cursor else None
+        pages = []
+
+        for ds_index, dset in enumerate(datasets):
+            query = sessions[dset].query(Item.id).add_columns(*[k for k, _ in sort_keys + id_keys])
+            pages.append((dset, keyset_page_query(query, sort_keys, id_keys, ds_index, last, page_size + 1).all()))
+
+        merged, cursor = merge_keyset_pages(pages, sort_keys, id_keys, 0, page_size)
+        assert len(merged) <= page_size
+        ret.extend((dset, r.id) for dset, r in merged)
+
+        if not cursor:
+            return ret
+
+
+@pytest.mark.parametrize('sort_specs', [
+    [{'field': 'name', 'order': 'asc'}],
+    [{'field': 'name', 'order': 'desc'}],
+    [{'field': 'value', 'order': 'asc'}],
+    [{'field': 'value', 'order': 'desc'}],
+    [{'field': 'value', 'order': 'asc'}, {'field': 'name', 'order': 'asc'}],
+    [{'field': 'name', 'order': 'desc'}, {'field': 'value', 'order': 'desc'}],
+    [],
+])
+@pytest.mark.parametrize('page_size', [1, 2, 3, 5, 20])
+def test_pages_match_full_sort(sessions, sort_specs, page_size):
+    assert read_pages(sessions, sort_specs, page_size) == expected_order(sort_specs)
+
+
+def test_offset_pages_match_full_sort(sessions):
+    sort_specs = [{'field': 'name', 'order': 'asc'}]
+    sort_keys = sort_key_columns(filters, sort_specs)
+    id_keys = [(Item.id.label('_sort_id'), False)]
+    expected = expected_order(sort_specs)
+
+    for offset in range(len(expected)):
+        pages = []
+        for ds_index, dset in enumerate(sessions.keys()):
+            query = sessions[dset].query(Item.id).add_columns(*[k for k, _ in sort_keys + id_keys])
+            pages.append((dset, keyset_page_query(query, sort_keys, id_keys, ds_index, None, offset + 3).all()))
+
+        merged, _ = merge_keyset_pages(pages, sort_keys, id_keys, offset, 2)
+        assert [(dset, r.id) for dset, r in merged] == expected[offset:offset + 2]
+
+
+# Names grouped within each dataset, sorted by their count. The position is applied with HAVING
+
+def test_grouped_pages(sessions):
+    count = func.count(Item.id)
+    grouped_filters = {'count': {'field': count, 'sort': 'numeric'}}
+    sort_keys = sort_key_columns(grouped_filters, [{'field': 'count', 'order': 'desc'}])
+    id_keys = [(func.min(Item.id).label('_sort_id'), False)]
+    datasets = list(sessions.keys())
+
+    expected = []
+    for dset, items in DATASETS.items():
+        groups = {}
+        for i, (name, _) in enumerate(items):
+            groups.setdefault(name, []).append(i + 1)
+        expected.extend((len(ids), dset, min(ids)) for ids in groups.values())
+    expected.sort(key=lambda x: (-x[0], datasets.index(x[1]), x[2]))
+
+    cursor = None
+    ret = []
+    while True:
+        last = decode_keyset_cursor(cursor, datasets, sort_keys, id_keys) if cursor else None
+        pages = []
+        for ds_index, dset in enumerate(datasets):
+            query = sessions[dset].query(Item.name).group_by(Item.name).add_columns(*[k for k, _ in sort_keys + id_keys])
+            pages.append((dset, keyset_page_query(query, sort_keys, id_keys, ds_index, last, 3, grouped=True).all()))
+
+        merged, cursor = merge_keyset_pages(pages, sort_keys, id_keys, 0, 2)
+        ret.extend((int(r._sort_0), dset, r._sort_id) for dset, r in merged)
+        if not cursor:
+            break
+
+    assert ret == expected
+
+
+def test_cursor_round_trips_typed_values():
+    content = {'k': [date(2020, 1, 2), datetime(2020, 1, 2, 3, 4, 5), Decimal('1.50'), None, 'x'], 'd': 'first', 'i': [3]}
+    assert decode_cursor(encode_cursor(content)) == content
+
+
+def encoded(content):
+    return base64.urlsafe_b64encode(json.dumps(content).encode('utf-8')).decode('ascii')
+
+
+@pytest.mark.parametrize('cursor', [
+    'not a cursor',
+    encoded([1, 2]),
+    encoded({'k': ['a', 0], 'd': 'first'}),
+    encoded({'k': ['a', 0, 1], 'd': 'first', 'i': [1]}),
+    encoded({'k': ['a', 0], 'd': 'first', 'i': []}),
+    encoded({'k': [{'x': 1}, 0], 'd': 'first', 'i': [1]}),
+    encoded({'k': ['a', 0], 'd': 'removed', 'i': [1]}),
+])
+def test_bad_cursors_are_rejected(cursor):
+    sort_keys = sort_key_columns(filters, [{'field': 'name', 'order': 'asc'}])
+    id_keys = [(Item.id.label('_sort_id'), False)]
+
+    with pytest.raises(ValueError):
+        decode_keyset_cursor(cursor, ['first', 'second'], sort_keys, id_keys)
+
+
+# A cursor issued for one sort order can't be used with another
+
+def test_stale_cursor_is_rejected(sessions):
+    sort_keys = sort_key_columns(filters, [{'field': 'name', 'order': 'asc'}])
+    id_keys = [(Item.id.label('_sort_id'), False)]
+    pages = [(dset, keyset_page_query(sessions[dset].query(Item.id).add_columns(*[k for k, _ in sort_keys + id_keys]),
+                                      sort_keys, id_keys, ds_index).all())
+             for ds_index, dset in enumerate(sessions.keys())]
+    _, cursor = merge_keyset_pages(pages, sort_keys, id_keys, 0, 2)
+
+    with pytest.raises(ValueError):
+        decode_keyset_cursor(cursor, ['first', 'second'], sort_key_columns(filters, [{'field': 'value', 'order': 'asc'}]), id_keys)
+
+
+def test_keyset_condition_after_blank(sessions):
+    sort_keys = sort_key_columns(filters, [{'field': 'name', 'order': 'asc'}])
+    session = sessions['first']
+
+    # after the last non-blank name come the blanks, and after the first blank (in id order) the remaining blanks
+    after_c = session.query(Item.id).filter(keyset_condition(sort_keys, [0, 'c'])).order_by(Item.id).all()
+    after_blank = session.query(Item.id).filter(keyset_condition(sort_keys + [(Item.id, False)], [1, None, 3])).all()
+
+    assert [r.id for r in after_c] == [3, 4]
+    assert [r.id for r in after_blank] == [4]
+
+
+def test_merge_sorted_streams():
+    streams = [[(1, 'a'), (3, 'c'), (3, 'd')], [(2, 'b'), (3, 'e')], []]
+
+    assert merge_sorted_streams(streams) == ['a', 'b', 'c', 'd', 'e']
+    assert merge_sorted_streams(streams, 1, 3) == ['b', 'c', 'd']
+    assert merge_sorted_streams(streams, 4, 10) == ['e']
+
+
+def test_check_sort_specs():
+    check_sort_specs(filters, [{'field': 'name', 'order': 'asc'}, {'field': 'value'}])
+
+    for spec in [{'field': 'dataset'}, {'field': 'missing'}, 'name']:
+        with pytest.raises(ValueError):
+            check_sort_specs(filters, [spec])
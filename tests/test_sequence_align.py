@@ -0,0 +1,40 @@
+# Check that the k-mer shortlist used by the sequence search report never leaves out a sequence that the aligner
+# would accept. Run with pytest
+
+import random
+
+from api.reports.sequence_align import KmerIndex, make_aligner
+
+
+def shortlist_misses(target, sequences):
+    min_score = len(target) * 0.9
+    aligner = make_aligner()
+    shortlist = set(KmerIndex(sequences).shortlist(target, min_score, sequences))
+    return [seq for seq in sequences if aligner.score(target, seq) >= min_score and seq not in shortlist]
+
+
+def test_shortlist_keeps_sequences_at_threshold():
+    assert shortlist_misses('cggtac', ['cggtacaa']) == []
+
+
+def test_shortlist_matches_aligner():
+    rng = random.Random(1)
+
+    for _ in range(2000):
+        target = ''.join(rng.choice('acgt') for _ in range(rng.randint(6, 30)))
+        sequences = []
+
+        for _ in range(10):
+            seq = list(target)
+            for _ in range(rng.randint(0, 3)):
+                p = rng.randrange(len(seq) + 1)
+                op = rng.choice('sid')
+                if op == 's' and p < len(seq):
+                    seq[p] = rng.choice('acgt')
+                elif op == 'i':
+                    seq.insert(p, rng.choice('acgt'))
+                elif p < len(seq):
+                    del seq[p]
+            sequences.append(''.join(seq))
+
+        assert shortlist_misses(target, sequences) == []
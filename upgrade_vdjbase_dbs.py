@@ -0,0 +1,21 @@
+# Standalone script to upgrade the schema of published VDJbase datasets built before the current schema
+#
+# Each dataset that needs it is copied to a new version, upgraded and published. The web app will not serve a dataset
+# until it has been upgraded. Workers do this at startup unless UPGRADE_DATASETS_AT_START is disabled, in which case
+# this script should be run on deployment.
+
+import argparse
+import os
+from db.vdjbase_db import upgrade_published_datasets
+
+parser = argparse.ArgumentParser(description='Upgrade the schema of published VDJbase datasets')
+parser.add_argument('db_path', nargs='?', default=os.path.join('static', 'study_data', 'VDJbase', 'db'),
+                    help='directory holding the published datasets (default static/study_data/VDJbase/db)')
+args = parser.parse_args()
+
+upgraded = upgrade_published_datasets(args.db_path)
+
+for dataset in upgraded:
+    print('Upgraded %s' % dataset)
+
+print('%d datasets upgraded' % len(upgraded))